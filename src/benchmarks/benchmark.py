@@ -0,0 +1,325 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+"""
+template-specialize benchmarks
+
+Each benchmark generates synthetic templates and environment files in a temporary directory and runs template-specialize
+repeatedly. The throughput, run time percentiles, and peak memory of each benchmark are reported and may be saved as
+JSON and compared to a previous run's results.
+"""
+
+import argparse
+import contextlib
+import fnmatch
+import json
+import os
+import platform
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+import tracemalloc
+import unittest.mock as unittest_mock
+
+from template_specialize.aws_parameter_store import ParameterStoreExtension
+from template_specialize.main import main as template_specialize_main
+
+
+def main(argv=None):
+    """
+    template-specialize benchmarks main entry point
+    """
+
+    parser = argparse.ArgumentParser(prog='benchmark')
+    parser.add_argument('-b', '--benchmark', dest='benchmarks', metavar='PATTERN', action='append',
+                        help='run the benchmarks matching a name glob pattern')
+    parser.add_argument('-r', '--repeat', type=int, metavar='N', default=5,
+                        help='run each benchmark N times (default is 5)')
+    parser.add_argument('-s', '--scale', type=float, metavar='X', default=1,
+                        help='scale the benchmark sizes by X (default is 1)')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='save the benchmark results as JSON')
+    parser.add_argument('-c', '--compare', metavar='FILE',
+                        help='compare with previously saved benchmark results')
+    parser.add_argument('-t', '--threshold', type=float, metavar='PCT', default=10,
+                        help='the median run time increase reported as a regression (default is 10)')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='list the benchmarks')
+    args = parser.parse_args(args=argv)
+    if args.repeat < 1:
+        parser.error(f'argument -r/--repeat: invalid repeat count: {args.repeat}')
+
+    # Get the benchmarks to run
+    benchmarks = [
+        (name, benchmark_fn) for name, benchmark_fn in BENCHMARKS
+        if args.benchmarks is None or any(fnmatch.fnmatch(name, pattern) for pattern in args.benchmarks)
+    ]
+    if args.list:
+        for name, _ in benchmarks:
+            print(name)
+        return
+    if not benchmarks:
+        parser.exit(message='no benchmarks match\n', status=2)
+
+    # Load the comparison results
+    baseline = None
+    if args.compare is not None:
+        try:
+            with open(args.compare, 'r', encoding='utf-8') as f_baseline:
+                baseline = json.load(f_baseline)['benchmarks']
+        except (OSError, ValueError, KeyError) as exc:
+            parser.exit(message=f'{exc}\n', status=2)
+
+    # Run the benchmarks
+    results = {}
+    print(f'{"Benchmark":<24} {"Items":>7} {"Items/sec":>11} {"p50 (ms)":>10} {"p90 (ms)":>10} {"p99 (ms)":>10} {"Peak (MB)":>10}')
+    for name, benchmark_fn in benchmarks:
+        with TemporaryDirectory() as temp_dir:
+            count, run_fn = benchmark_fn(temp_dir, args.scale)
+            results[name] = _run_benchmark(count, run_fn, args.repeat)
+        result = results[name]
+        print(
+            f'{name:<24} {count:>7} {result["throughput"]:>11.1f} {result["p50"] * 1000:>10.1f} '
+            f'{result["p90"] * 1000:>10.1f} {result["p99"] * 1000:>10.1f} {result["peak_memory"] / 1048576:>10.1f}'
+        )
+
+    # Save the results
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f_output:
+            json.dump({
+                'version': RESULTS_VERSION,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'scale': args.scale,
+                'benchmarks': results
+            }, f_output, indent=4, sort_keys=True)
+
+    # Compare the results
+    if baseline is not None:
+        regressions = []
+        print()
+        print(f'{"Benchmark":<24} {"Base p50 (ms)":>14} {"p50 (ms)":>10} {"Change":>8}')
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            change = (result['p50'] / baseline[name]['p50'] - 1) * 100
+            is_regression = change > args.threshold
+            if is_regression:
+                regressions.append(name)
+            print(
+                f'{name:<24} {baseline[name]["p50"] * 1000:>14.1f} {result["p50"] * 1000:>10.1f} {change:>+7.1f}%'
+                f'{" REGRESSION" if is_regression else ""}'
+            )
+        if regressions:
+            parser.exit(message=f'\n{len(regressions)} benchmark regressions\n', status=1)
+
+
+# The benchmark results file version
+RESULTS_VERSION = 1
+
+
+def _run_benchmark(count, run_fn, repeat):
+    # Warm up and measure peak memory
+    tracemalloc.start()
+    try:
+        run_fn()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    # Time the runs
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        run_fn()
+        times.append(time.perf_counter() - start_time)
+    times.sort()
+
+    p50 = _percentile(times, 0.5)
+    return {
+        'count': count,
+        'times': times,
+        'p50': p50,
+        'p90': _percentile(times, 0.9),
+        'p99': _percentile(times, 0.99),
+        'throughput': count / p50 if p50 else 0,
+        'peak_memory': peak_memory
+    }
+
+
+def _percentile(sorted_values, fraction):
+    # Linear interpolation between the closest ranks
+    position = (len(sorted_values) - 1) * fraction
+    index = int(position)
+    if index + 1 >= len(sorted_values):
+        return sorted_values[-1]
+    return sorted_values[index] + (sorted_values[index + 1] - sorted_values[index]) * (position - index)
+
+
+def _run_main(argv):
+    # Run template-specialize, discarding its output
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, \
+         contextlib.redirect_stdout(devnull), \
+         contextlib.redirect_stderr(devnull):
+        template_specialize_main(argv)
+
+
+def _write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file_:
+        file_.write(content)
+
+
+# A typical small configuration template
+TEMPLATE = '''\
+# {{name}} configuration
+{% for key, value in settings|dictsort %}
+{{key}} = {{value}}
+{% endfor %}
+{% include "include/footer.txt" %}
+'''
+
+
+def _write_templates(src_dir, file_paths):
+    for file_path in file_paths:
+        _write_file(os.path.join(src_dir, file_path), TEMPLATE)
+    _write_file(os.path.join(src_dir, 'include', 'footer.txt'), '# generated for {{name}}\n')
+
+
+TEMPLATE_KEYS = ['-k', 'name', 'benchmark', '-k', 'settings', json.dumps({f'setting{ix}': ix for ix in range(20)})]
+
+
+def _benchmark_wide(temp_dir, scale, args=()):
+    # Many template files in one directory
+    count = max(1, int(2000 * scale))
+    src_dir = os.path.join(temp_dir, 'src')
+    dst_dir = os.path.join(temp_dir, 'dst')
+    _write_templates(src_dir, [f'file{ix}.txt' for ix in range(count)])
+    return count + 1, lambda: _run_main([src_dir, dst_dir, *TEMPLATE_KEYS, *args])
+
+
+def _benchmark_wide_jobs(temp_dir, scale):
+    return _benchmark_wide(temp_dir, scale, ('-j', '8'))
+
+
+def _benchmark_wide_incremental(temp_dir, scale):
+    # Unchanged inputs - all files are skipped after the first run
+    return _benchmark_wide(temp_dir, scale, ('--incremental',))
+
+
+def _benchmark_deep(temp_dir, scale):
+    # Template files in a deeply-nested directory tree
+    depth = 8
+    files_per_dir = max(1, int(100 * scale))
+    src_dir = os.path.join(temp_dir, 'src')
+    dst_dir = os.path.join(temp_dir, 'dst')
+    file_paths = []
+    for ix_depth in range(depth):
+        dir_path = os.path.join(*(f'dir{ix}' for ix in range(ix_depth + 1)))
+        file_paths.extend(os.path.join(dir_path, f'file{ix}.txt') for ix in range(files_per_dir))
+    _write_templates(src_dir, file_paths)
+    return len(file_paths) + 1, lambda: _run_main([src_dir, dst_dir, *TEMPLATE_KEYS])
+
+
+def _benchmark_environment_large(temp_dir, scale):
+    # Many environments with many values
+    environment_count = max(1, int(200 * scale))
+    environments = {'base': {'values': {f'value{ix}': {'a': ix, 'b': [ix, ix + 1]} for ix in range(500)}}}
+    for ix in range(environment_count):
+        environments[f'env{ix}'] = {
+            'parents': ['base'],
+            'values': {f'value{ix_value}': {'a': ix} for ix_value in range(0, 500, 5)}
+        }
+    environment_path = os.path.join(temp_dir, 'environments.json')
+    _write_file(environment_path, json.dumps(environments))
+    template_path = os.path.join(temp_dir, 'template.txt')
+    _write_file(template_path, '{{value0.a}}')
+    dst_path = os.path.join(temp_dir, 'output-{env}.txt')
+    return environment_count, lambda: _run_main([template_path, dst_path, '-c', environment_path, '-e', 'env*'])
+
+
+def _benchmark_environment_deep(temp_dir, scale):
+    # A deeply-inherited environment
+    depth = max(1, int(500 * scale))
+    environments = {'env0': {'values': {f'value{ix}': ix for ix in range(100)}}}
+    for ix in range(1, depth):
+        environments[f'env{ix}'] = {'parents': [f'env{ix - 1}'], 'values': {f'value{ix % 100}': {'level': ix}}}
+    environment_path = os.path.join(temp_dir, 'environments.json')
+    _write_file(environment_path, json.dumps(environments))
+    template_path = os.path.join(temp_dir, 'template.txt')
+    _write_file(template_path, '{{value0}}')
+    dst_path = os.path.join(temp_dir, 'output.txt')
+    return depth, lambda: _run_main([template_path, dst_path, '-c', environment_path, '-e', f'env{depth - 1}'])
+
+
+def _benchmark_keys(temp_dir, scale):
+    # Many -k template keys
+    count = max(1, int(5000 * scale))
+    keys = []
+    for ix in range(count):
+        keys.extend(('-k', f'key{ix}', json.dumps({'value': ix})))
+    template_path = os.path.join(temp_dir, 'template.txt')
+    _write_file(template_path, '{{key0.value}}')
+    dst_path = os.path.join(temp_dir, 'output.txt')
+    return count, lambda: _run_main([template_path, dst_path, *keys])
+
+
+class _ParameterStoreClient:
+    # A Parameter Store client that simulates request latency
+
+    LATENCY = 0.002
+
+    def get_parameters(self, Names, WithDecryption): # pylint: disable=invalid-name, unused-argument
+        time.sleep(self.LATENCY)
+        return {'Parameters': [{'Name': name, 'Value': f'{name}-value'} for name in Names], 'InvalidParameters': []}
+
+    def get_parameter(self, Name, WithDecryption): # pylint: disable=invalid-name, unused-argument
+        time.sleep(self.LATENCY)
+        return {'Parameter': {'Name': Name, 'Value': f'{Name}-value'}}
+
+
+def _benchmark_parameter_store(temp_dir, scale):
+    # Many aws_parameter_store tags - literal names are prefetched and computed names are retrieved concurrently
+    file_count = max(1, int(50 * scale))
+    src_dir = os.path.join(temp_dir, 'src')
+    dst_dir = os.path.join(temp_dir, 'dst')
+    for ix_file in range(file_count):
+        _write_file(os.path.join(src_dir, f'file{ix_file}.txt'), ''.join((
+            *(f"literal{ix} = {{% aws_parameter_store 'literal/{ix_file}/{ix}' %}}\n" for ix in range(20)),
+            '{% set names = [] %}',
+            f"{{% for ix in range(20) %}}{{% set _ = names.append('computed/{ix_file}/' ~ ix) %}}{{% endfor %}}",
+            '{% for value in names|aws_parameter_store %}{{value}}\n{% endfor %}'
+        )))
+
+    def run_fn():
+        with unittest_mock.patch.object(ParameterStoreExtension, '_get_client', return_value=_ParameterStoreClient()):
+            _run_main([src_dir, dst_dir])
+
+    return file_count * 40, run_fn
+
+
+def _benchmark_startup(unused_temp_dir, unused_scale):
+    # Interpreter startup and template-specialize import
+    def run_fn():
+        subprocess.run([sys.executable, '-c', 'import template_specialize.main'], check=True)
+
+    return 1, run_fn
+
+
+# The benchmarks
+BENCHMARKS = [
+    ('startup', _benchmark_startup),
+    ('wide', _benchmark_wide),
+    ('wide-jobs', _benchmark_wide_jobs),
+    ('wide-incremental', _benchmark_wide_incremental),
+    ('deep', _benchmark_deep),
+    ('environment-large', _benchmark_environment_large),
+    ('environment-deep', _benchmark_environment_deep),
+    ('keys', _benchmark_keys),
+    ('parameter-store', _benchmark_parameter_store)
+]
+
+
+if __name__ == '__main__':
+    main()
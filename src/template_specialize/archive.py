@@ -0,0 +1,355 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+"""
+template-specialize template archives and archive destinations
+"""
+
+import functools
+import io
+import os
+import posixpath
+import sys
+import threading
+import time
+import zlib
+
+import jinja2
+import jinja2.loaders
+
+
+def archive_format(path):
+    """
+    Get a destination path's archive format ("tar", "tar.gz", or "zip") - returns None if the path is not an archive.
+    The path "-" is a tar stream written to stdout.
+    """
+
+    if path == ARCHIVE_STDOUT:
+        return 'tar'
+    path_lower = path.lower()
+    for suffix, format_ in ARCHIVE_SUFFIXES:
+        if path_lower.endswith(suffix):
+            return format_
+    return None
+
+
+# The archive path suffixes and their formats
+ARCHIVE_SUFFIXES = (
+    ('.tar.gz', 'tar.gz'),
+    ('.tgz', 'tar.gz'),
+    ('.tar', 'tar'),
+    ('.zip', 'zip')
+)
+
+# The stdout archive path
+ARCHIVE_STDOUT = '-'
+
+
+def rename_member(members, path, name):
+    """
+    Rename an archive member (or directory of members) - if name is None, the member is deleted
+
+    :param members: The dict of member name to member content (bytes) or source file path
+    :param path: The member's POSIX path
+    :raises ValueError: There is no such member or directory
+    """
+
+    prefix = f'{path}/'
+    matched = [member for member in members if member == path or member.startswith(prefix)]
+    if not matched:
+        raise ValueError(f'no such file or directory: {path!r}')
+
+    # If the destination is a directory, delete it first
+    dst_path = posixpath.join(posixpath.dirname(path), name) if name is not None else None
+    if dst_path is not None and dst_path != path:
+        dst_prefix = f'{dst_path}/'
+        for member in [member for member in members if member.startswith(dst_prefix)]:
+            del members[member]
+
+    # Rename or delete the members
+    for member in matched:
+        member_content = members.pop(member)
+        if dst_path is not None:
+            members[f'{dst_path}{member[len(path):]}'] = member_content
+
+
+def write_archive(path, archive_format_, members):
+    """
+    Write an archive file (or stdout tar stream) atomically
+
+    :param members: The dict of member name to member content (bytes) or source file path (str)
+    """
+
+    # Import the archive modules only when writing an archive
+    import tarfile # pylint: disable=import-outside-toplevel
+    import zipfile # pylint: disable=import-outside-toplevel
+
+    # Write the stdout tar stream
+    if path == ARCHIVE_STDOUT:
+        sys.stdout.flush()
+        with tarfile.open(fileobj=sys.stdout.buffer, mode='w|') as archive:
+            _write_tar_members(archive, members)
+        sys.stdout.buffer.flush()
+        return
+
+    # Write to a temporary file and then rename
+    path_dir = os.path.dirname(path)
+    if path_dir:
+        os.makedirs(path_dir, exist_ok=True)
+    path_tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        if archive_format_ == 'zip':
+            with zipfile.ZipFile(path_tmp, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                date_time = time.localtime()[:6]
+                for member, member_content in members.items():
+                    if isinstance(member_content, str):
+                        archive.write(member_content, arcname=member)
+                    else:
+                        member_info = zipfile.ZipInfo(member, date_time=date_time)
+                        member_info.compress_type = zipfile.ZIP_DEFLATED
+                        member_info.external_attr = (0o100000 | MEMBER_MODE) << 16
+                        archive.writestr(member_info, member_content)
+        else:
+            with tarfile.open(path_tmp, mode='w:gz' if archive_format_ == 'tar.gz' else 'w') as archive:
+                _write_tar_members(archive, members)
+        os.replace(path_tmp, path)
+    finally:
+        if os.path.exists(path_tmp):
+            os.unlink(path_tmp)
+
+
+# The rendered archive member permissions
+MEMBER_MODE = 0o644
+
+
+def _write_tar_members(archive, members):
+    import tarfile # pylint: disable=import-outside-toplevel
+
+    mtime = time.time()
+    for member, member_content in members.items():
+        if isinstance(member_content, str):
+            archive.add(member_content, arcname=member, recursive=False)
+        else:
+            member_info = tarfile.TarInfo(member)
+            member_info.size = len(member_content)
+            member_info.mtime = mtime
+            member_info.mode = MEMBER_MODE
+            archive.addfile(member_info, io.BytesIO(member_content))
+
+
+def is_archive_file(path):
+    """
+    Returns True if the path is an archive file (".tar", ".tar.gz", ".tgz", or ".zip")
+    """
+
+    return path != ARCHIVE_STDOUT and archive_format(path) is not None and os.path.isfile(path)
+
+
+def open_archive(path):
+    """
+    Open a template archive - archives are opened once and re-opened when the archive file changes
+
+    :raises OSError: The archive could not be read or is invalid
+    """
+
+    path_abs = os.path.abspath(path)
+    path_stat = os.stat(path_abs)
+    stat_key = (path_stat.st_mtime_ns, path_stat.st_size)
+    with _ARCHIVES_LOCK:
+        archive = _ARCHIVES.get(path_abs)
+        if archive is None or archive.stat_key != stat_key:
+            archive = TemplateArchive(path_abs, stat_key)
+            _ARCHIVES[path_abs] = archive
+    return archive
+
+
+# The open template archives by absolute path
+_ARCHIVES = {}
+_ARCHIVES_LOCK = threading.Lock()
+
+
+class TemplateArchive:
+    """
+    A read-only template archive with an in-memory member index
+
+    Member content is read only when requested. Uncompressed tar archive members are read from a memory-mapped archive
+    file, so reads are thread-safe and do not seek. Zip archive members are read by zipfile from the memory-mapped
+    archive file and compressed tar archive members are read in sequence from the compressed stream, one at a time.
+
+    :param path: The archive file path
+    :param stat_key: The archive file's modified time and size when opened
+    :raises OSError: The archive could not be read or is invalid
+    """
+
+    def __init__(self, path, stat_key=None):
+        # Import the archive modules only when reading an archive
+        import mmap # pylint: disable=import-outside-toplevel
+        import tarfile # pylint: disable=import-outside-toplevel
+        import zipfile # pylint: disable=import-outside-toplevel
+
+        self.path = path
+        self.stat_key = stat_key
+        self.format = archive_format(path)
+        self.members = {}
+        self._mmap = None
+        self._tarfile = None
+        self._zipfile = None
+        self._lock = threading.Lock()
+        with open(path, 'rb') as archive_file:
+            try:
+                if self.format == 'tar.gz':
+                    self._tarfile = tarfile.open(path, 'r:gz')
+                    self._add_tar_members(self._tarfile)
+                else:
+                    self._mmap = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+                    if self.format == 'zip':
+                        self._zipfile = zipfile.ZipFile(_SeekableMmap(self._mmap))
+                        for member_info in self._zipfile.infolist():
+                            if not member_info.is_dir():
+                                self._add_member(member_info.filename, member_info)
+                    else:
+                        with tarfile.open(fileobj=self._mmap, mode='r:') as archive:
+                            self._add_tar_members(archive)
+            except (EOFError, ValueError, tarfile.TarError, zipfile.BadZipFile, zlib.error) as exc:
+                self.close()
+                raise OSError(f'invalid archive {path!r}: {exc}') from exc
+
+    def close(self):
+        """
+        Close the archive file
+        """
+
+        if self._tarfile is not None:
+            self._tarfile.close()
+        if self._zipfile is not None:
+            self._zipfile.close()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def read(self, name):
+        """
+        Read an archive member's content
+
+        :param name: The member's POSIX path
+        :raises KeyError: There is no such member
+        :raises OSError: The member could not be read
+        """
+
+        member_info = self.members[name]
+
+        # Uncompressed tar archive?
+        if self.format == 'tar':
+            return self._mmap[member_info.offset_data:member_info.offset_data + member_info.size]
+
+        # Zip or compressed tar archive
+        import zipfile # pylint: disable=import-outside-toplevel
+
+        with self._lock:
+            try:
+                if self._zipfile is not None:
+                    return self._zipfile.read(member_info)
+                return self._tarfile.extractfile(member_info).read()
+            except (EOFError, zlib.error, zipfile.BadZipFile, NotImplementedError, RuntimeError) as exc:
+                raise OSError(f'invalid archive {self.path!r}: {exc}') from exc
+
+    def size(self, name):
+        """
+        Get an archive member's uncompressed size
+
+        :param name: The member's POSIX path
+        :raises KeyError: There is no such member
+        """
+
+        member_info = self.members[name]
+        return member_info.file_size if self.format == 'zip' else member_info.size
+
+    def _add_tar_members(self, archive):
+        for member_info in archive:
+            if member_info.isreg():
+                self._add_member(member_info.name, member_info)
+
+    def _add_member(self, name, member_info):
+        # Normalize the member name - members outside of the archive root are ignored
+        name = posixpath.normpath(name.lstrip('/'))
+        if name in ('.', '..') or name.startswith('../'):
+            return
+        self.members[name] = member_info
+
+
+class _SeekableMmap:
+    # A memory map file object for zipfile member reads - memory maps have no "seekable" method before Python 3.13
+
+    __slots__ = ('_mmap',)
+
+    def __init__(self, mmap_):
+        self._mmap = mmap_
+
+    def __getattr__(self, name):
+        return getattr(self._mmap, name)
+
+    @staticmethod
+    def seekable():
+        return True
+
+
+class ArchiveLoader(jinja2.FileSystemLoader):
+    """
+    A file system template loader whose search paths may be template archive files (".tar", ".tar.gz", ".tgz", or
+    ".zip"). Archive templates are loaded by member path.
+    """
+
+    def __init__(self, searchpath, encoding='utf-8', followlinks=False):
+        super().__init__(searchpath, encoding=encoding, followlinks=followlinks)
+        self._loaders = [
+            (searchpath_, None if is_archive_file(searchpath_) else jinja2.FileSystemLoader(searchpath_, encoding, followlinks))
+            for searchpath_ in self.searchpath
+        ]
+
+    def get_source(self, environment, template):
+        name = '/'.join(jinja2.loaders.split_template_path(template))
+        for searchpath, loader in self._loaders:
+            # File system search path?
+            if loader is not None:
+                try:
+                    return loader.get_source(environment, template)
+                except jinja2.TemplateNotFound:
+                    continue
+
+            # Archive search path
+            archive = open_archive(searchpath)
+            if name in archive.members:
+                source = archive.read(name).decode(self.encoding)
+                return source, os.path.join(searchpath, *name.split('/')), functools.partial(_archive_uptodate, archive)
+        raise jinja2.TemplateNotFound(template)
+
+    def list_templates(self):
+        templates = set()
+        for searchpath, loader in self._loaders:
+            templates.update(loader.list_templates() if loader is not None else open_archive(searchpath).members)
+        return sorted(templates)
+
+    def template_filename(self, name):
+        """
+        Get the path of the file containing a template (the template file or archive file) - returns None if the
+        template is not found
+        """
+
+        try:
+            name_parts = jinja2.loaders.split_template_path(name)
+        except jinja2.TemplateNotFound:
+            return None
+        for searchpath, loader in self._loaders:
+            if loader is not None:
+                filename = os.path.join(searchpath, *name_parts)
+                if os.path.isfile(filename):
+                    return os.path.abspath(filename)
+            elif '/'.join(name_parts) in open_archive(searchpath).members:
+                return os.path.abspath(searchpath)
+        return None
+
+
+def _archive_uptodate(archive):
+    try:
+        return open_archive(archive.path) is archive
+    except OSError:
+        return False
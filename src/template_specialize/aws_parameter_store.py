@@ -1,13 +1,16 @@
 # Licensed under the MIT License
 # https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
 
-try:
-    import botocore.session
-    import botocore.exceptions
-except ImportError: # pragma: nocover
-    pass
+import errno
+import hashlib
+import json
+import os
+import threading
+import time
+
 import jinja2
 import jinja2.ext
+import jinja2.nodes
 
 
 class ParameterStoreExtension(jinja2.ext.Extension):
@@ -15,7 +18,16 @@ class ParameterStoreExtension(jinja2.ext.Extension):
 
     def __init__(self, environment):
         super().__init__(environment)
-        environment.extend(aws_parameter_store_client=None, aws_parameter_store_values={})
+        environment.extend(
+            aws_parameter_store_client=None,
+            aws_parameter_store_client_config={},
+            aws_parameter_store_values={},
+            aws_parameter_store_cache=None,
+            aws_parameter_store_hooks=None
+        )
+        environment.filters['aws_parameter_store'] = self._get_parameters
+        self._lock = threading.Lock()
+        self._pending = {}
 
     def parse(self, parser):
         lineno = next(parser.stream).lineno
@@ -23,19 +35,303 @@ class ParameterStoreExtension(jinja2.ext.Extension):
         parameter_value = self.call_method('_get_parameter', [name], lineno=lineno)
         return jinja2.nodes.Output([parameter_value], lineno=lineno)
 
-    def _get_parameter(self, name):
-        if name not in self.environment.aws_parameter_store_values:
+    @classmethod
+    def find_parameter_names(cls, ast):
+        """
+        Find the literal aws_parameter_store parameter names of a parsed template
+        """
 
-            # Create the ssm client as needed
-            if self.environment.aws_parameter_store_client is None:
-                session = botocore.session.get_session()
-                self.environment.aws_parameter_store_client = session.create_client('ssm')
+        for node in ast.find_all(jinja2.nodes.Call):
+            if isinstance(node.node, jinja2.nodes.ExtensionAttribute) and node.node.identifier == cls.identifier and \
+               node.node.name == '_get_parameter' and isinstance(node.args[0], jinja2.nodes.Const) and \
+               isinstance(node.args[0].value, str):
+                yield node.args[0].value
+
+    @classmethod
+    def uses_parameter_store(cls, ast):
+        """
+        Returns True if a parsed template uses the aws_parameter_store tag or filter (including filter names passed as
+        strings, e.g. "map('aws_parameter_store')")
+        """
+
+        for node in ast.find_all((jinja2.nodes.ExtensionAttribute, jinja2.nodes.Filter, jinja2.nodes.Const)):
+            if (isinstance(node, jinja2.nodes.ExtensionAttribute) and node.identifier == cls.identifier) or \
+               (isinstance(node, jinja2.nodes.Filter) and node.name == 'aws_parameter_store') or \
+               (isinstance(node, jinja2.nodes.Const) and node.value == 'aws_parameter_store'):
+                return True
+        return False
+
+    def prefetch(self, names):
+        """
+        Retrieve parameter values using batched GetParameters calls
 
+        Parameters that fail to be retrieved are left for individual retrieval (and error reporting) at render time.
+        """
+
+        values = self.environment.aws_parameter_store_values
+        cache = self.environment.aws_parameter_store_cache
+        names = [name for name in dict.fromkeys(names) if name not in values]
+
+        # Use cached values, if possible
+        if cache is not None:
+            uncached_names = []
+            for name in names:
+                cached_value = self._cache_get(cache, name)
+                if cached_value is not None:
+                    values[name] = cached_value
+                else:
+                    uncached_names.append(name)
+            names = uncached_names
+        if not names:
+            return
+
+        # Import botocore only when values are retrieved - it is slow to import
+        import botocore.exceptions # pylint: disable=import-outside-toplevel
+
+        for ix_batch in range(0, len(names), GET_PARAMETERS_MAX):
+            batch_names = names[ix_batch:ix_batch + GET_PARAMETERS_MAX]
             try:
-                result = self.environment.aws_parameter_store_client.get_parameter(Name=name, WithDecryption=True)
-                self.environment.aws_parameter_store_values[name] = result['Parameter']['Value']
+                result = self._call('get_parameters', Names=batch_names, WithDecryption=True)
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+                continue
+
+            # Match the requested names - the request name may be a parameter name, a name and selector, or an ARN
+            batch_values = {}
+            for parameter in result['Parameters']:
+                batch_values[parameter['Name']] = parameter['Value']
+                if 'Selector' in parameter:
+                    batch_values[f'{parameter["Name"]}{parameter["Selector"]}'] = parameter['Value']
+                if 'ARN' in parameter:
+                    batch_values[parameter['ARN']] = parameter['Value']
+            for name in batch_names:
+                if name in batch_values:
+                    values[name] = batch_values[name]
+                    if cache is not None:
+                        cache.set(name, batch_values[name])
+
+    def get_parameters_by_path(self, path):
+        """
+        Retrieve the parameter values under a path, recursively, as a nested dict
+
+        For example, the values of "/svc/prod/db/host" and "/svc/prod/db/port" with path "/svc/prod" are returned as
+        {"db": {"host": ..., "port": ...}}. Retrieved values are cached for use by the aws_parameter_store tag.
+        """
+
+        import botocore.exceptions # pylint: disable=import-outside-toplevel
+
+        values = self.environment.aws_parameter_store_values
+        cache = self.environment.aws_parameter_store_cache
+        path_prefix = path.rstrip('/') + '/'
+        path_values = {}
+        request_args = {'Path': path, 'Recursive': True, 'WithDecryption': True}
+        while True:
+            try:
+                result = self._call('get_parameters_by_path', **request_args)
             except botocore.exceptions.ClientError as ex:
                 code = ex.response.get('Error', {}).get('Code')
-                raise ValueError(f'Failed to retrieve value "{name}" from parameter store with error: {code}') from None
+                raise ValueError(f'Failed to retrieve path "{path}" from parameter store with error: {code}') from None
+            except botocore.exceptions.BotoCoreError as ex:
+                code = type(ex).__name__
+                raise ValueError(f'Failed to retrieve path "{path}" from parameter store with error: {code}') from None
+
+            # Add each parameter value to the nested dict
+            for parameter in result['Parameters']:
+                name = parameter['Name']
+                value = parameter['Value']
+                values[name] = value
+                if cache is not None:
+                    cache.set(name, value)
+                name_parts = [part for part in name[len(path_prefix):].split('/') if part] \
+                    if name.startswith(path_prefix) else [name.rsplit('/', 1)[-1]]
+                parent = path_values
+                for name_part in name_parts[:-1]:
+                    if not isinstance(parent.get(name_part), dict):
+                        parent[name_part] = {}
+                    parent = parent[name_part]
+                if not isinstance(parent.get(name_parts[-1]), dict):
+                    parent[name_parts[-1]] = value
+
+            # Next page?
+            next_token = result.get('NextToken')
+            if not next_token:
+                break
+            request_args['NextToken'] = next_token
+
+        return path_values
+
+    def _get_client(self):
+        # Create the ssm client as needed - botocore clients are thread-safe
+        with self._lock:
+            if self.environment.aws_parameter_store_client is None:
+                import botocore.config # pylint: disable=import-outside-toplevel
+                import botocore.session # pylint: disable=import-outside-toplevel
+
+                session = botocore.session.get_session()
+                client_config = self.environment.aws_parameter_store_client_config
+                if client_config:
+                    self.environment.aws_parameter_store_client = session.create_client(
+                        'ssm', config=botocore.config.Config(**client_config)
+                    )
+                else:
+                    self.environment.aws_parameter_store_client = session.create_client('ssm')
+            return self.environment.aws_parameter_store_client
+
+    def _call(self, method_name, **kwargs):
+        # Call a client method - throttled requests are retried by the client (see aws_parameter_store_client_config)
+        hooks = self.environment.aws_parameter_store_hooks
+        error = None
+        start_time = time.perf_counter()
+        try:
+            return getattr(self._get_client(), method_name)(**kwargs)
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            # Report the request's wait time, including retry delays
+            if hooks is not None:
+                hooks.parameter_fetch(method_name, kwargs, time.perf_counter() - start_time, error)
+
+    def _get_parameter(self, name):
+        values = self.environment.aws_parameter_store_values
+        if name in values:
+            return values[name]
+
+        # If another thread is retrieving the value, wait for it
+        with self._lock:
+            if name in values:
+                return values[name]
+            future = self._pending.get(name)
+            is_owner = future is None
+            if is_owner:
+                import concurrent.futures # pylint: disable=import-outside-toplevel
+
+                future = self._pending[name] = concurrent.futures.Future()
+        if not is_owner:
+            return future.result()
+
+        # Retrieve the value
+        try:
+            values[name] = self._get_parameter_value(name)
+            future.set_result(values[name])
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                del self._pending[name]
+
+        return values[name]
+
+    def _get_parameter_value(self, name):
+        # Cached value?
+        cache = self.environment.aws_parameter_store_cache
+        if cache is not None:
+            cached_value = self._cache_get(cache, name)
+            if cached_value is not None:
+                return cached_value
+
+        import botocore.exceptions # pylint: disable=import-outside-toplevel
+
+        try:
+            result = self._call('get_parameter', Name=name, WithDecryption=True)
+            value = result['Parameter']['Value']
+        except botocore.exceptions.ClientError as ex:
+            code = ex.response.get('Error', {}).get('Code')
+            raise ValueError(f'Failed to retrieve value "{name}" from parameter store with error: {code}') from None
+
+        if cache is not None:
+            cache.set(name, value)
+        return value
+
+    def _cache_get(self, cache, name):
+        # Get a cached value and report the cache hit or miss
+        cached_value = cache.get(name)
+        hooks = self.environment.aws_parameter_store_hooks
+        if hooks is not None:
+            hooks.parameter_cache(name, cached_value is not None)
+        return cached_value
+
+    def _get_parameters(self, names):
+        # The "aws_parameter_store" filter - retrieve a sequence of parameter values concurrently
+        import concurrent.futures # pylint: disable=import-outside-toplevel
+
+        names = list(names)
+        self.prefetch(name for name in names if isinstance(name, str))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(GET_PARAMETER_WORKERS, max(1, len(names)))) as executor:
+            return list(executor.map(self._get_parameter, names))
+
+
+class ParameterStoreCache:
+    """
+    An on-disk Parameter Store value cache that may be shared by multiple processes
+
+    Cache files are readable and writable only by the current user. Values are cached by AWS profile and region (the
+    AWS_PROFILE and AWS_REGION or AWS_DEFAULT_REGION environment variables), as well as by parameter name. If refresh is
+    True, cached values are not read but retrieved values are written.
+    """
+
+    def __init__(self, directory, ttl, refresh=False):
+        # A created cache directory is accessible only by the current user - an existing directory's mode is unchanged
+        try:
+            os.makedirs(directory, mode=0o700)
+            os.chmod(directory, 0o700)
+        except FileExistsError:
+            if not os.path.isdir(directory):
+                raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), directory) from None
+        self.directory = directory
+        self.ttl = ttl
+        self.refresh = refresh
+        self.profile = os.environ.get('AWS_PROFILE')
+        self.region = os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Get a cached parameter value - returns None if there is no unexpired cached value
+        """
+
+        value = None
+        if not self.refresh:
+            try:
+                with open(self._cache_path(name), 'r', encoding='utf-8') as f_cache:
+                    cache_entry = json.load(f_cache)
+                if cache_entry['name'] == name and time.time() < cache_entry['time'] + self.ttl:
+                    value = cache_entry['value']
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        with self._lock:
+            if value is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return value
+
+    def set(self, name, value):
+        """
+        Set a cached parameter value - cache write errors are ignored
+        """
+
+        cache_path = self._cache_path(name)
+        cache_path_tmp = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with os.fdopen(os.open(cache_path_tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w', encoding='utf-8') as f_cache:
+                json.dump({'name': name, 'value': value, 'time': time.time()}, f_cache)
+            os.replace(cache_path_tmp, cache_path)
+        except OSError:
+            pass
+        finally:
+            if os.path.exists(cache_path_tmp):
+                os.unlink(cache_path_tmp)
+
+    def _cache_path(self, name):
+        cache_key = json.dumps([self.profile, self.region, name])
+        return os.path.join(self.directory, f'{hashlib.sha256(cache_key.encode("utf-8")).hexdigest()}.json')
+
+
+# The maximum number of parameter names per GetParameters call
+GET_PARAMETERS_MAX = 10
 
-        return self.environment.aws_parameter_store_values[name]
+# The maximum number of concurrent GetParameter calls of the "aws_parameter_store" filter
+GET_PARAMETER_WORKERS = 10
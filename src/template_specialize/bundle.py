@@ -0,0 +1,150 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+"""
+template-specialize compiled template bundles
+"""
+
+import functools
+import json
+import os
+
+import jinja2
+
+from .archive import archive_format, is_archive_file, open_archive
+
+
+def compile_bundle(environment, path, template_names, files, manifest, all_templates=False):
+    """
+    Compile templates into a template bundle - a zip file of compiled template modules, the files copied verbatim, and
+    the bundle manifest
+
+    :param environment: The template environment
+    :param path: The bundle file path (a ".zip" file)
+    :param template_names: The names of the templates to compile
+    :param files: The dict of verbatim file name to content (bytes) or source file path (str)
+    :param manifest: The bundle manifest dict
+    :param all_templates: If True, all other templates that parse are compiled, as well (e.g. for dynamic includes)
+    :raises jinja2.TemplateSyntaxError: A template has a syntax error
+    :raises OSError: The bundle could not be written
+    :raises ValueError: A file name conflicts with the bundle manifest or a template is not UTF-8 text
+    """
+
+    # Import the zip module only when compiling a bundle
+    import zipfile # pylint: disable=import-outside-toplevel
+
+    if BUNDLE_MANIFEST_NAME in files:
+        raise ValueError(f'file name conflicts with the bundle manifest: {BUNDLE_MANIFEST_NAME!r}')
+
+    # Compile to a temporary file and then rename
+    path_dir = os.path.dirname(path)
+    if path_dir:
+        os.makedirs(path_dir, exist_ok=True)
+    path_tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        template_names = frozenset(template_names)
+        if all_templates:
+            filter_func = functools.partial(_is_bundle_template, environment, template_names)
+        else:
+            filter_func = template_names.__contains__
+        environment.compile_templates(path_tmp, filter_func=filter_func, zip='deflated', ignore_errors=False)
+
+        # Add the verbatim files and the manifest
+        with zipfile.ZipFile(path_tmp, 'a', compression=zipfile.ZIP_DEFLATED) as bundle:
+            for name, content in files.items():
+                if isinstance(content, str):
+                    bundle.write(content, arcname=name)
+                else:
+                    bundle.writestr(name, content)
+            bundle.writestr(BUNDLE_MANIFEST_NAME, json.dumps(
+                {'version': BUNDLE_VERSION, 'jinja2': jinja2.__version__, **manifest}, sort_keys=True, indent=4
+            ))
+        os.replace(path_tmp, path)
+    finally:
+        if os.path.exists(path_tmp):
+            os.unlink(path_tmp)
+
+
+# The bundle manifest member name and version
+BUNDLE_MANIFEST_NAME = 'template-specialize-bundle.json'
+BUNDLE_VERSION = 1
+
+
+def _is_bundle_template(environment, template_names, name):
+    # Templates other than the named templates are compiled only if they are UTF-8 text and parse
+    if name in template_names:
+        return True
+    try:
+        source, filename, _ = environment.loader.get_source(environment, name)
+        environment.parse(source, name, filename)
+    except (jinja2.TemplateError, ValueError):
+        return False
+    return True
+
+
+def is_bundle_file(path):
+    """
+    Returns True if the path is a template bundle file (a ".zip" file with a bundle manifest)
+    """
+
+    if archive_format(path) != 'zip' or not is_archive_file(path):
+        return False
+    try:
+        return BUNDLE_MANIFEST_NAME in open_archive(path).members
+    except OSError:
+        return False
+
+
+def load_bundle(path):
+    """
+    Load a template bundle's manifest
+
+    :raises OSError: The bundle could not be read
+    :raises ValueError: The bundle is invalid or was compiled by another Jinja2 version
+    """
+
+    try:
+        manifest = json.loads(open_archive(path).read(BUNDLE_MANIFEST_NAME))
+    except KeyError as exc:
+        raise ValueError(f'invalid bundle {path!r}: no manifest') from exc
+    if not isinstance(manifest, dict) or manifest.get('version') != BUNDLE_VERSION:
+        raise ValueError(f'invalid bundle {path!r}: unsupported version')
+    if manifest.get('jinja2') != jinja2.__version__:
+        raise ValueError(f'bundle {path!r} was compiled with Jinja2 {manifest.get("jinja2")}, not Jinja2 {jinja2.__version__}')
+    return manifest
+
+
+class BundleLoader(jinja2.ModuleLoader):
+    """
+    A compiled template loader for template bundles
+
+    Compiled template modules are read from the bundle's memory-mapped member index rather than imported, so loads are
+    thread-safe and templates are re-loaded when the bundle file changes.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.path = path
+
+    def load(self, environment, name, globals=None): # pylint: disable=redefined-builtin
+        archive = open_archive(self.path)
+        module_filename = self.get_module_filename(name)
+        try:
+            module_source = archive.read(module_filename)
+        except KeyError as exc:
+            raise jinja2.TemplateNotFound(name) from exc
+
+        # Execute the compiled template module
+        module_path = os.path.join(self.path, module_filename)
+        module_dict = {'__name__': f'{self.package_name}.{self.get_template_key(name)}', '__file__': module_path}
+        exec(compile(module_source, module_path, 'exec'), module_dict) # pylint: disable=exec-used
+        template = environment.template_class.from_module_dict(environment, module_dict, globals if globals is not None else {})
+        template._uptodate = functools.partial(_bundle_uptodate, archive) # pylint: disable=protected-access
+        return template
+
+
+def _bundle_uptodate(archive):
+    try:
+        return open_archive(archive.path) is archive
+    except OSError:
+        return False
@@ -0,0 +1,92 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+"""
+template-specialize on-disk compiled template cache
+"""
+
+import fnmatch
+import hashlib
+import os
+import tempfile
+import time
+
+import jinja2.bccache
+
+
+class TemplateBytecodeCache(jinja2.bccache.FileSystemBytecodeCache):
+    """
+    A Jinja2 bytecode cache that may be shared by multiple processes
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(directory, CACHE_FILE_PATTERN)
+
+    def get_bucket(self, environment, name, filename, source):
+        # Key the cache entry on the environment configuration, as well
+        environment_key = '|'.join((
+            *sorted(environment.extensions),
+            str(environment.keep_trailing_newline),
+            str(environment.trim_blocks),
+            str(environment.lstrip_blocks)
+        ))
+        return super().get_bucket(environment, name, f'{filename}|{environment_key}', source)
+
+    def get_cache_key(self, name, filename=None):
+        return hashlib.sha256(f'{name}|{filename}'.encode('utf-8')).hexdigest()
+
+    def load_bytecode(self, bucket):
+        super().load_bytecode(bucket)
+
+        # Update the cache file's modified time so that recently-used entries are evicted last
+        if bucket.code is not None:
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError: # pragma: no cover
+                pass
+
+    def dump_bytecode(self, bucket):
+        # Write to a temporary file and then rename so other processes never read a partially-written file
+        filename = self._get_cache_filename(bucket)
+        fd_tmp, filename_tmp = tempfile.mkstemp(dir=self.directory, prefix=os.path.basename(filename), suffix='.tmp')
+        try:
+            with os.fdopen(fd_tmp, 'wb') as f_tmp:
+                bucket.write_bytecode(f_tmp)
+            os.replace(filename_tmp, filename)
+        except OSError: # pragma: no cover
+            try:
+                os.unlink(filename_tmp)
+            except OSError:
+                pass
+
+    def prune(self, max_age=None, max_size=None):
+        """
+        Delete cache entries older than max_age seconds and the least-recently-used entries over max_size bytes
+        """
+
+        # Get the cache files - ignore files deleted by other processes
+        cache_files = []
+        for cache_name in fnmatch.filter(os.listdir(self.directory), CACHE_FILE_PATTERN % ('*',)):
+            cache_path = os.path.join(self.directory, cache_name)
+            try:
+                cache_stat = os.stat(cache_path)
+            except OSError: # pragma: no cover
+                continue
+            cache_files.append((cache_stat.st_mtime, cache_stat.st_size, cache_path))
+
+        # Delete the expired and least-recently-used cache files
+        cache_files.sort(reverse=True)
+        min_mtime = time.time() - max_age if max_age is not None else None
+        total_size = 0
+        for cache_mtime, cache_size, cache_path in cache_files:
+            total_size += cache_size
+            if (min_mtime is not None and cache_mtime < min_mtime) or (max_size is not None and total_size > max_size):
+                try:
+                    os.unlink(cache_path)
+                except OSError: # pragma: no cover
+                    pass
+
+
+# The bytecode cache file name pattern
+CACHE_FILE_PATTERN = 'template-specialize-%s.cache'
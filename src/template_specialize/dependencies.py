@@ -0,0 +1,213 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+"""
+template-specialize template dependency index
+"""
+
+import hashlib
+from itertools import chain
+import json
+import os
+
+import jinja2
+import jinja2.loaders
+import jinja2.meta
+
+from .archive import ArchiveLoader
+from .aws_parameter_store import ParameterStoreExtension
+
+
+class TemplateDependencyIndex:
+    """
+    An index of the templates that each template includes, imports, or extends and the variables each template reads
+
+    Each template's references, variables, literal aws_parameter_store names, and use of the aws_parameter_store tag or
+    filter are found by parsing its source - a template's variables are found only when requested. Parsed templates are
+    re-used until the template file's modified time changes and its source hash differs. If cache_dir is provided, the
+    index is loaded from and saved to a file in the directory. Otherwise, if path is provided, the index is loaded from
+    and saved to the file path - the index is re-used only by template environments with the same search paths and
+    extensions.
+    """
+
+    def __init__(self, environment, cache_dir=None, path=None):
+        self.environment = environment
+        self.path = None
+        self._templates = {}
+        self._changed = False
+
+        # Load the index file, if any
+        self._key = '|'.join((
+            *(os.path.abspath(searchpath) for searchpath in getattr(environment.loader, 'searchpath', ())),
+            *sorted(environment.extensions)
+        ))
+        if cache_dir is not None:
+            index_hash = hashlib.sha256(self._key.encode('utf-8')).hexdigest()
+            self.path = os.path.join(cache_dir, INDEX_FILE_PATTERN % (index_hash,))
+        elif path is not None:
+            self.path = path
+        if self.path is not None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f_index:
+                    index = json.load(f_index)
+                if isinstance(index, dict) and index.get('version') == INDEX_VERSION and index.get('key') == self._key:
+                    self._templates = index['templates']
+            except (OSError, ValueError):
+                pass
+
+    def references(self, name):
+        """
+        Get the names of the templates that a template directly includes, imports, or extends. Dynamic references (e.g.
+        includes of a variable) are None.
+
+        :raises jinja2.TemplateError: The template was not found or has a syntax error
+        """
+
+        return self._template(name)['references']
+
+    def dependencies(self, name):
+        """
+        Get the set of names of a template and all templates it includes, imports, or extends, transitively. Returns
+        None if the template's dependencies cannot be determined (e.g. dynamic includes or template errors).
+        """
+
+        return self._dependencies(name)
+
+    def variables(self, name):
+        """
+        Get the set of undeclared (top-level) variables read by a template and all templates it includes, imports, or
+        extends. Returns None if the template's dependencies cannot be determined.
+        """
+
+        dependencies = self._dependencies(name, True)
+        if dependencies is None:
+            return None
+        return set(chain.from_iterable(self._template(template_name, True)['variables'] for template_name in dependencies))
+
+    def parameter_names(self, name):
+        """
+        Get the literal aws_parameter_store names of a template (not including the templates it references)
+
+        :raises jinja2.TemplateError: The template was not found or has a syntax error
+        """
+
+        return self._template(name)['parameter_names']
+
+    def uses_parameter_store(self, name):
+        """
+        Returns True if a template or any template it includes, imports, or extends uses the aws_parameter_store tag or
+        filter. Returns None if the template's dependencies cannot be determined.
+        """
+
+        dependencies = self.dependencies(name)
+        if dependencies is None:
+            return None
+        return any(self._template(template_name)['parameter_store'] for template_name in dependencies)
+
+    def template_hash(self, name):
+        """
+        Get the hash of the sources of a template and all templates it includes, imports, or extends. Returns None if
+        the template's dependencies cannot be determined.
+        """
+
+        dependencies = self.dependencies(name)
+        if dependencies is None:
+            return None
+        template_hash = hashlib.sha256()
+        for template_name in sorted(dependencies):
+            template_hash.update(f'{template_name}\0{self._template(template_name)["hash"]}\0'.encode('utf-8'))
+        return template_hash.hexdigest()
+
+    def save(self):
+        """
+        Save the index file, if the index has changed
+        """
+
+        if self.path is None or not self._changed:
+            return
+        path_tmp = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(path_tmp, 'w', encoding='utf-8') as f_index:
+                json.dump({'version': INDEX_VERSION, 'key': self._key, 'templates': self._templates}, f_index, sort_keys=True)
+            os.replace(path_tmp, self.path)
+            self._changed = False
+        except OSError: # pragma: no cover
+            if os.path.exists(path_tmp):
+                os.unlink(path_tmp)
+
+    def _dependencies(self, name, variables=False):
+        # Get a template's dependencies - if variables is True, the variables of each dependency are found, as well
+        dependencies = set()
+        pending = [name]
+        while pending:
+            template_name = pending.pop()
+            if template_name in dependencies:
+                continue
+            dependencies.add(template_name)
+            try:
+                references = self._template(template_name, variables)['references']
+            except jinja2.TemplateError:
+                return None
+            if None in references:
+                return None
+            pending.extend(references)
+        return dependencies
+
+    def _template(self, name, variables=False):
+        # Get the template's file modified time, if possible
+        filename = self._template_filename(name)
+        mtime = None
+        if filename is not None:
+            try:
+                mtime = os.stat(filename).st_mtime_ns
+            except OSError: # pragma: no cover
+                filename = None
+
+        # Template file unchanged?
+        template = self._templates.get(name)
+        if template is not None and mtime is not None and template['filename'] == filename and template['mtime'] == mtime and \
+           (not variables or 'variables' in template):
+            return template
+
+        # Template source unchanged? If not, parse the template to find its references (and variables, if requested).
+        # Finding a template's variables costs about as much as parsing it, so they are found only when needed.
+        source = self.environment.loader.get_source(self.environment, name)[0]
+        source_hash = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        if template is None or template['hash'] != source_hash or (variables and 'variables' not in template):
+            ast = self.environment.parse(source, name, filename)
+            template = {
+                'hash': source_hash,
+                'references': list(jinja2.meta.find_referenced_templates(ast)),
+                'parameter_names': list(ParameterStoreExtension.find_parameter_names(ast)),
+                'parameter_store': ParameterStoreExtension.uses_parameter_store(ast)
+            }
+            if variables:
+                template['variables'] = sorted(jinja2.meta.find_undeclared_variables(ast))
+        template = {**template, 'filename': filename, 'mtime': mtime}
+        if template != self._templates.get(name):
+            self._templates[name] = template
+            self._changed = True
+        return template
+
+    def _template_filename(self, name):
+        # Only file system loader template file names can be determined without loading the template - archive
+        # templates are identified by their archive file
+        loader = self.environment.loader
+        if isinstance(loader, ArchiveLoader):
+            return loader.template_filename(name)
+        if not isinstance(loader, jinja2.FileSystemLoader):
+            return None
+        try:
+            name_parts = jinja2.loaders.split_template_path(name)
+        except jinja2.TemplateNotFound:
+            return None
+        for searchpath in loader.searchpath:
+            filename = os.path.join(searchpath, *name_parts)
+            if os.path.isfile(filename):
+                return os.path.abspath(filename)
+        return None
+
+
+# The dependency index file name pattern and version
+INDEX_FILE_PATTERN = 'template-specialize-deps-%s.json'
+INDEX_VERSION = 4
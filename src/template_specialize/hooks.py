@@ -0,0 +1,73 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+"""
+template-specialize instrumentation hooks
+"""
+
+
+class SpecializerHooks:
+    """
+    Instrumentation hooks base class - override the methods of interest to collect metrics or traces
+
+    Hooks may be called concurrently from multiple threads (e.g. when rendering with multiple jobs).
+    """
+
+    def before_template(self, name):
+        """
+        Called before a template file is loaded and rendered
+
+        :param name: The template name
+        """
+
+    def after_template(self, name, seconds, error):
+        """
+        Called after a template file is rendered (or fails to render)
+
+        :param name: The template name
+        :param seconds: The wall time of the template's load, compile, render, and write
+        :param error: The exception, if the template failed to render, otherwise None
+        """
+
+    def cache_hit(self, name, seconds):
+        """
+        Called when a template (or an included template) is loaded without being compiled
+
+        :param name: The template name
+        :param seconds: The template load's wall time
+        """
+
+    def cache_miss(self, name, seconds, compile_seconds):
+        """
+        Called when a template (or an included template) is loaded and compiled
+
+        :param name: The template name
+        :param seconds: The template load's wall time, including the compile
+        :param compile_seconds: The template compile's wall time
+        """
+
+    def parameter_fetch(self, method_name, request, seconds, error):
+        """
+        Called after an AWS Parameter Store request, including any throttling retries
+
+        :param method_name: The botocore SSM client method name (e.g. "get_parameters")
+        :param request: The request's keyword arguments
+        :param seconds: The request's wall time, including retry delays
+        :param error: The exception, if the request failed, otherwise None
+        """
+
+    def parameter_cache(self, name, hit):
+        """
+        Called after an AWS Parameter Store value cache (--aws-cache) lookup
+
+        :param name: The parameter name
+        :param hit: True if an unexpired cached value was found, otherwise False
+        """
+
+    def rename_applied(self, path, name):
+        """
+        Called after a template_specialize_rename operation is applied
+
+        :param path: The renamed (or deleted) path, relative to the destination directory
+        :param name: The new name, or None if the path was deleted
+        """
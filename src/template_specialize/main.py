@@ -6,24 +6,43 @@ template-specialize command-line script main module
 """
 
 import argparse
+import contextlib
+import contextvars
 import datetime
+import errno
+import fnmatch
+import functools
+import hashlib
+import heapq
+import io
 from itertools import chain
 import json
 import os
-import pathlib
+import posixpath
 import re
 import shutil
 import sys
+import threading
+import time
 
 import jinja2
 import jinja2.ext
+import jinja2.meta
 
-from .aws_parameter_store import ParameterStoreExtension
+from .archive import ARCHIVE_STDOUT, ArchiveLoader, archive_format, is_archive_file, open_archive, rename_member, write_archive
+from .aws_parameter_store import ParameterStoreCache, ParameterStoreExtension
+from .bundle import BundleLoader, compile_bundle, is_bundle_file, load_bundle
+from .bytecode_cache import TemplateBytecodeCache
+from .dependencies import TemplateDependencyIndex
+from .timings import Timings
 
 
-def main(argv=None):
+def main(argv=None, state=None):
     """
     template-specialize command-line script main entry point
+
+    :param state: The render daemon's state dict - template environments and parsed environment files are re-used by
+        requests with the same options
     """
 
     # Command line arguments
@@ -31,134 +50,1610 @@ def main(argv=None):
     if sys.version_info >= (3, 14): # pragma: no cover
         argument_parser_args['color'] = False
     parser = argparse.ArgumentParser(**argument_parser_args)
-    parser.add_argument('src_path', metavar='SRC',
-                        help='the source template file or directory')
-    parser.add_argument('dst_path', metavar='DST',
-                        help='the destination file or directory')
+    parser.add_argument('src_path', metavar='SRC', nargs='?',
+                        help='the source template file, directory, archive (.tar, .tar.gz, .tgz, or .zip), or bundle')
+    parser.add_argument('dst_path', metavar='DST', nargs='?',
+                        help='the destination file, directory, or archive (.tar, .tar.gz, .tgz, .zip, or "-" for stdout)')
     parser.add_argument('-i', dest='searchpaths', metavar='PATH', action='append', default=[],
-                        help='add an include search path')
+                        help='add an include search path (a directory or archive)')
     parser.add_argument('-c', dest='environment_files', metavar='FILE', action='append',
                         help='the environment files')
-    parser.add_argument('-e', dest='environment', metavar='ENV',
-                        help='the environment name')
+    parser.add_argument('-e', dest='environments', metavar='ENV', action='append',
+                        help='the environment name or glob pattern - DST may contain "{env}"')
     parser.add_argument('-k', '--key', action='append', nargs=2, dest='keys', metavar=('KEY', 'VALUE'), default=[],
                         help='add a template key and value')
+    parser.add_argument('--exclude', action='append', dest='exclude_patterns', metavar='PATTERN', default=[],
+                        help='exclude source files and directories matching a glob pattern (e.g. "node_modules")')
+    parser.add_argument('--include', action='append', dest='include_patterns', metavar='PATTERN', default=[],
+                        help='include source files and directories matching a glob pattern, even if excluded')
+    parser.add_argument('--copy', action='append', dest='copy_patterns', metavar='PATTERN', default=[],
+                        help='copy files matching a glob pattern verbatim (e.g. "*.png")')
+    parser.add_argument('--no-copy', action='append', dest='no_copy_patterns', metavar='PATTERN', default=[],
+                        help='render files matching a glob pattern, even if they match a --copy pattern')
     parser.add_argument('--dump', action='store_true',
                         help='dump the template variables')
+    parser.add_argument('--deps', action='store_true',
+                        help='dump the templates included, imported, or extended by each template')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N', default=1,
+                        help='render template files using N threads (default is 1)')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the source templates into a template bundle (.zip) at DST')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only render template directory files whose inputs changed since the last run')
+    parser.add_argument('--shard', metavar='I/N',
+                        help='render only shard I of N of the template directory files, exporting its rename operations')
+    parser.add_argument('--merge-shards', metavar='DIR',
+                        help="apply the rename operations exported by each shard's render of DIR")
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='cache compiled templates in a directory')
+    parser.add_argument('--cache-max-age', type=float, metavar='DAYS', default=30,
+                        help='delete cached compiled templates unused for DAYS days (default is 30)')
+    parser.add_argument('--cache-max-size', type=float, metavar='MB', default=100,
+                        help='limit the compiled template cache to MB megabytes (default is 100)')
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help="don't write destination files whose content is unchanged")
+    parser.add_argument('--aws-cache', metavar='DIR',
+                        help='cache AWS Parameter Store values in a directory')
+    parser.add_argument('--aws-cache-ttl', type=float, metavar='SECONDS', default=300,
+                        help='the AWS Parameter Store cache time-to-live (default is 300)')
+    parser.add_argument('--aws-cache-refresh', action='store_true',
+                        help="don't read cached AWS Parameter Store values")
+    parser.add_argument('--aws-path', action='append', nargs=2, dest='aws_paths', metavar=('KEY', 'PATH'), default=[],
+                        help='add a template key with the AWS Parameter Store values of a path')
+    parser.add_argument('--aws-retries', type=int, metavar='N', default=4,
+                        help='the maximum AWS Parameter Store throttling retries (default is 4)')
+    parser.add_argument('--aws-max-pool-connections', type=int, metavar='N',
+                        help='the maximum AWS Parameter Store client connections')
+    parser.add_argument('--aws-connect-timeout', type=float, metavar='SECONDS',
+                        help='the AWS Parameter Store client connect timeout')
+    parser.add_argument('--aws-read-timeout', type=float, metavar='SECONDS',
+                        help='the AWS Parameter Store client read timeout')
+    parser.add_argument('--watch', action='store_true',
+                        help='watch for changes and re-render the affected templates')
+    parser.add_argument('--watch-interval', type=float, metavar='SECONDS', default=1,
+                        help='the watch polling interval (default is 1)')
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help='serve requests from template-specialize-client on a Unix socket')
+    parser.add_argument('--timings', action='store_true',
+                        help='report the wall time of each phase and template')
+    parser.add_argument('--timings-json', metavar='FILE',
+                        help='write the timings report as JSON')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write the run\'s cProfile statistics')
     args = parser.parse_args(args=argv)
+    if args.serve is not None:
+        if state is not None:
+            parser.error('argument --serve: not allowed in a daemon request')
+        if args.src_path is not None:
+            parser.error('argument --serve: not allowed with SRC and DST')
+    elif args.merge_shards is not None:
+        if args.src_path is not None:
+            parser.error('argument --merge-shards: not allowed with SRC and DST')
+    elif args.src_path is None:
+        parser.error(f'the following arguments are required: {"SRC" if args.deps else "SRC, DST"}')
+    elif args.dst_path is None and not args.deps:
+        parser.error('the following arguments are required: DST')
+    if state is not None and args.watch:
+        parser.error('argument --watch: not allowed in a daemon request')
+    if args.dst_path is not None and args.compile:
+        if archive_format(args.dst_path) != 'zip' or args.dst_path == ARCHIVE_STDOUT:
+            parser.error('argument --compile: DST must be a .zip file')
+        for option, value in (('--incremental', args.incremental), ('--skip-unchanged', args.skip_unchanged), ('--watch', args.watch)):
+            if value:
+                parser.error(f'argument {option}: not allowed with --compile')
+    if args.shard is not None:
+        shard_match = RE_SHARD.fullmatch(args.shard)
+        if shard_match is None or not 1 <= int(shard_match[1]) <= int(shard_match[2]):
+            parser.error(f'argument --shard: invalid shard: {args.shard!r}')
+        args.shard = (int(shard_match[1]), int(shard_match[2]))
+        for option, value in (('--compile', args.compile), ('--incremental', args.incremental), ('--watch', args.watch)):
+            if value:
+                parser.error(f'argument {option}: not allowed with --shard')
+    if args.jobs < 1:
+        parser.error(f'argument -j/--jobs: invalid job count: {args.jobs}')
+    if args.aws_retries < 0:
+        parser.error(f'argument --aws-retries: invalid retry count: {args.aws_retries}')
+
+    # Profile the run, if necessary
+    if args.profile is not None:
+        import cProfile # pylint: disable=import-outside-toplevel
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(_main, parser, args, state)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        _main(parser, args, state)
+
+
+def _main(parser, args, state):
+    timings = Timings()
+
+    # Serve render daemon requests, if necessary
+    if args.serve is not None:
+        from .serve import serve # pylint: disable=import-outside-toplevel
+
+        try:
+            serve(args.serve, functools.partial(_serve_request, {}))
+        except OSError as exc:
+            parser.exit(message=f'{exc}\n', status=2)
+        return
+
+    # Apply the shards' rename operations, if necessary
+    if args.merge_shards is not None:
+        try:
+            with timings.time('merge shards'):
+                _merge_shards(args.merge_shards)
+        except (OSError, ValueError) as exc:
+            parser.exit(message=f'{exc}\n', status=2)
+        _report_timings(parser, args, timings)
+        return
 
     # Parse the environment files
     environments = {}
     if args.environment_files:
-        for environment_file in args.environment_files:
-            try:
-                with open(environment_file, 'r', encoding='utf-8') as f_environment:
-                    _parse_environments(f_environment.read(), environments)
-            except ValueError as exc:
-                parser.exit(message=f'{exc}\n', status=2)
-
-    # Build the template variables dict
-    template_variables = {
-        'now': datetime.datetime.now()
-    }
+        try:
+            with timings.time('parse environments'):
+                environments = _load_environments(args.environment_files, state)
+        except ValueError as exc:
+            parser.exit(message=f'{exc}\n', status=2)
+
+    # Get the environment names
+    environment_names = []
+    if args.environments is not None:
+        try:
+            for environment_pattern in args.environments:
+                environment_names.extend(_match_environments(environments, environment_pattern))
+        except ValueError as exc:
+            parser.exit(message=f'{exc}\n', status=2)
+        environment_names = list(dict.fromkeys(environment_names))
+    if len(environment_names) > 1 and not args.dump and not args.deps and ENVIRONMENT_PATTERN not in args.dst_path:
+        parser.exit(message=f'multiple environments require a destination path containing {ENVIRONMENT_PATTERN!r}\n',
+                    status=2)
+
+    # Get the source template directory - template archives are template directories
+    is_dir = os.path.isdir(args.src_path) or is_archive_file(args.src_path)
+    if is_dir:
+        src_dir = args.src_path
+    else:
+        src_dir = os.path.dirname(args.src_path)
+    if args.compile and not is_dir:
+        parser.exit(message='a template bundle requires a template directory\n', status=2)
+    if args.shard is not None and not is_dir:
+        parser.exit(message='--shard requires a template directory\n', status=2)
+
+    # Archive destination? Only template directories are rendered to archives - a template file is rendered to the
+    # destination path as-is. The "--deps" argument doesn't require a destination path.
+    dst_archive_format = archive_format(args.dst_path) if is_dir and args.dst_path is not None and not args.compile else None
+    if dst_archive_format is not None:
+        if state is not None and args.dst_path == ARCHIVE_STDOUT:
+            parser.error(f'argument DST: {ARCHIVE_STDOUT!r} not allowed in a daemon request')
+        for option, value in (
+            ('--incremental', args.incremental), ('--skip-unchanged', args.skip_unchanged), ('--watch', args.watch),
+            ('--shard', args.shard)
+        ):
+            if value:
+                parser.error(f'argument {option}: not allowed with an archive destination')
+
+    # Template bundle source? If so, the source files are read from the bundle manifest.
+    bundle_manifest = None
+    if is_dir and is_bundle_file(args.src_path):
+        for option, value in (
+            ('-i', args.searchpaths), ('--exclude', args.exclude_patterns), ('--include', args.include_patterns),
+            ('--copy', args.copy_patterns), ('--no-copy', args.no_copy_patterns), ('--compile', args.compile),
+            ('--deps', args.deps), ('--incremental', args.incremental), ('--watch', args.watch)
+        ):
+            if value:
+                parser.error(f'argument {option}: not allowed with a template bundle source')
+        try:
+            bundle_manifest = load_bundle(args.src_path)
+        except (OSError, ValueError) as exc:
+            parser.exit(message=f'{exc}\n', status=2)
+
+    # Incremental mode without a compiled template cache? If so, the template dependency index is saved with the (first
+    # environment's) incremental manifest. Render daemon requests re-use the daemon's index.
+    index_path = None
+    if args.incremental and args.cache_dir is None and is_dir and state is None and args.dst_path is not None:
+        index_path = os.path.join(_environment_dst_path(args.dst_path, next(iter(environment_names), None)), INDEX_NAME)
+
+    # Create the template environment
     try:
-        if args.environment is not None:
-            _merge_environment(environments, args.environment, template_variables, set())
-        for key, value in args.keys:
-            try:
-                value_json = json.loads(value)
-            except ValueError:
-                value_json = value
-            _merge_values({key: value_json}, template_variables)
+        with timings.time('create environment'):
+            environment, bytecode_cache, dependency_index = _create_environment(args, src_dir, is_dir, state, index_path)
+    except OSError as exc:
+        parser.exit(message=f'{exc}\n', status=2)
+    environment.template_specialize_hooks = timings
+    environment.aws_parameter_store_hooks = timings
+
+    # Load Parameter Store path values
+    aws_path_values = []
+    for key, path in args.aws_paths:
+        try:
+            with timings.time('parameter store path', path):
+                aws_path_values.append((key, environment.extensions[ParameterStoreExtension.identifier].get_parameters_by_path(path)))
+        except ValueError as exc:
+            parser.exit(message=f'{exc}\n', status=2)
+
+    # Build the template variables dict for each environment
+    try:
+        with timings.time('merge'):
+            environments_variables = _environments_variables(environments, environment_names, aws_path_values, args.keys)
     except Exception as exc:
         parser.exit(message=f'{exc}\n', status=2)
 
     # Dump the template variables, if necessary
     if args.dump:
         encoder = JSONEncoder(sort_keys=True, indent=4)
-        parser.exit(message=f'{encoder.encode(template_variables)}\n')
+        if len(environments_variables) == 1:
+            parser.exit(message=f'{encoder.encode(environments_variables[0][1])}\n')
+        parser.exit(message=f'{encoder.encode(dict(environments_variables))}\n')
 
     # Get the source template file paths
-    is_dir = os.path.isdir(args.src_path)
-    if is_dir:
-        src_dir = args.src_path
-        src_files = list(
-            os.path.relpath(src_file, src_dir) for src_file in
-            chain.from_iterable((os.path.join(root, file_) for file_ in files) for root, _, files in os.walk(args.src_path))
-        )
+    try:
+        with timings.time('walk'):
+            if bundle_manifest is not None:
+                src_files, copy_files, bundle_rename_files = _bundle_files(bundle_manifest)
+            else:
+                exclude_patterns, include_patterns = \
+                    _walk_patterns(args.src_path, is_dir, args.exclude_patterns, args.include_patterns)
+                src_files = _src_files(args.src_path, is_dir, exclude_patterns, include_patterns)
+                copy_files = _copy_files(src_files, args.copy_patterns, args.no_copy_patterns)
+
+            # Render only the shard's source files, if necessary
+            if args.shard is not None:
+                src_files = _shard_files(
+                    src_files, _src_file_sizes(args.src_path, src_files, copy_files, bundle_manifest), *args.shard
+                )
+    except (OSError, ValueError) as exc:
+        parser.exit(message=f'{exc}\n', status=2)
+
+    # Dump the template dependencies, if necessary
+    if args.deps:
+        template_dependencies = {}
+        for src_file in src_files:
+            dependencies = _template_dependencies(dependency_index, src_file, copy_files)
+            template_dependencies[_posix_path(src_file)] = \
+                sorted(dependencies - {_posix_path(src_file)}) if dependencies is not None else None
+        dependency_index.save()
+        parser.exit(message=f'{JSONEncoder(sort_keys=True, indent=4).encode(template_dependencies)}\n')
+
+    # Compute the template input hashes and variable names for incremental mode
+    template_inputs = None
+    if args.incremental:
+        if not is_dir:
+            parser.exit(message='--incremental requires a template directory\n', status=2)
+        with timings.time('dependencies'):
+            template_inputs = {src_file: _template_inputs(dependency_index, src_file, copy_files) for src_file in src_files}
+
+    # Scan the templates for literal Parameter Store names and rename tags - template bundles are scanned when compiled.
+    # Template files that incremental mode skips in every environment are not scanned.
+    with timings.time('scan'):
+        if bundle_manifest is not None:
+            parameter_store_names, template_scan = bundle_manifest['parameter_store_names'], None
+        else:
+            scan_files = [src_file for src_file in src_files if src_file not in copy_files]
+            if template_inputs is not None:
+                unchanged_files = set.intersection(*(
+                    set(_incremental_files(
+                        _environment_dst_path(args.dst_path, environment_name), src_files, template_variables, template_inputs
+                    )[2])
+                    for environment_name, template_variables in environments_variables
+                ))
+                scan_files = [src_file for src_file in scan_files if src_file not in unchanged_files]
+            parameter_store_names, template_scan = \
+                _scan_templates(dependency_index, [_posix_path(src_file) for src_file in scan_files])
+
+    # Compile the templates into a template bundle, if necessary
+    if args.compile:
+        try:
+            with timings.time('compile bundle'):
+                _compile_bundle(environment, src_dir, src_files, copy_files, parameter_store_names, template_scan, args.dst_path)
+        except jinja2.TemplateSyntaxError as exc:
+            parser.exit(message=_template_error_message(exc, src_dir, exc.name), status=2)
+        except (OSError, ValueError) as exc:
+            parser.exit(message=f'{exc}\n', status=2)
+        _report_timings(parser, args, timings)
+        return
+
+    # Retrieve the templates' literal Parameter Store values using batched requests
+    with timings.time('parameter store prefetch'):
+        if parameter_store_names:
+            environment.extensions[ParameterStoreExtension.identifier].prefetch(parameter_store_names)
+
+    # Find the template files that may rename or delete files - they are rendered before any file is written. Shards
+    # export their rename operations rather than applying them.
+    if args.shard is not None:
+        rename_files = frozenset()
+    elif bundle_manifest is not None:
+        rename_files = bundle_rename_files
     else:
-        src_dir = os.path.dirname(args.src_path)
-        src_files = [os.path.basename(args.src_path)]
+        rename_files = _rename_files(template_scan, src_files, copy_files) if is_dir else None
+
+    # Render the templates for each environment
+    environments_file_renames = {}
+    for environment_name, template_variables in environments_variables:
+        try:
+            with timings.time('render environment', environment_name):
+                dst_path = _environment_dst_path(args.dst_path, environment_name)
+                environments_file_renames[environment_name] = _render_environment(
+                    environment, src_dir, src_files, dst_path, template_variables, is_dir, {}, args.jobs, args.skip_unchanged,
+                    template_inputs, copy_files, dst_archive_format, rename_files, apply_renames=args.shard is None
+                )
+                if args.shard is not None:
+                    _write_shard_renames(dst_path, *args.shard, environments_file_renames[environment_name])
+        except ValueError as exc:
+            parser.exit(message=str(exc), status=2)
+        except OSError as exc:
+            parser.exit(message=f'{exc}\n', status=2)
+
+    # Save the template dependency index and evict expired compiled template cache entries
+    with timings.time('save caches'):
+        dependency_index.save()
+        if bytecode_cache is not None:
+            bytecode_cache.prune(max_age=args.cache_max_age * 86400, max_size=int(args.cache_max_size * 1024 * 1024))
+
+    # Report the timings, if necessary
+    _report_timings(parser, args, timings)
+
+    # Watch mode? If so, re-render the templates affected by each change until interrupted
+    if args.watch:
+        _watch(
+            args, environment, dependency_index, src_dir, is_dir, aws_path_values, environment_names, environments_variables,
+            environments_file_renames, src_files, copy_files, template_inputs, template_scan, rename_files
+        )
+
+
+def _watch(args, environment, dependency_index, src_dir, is_dir, aws_path_values, environment_names, environments_variables,
+           environments_file_renames, src_files, copy_files, template_inputs, template_scan, rename_files):
+    # Poll the template search paths and environment files for changes and re-render the affected templates of each
+    # environment until interrupted. Render errors are reported and watching continues. Excluded directories are watched,
+    # too, since their templates may be included.
+    template_dependencies = {src_file: _template_dependencies(dependency_index, src_file, copy_files) for src_file in src_files}
+    template_variable_names = {src_file: _template_variables(dependency_index, src_file, copy_files) for src_file in src_files}
+    dependency_index.save()
+    watch_paths = [*environment.loader.searchpath, *(args.environment_files or [])]
+    watch_snapshot = _watch_snapshot(watch_paths)
+    try:
+        while True:
+            time.sleep(args.watch_interval)
+
+            # Any changes?
+            watch_snapshot_prev = watch_snapshot
+            watch_snapshot = _watch_snapshot(watch_paths)
+            changed_paths = {
+                path for path in chain(watch_snapshot_prev, watch_snapshot)
+                if watch_snapshot_prev.get(path) != watch_snapshot.get(path)
+            }
+            if not changed_paths:
+                continue
+
+            try:
+                # Environment file changed? If so, re-parse the environment files and re-build the template variables.
+                changed_variables = {}
+                if args.environment_files and any(path in changed_paths for path in args.environment_files):
+                    environments = _load_environments(args.environment_files)
+                    if args.environments is not None:
+                        environment_names = list(dict.fromkeys(chain.from_iterable(
+                            _match_environments(environments, environment_pattern) for environment_pattern in args.environments
+                        )))
+                    environments_variables_prev = dict(environments_variables)
+                    environments_variables = _environments_variables(environments, environment_names, aws_path_values, args.keys)
+                    changed_variables = {
+                        environment_name: _changed_variables(environments_variables_prev.get(environment_name), template_variables)
+                        for environment_name, template_variables in environments_variables
+                    }
+
+                # Determine the source template files affected by the changed templates - all template files are
+                # affected by a changed template archive
+                changed_names = set()
+                changed_archive = False
+                for path in changed_paths:
+                    if path in environment.loader.searchpath and archive_format(path) is not None:
+                        changed_archive = True
+                    for searchpath in environment.loader.searchpath:
+                        path_rel = os.path.relpath(path, searchpath or '.')
+                        if not path_rel.startswith(os.pardir):
+                            changed_names.add(_posix_path(path_rel))
+                exclude_patterns, include_patterns = \
+                    _walk_patterns(args.src_path, is_dir, args.exclude_patterns, args.include_patterns)
+                src_files = _src_files(args.src_path, is_dir, exclude_patterns, include_patterns)
+                copy_files = _copy_files(src_files, args.copy_patterns, args.no_copy_patterns)
+                affected_files = [
+                    src_file for src_file in src_files
+                    if changed_archive or src_file not in template_dependencies or template_dependencies[src_file] is None or
+                    not template_dependencies[src_file].isdisjoint(changed_names)
+                ]
+                template_dependencies = {src_file: template_dependencies.get(src_file) for src_file in src_files}
+                template_variable_names = {src_file: template_variable_names.get(src_file) for src_file in src_files}
+                for src_file in affected_files:
+                    template_dependencies[src_file] = _template_dependencies(dependency_index, src_file, copy_files)
+                    template_variable_names[src_file] = _template_variables(dependency_index, src_file, copy_files)
+                    if template_inputs is not None:
+                        template_inputs[src_file] = _template_inputs(dependency_index, src_file, copy_files)
+                dependency_index.save()
+
+                # Retrieve the affected templates' literal Parameter Store values and find the template files that may
+                # rename or delete files
+                parameter_store_names, affected_template_scan = _scan_templates(
+                    dependency_index, [_posix_path(src_file) for src_file in affected_files if src_file not in copy_files]
+                )
+                template_scan.update(affected_template_scan)
+                if is_dir:
+                    rename_files = _rename_files(template_scan, src_files, copy_files)
+                if parameter_store_names:
+                    environment.extensions[ParameterStoreExtension.identifier].prefetch(parameter_store_names)
+
+                # Re-render the affected templates (and the templates that read changed variables) for each environment
+                for environment_name, template_variables in environments_variables:
+                    environment_changed_variables = changed_variables.get(environment_name, set())
+                    environment_affected_files = set(affected_files)
+                    if environment_changed_variables is None:
+                        environment_affected_files.update(src_files)
+                    elif environment_changed_variables:
+                        environment_affected_files.update(
+                            src_file for src_file in src_files
+                            if template_variable_names[src_file] is None or
+                            not template_variable_names[src_file].isdisjoint(environment_changed_variables)
+                        )
+                    if not environment_affected_files:
+                        continue
+                    file_renames = dict(environments_file_renames.get(environment_name) or {})
+                    for src_file in environment_affected_files:
+                        file_renames.pop(src_file, None)
+                    # Forget the environment's renames until it renders - after a render error, the next change re-renders
+                    # all of the environment's files
+                    environments_file_renames[environment_name] = None
+                    environments_file_renames[environment_name] = _render_environment(
+                        environment, src_dir, src_files, _environment_dst_path(args.dst_path, environment_name),
+                        template_variables, is_dir, file_renames, args.jobs, args.skip_unchanged, template_inputs, copy_files,
+                        rename_files=rename_files
+                    )
+            except Exception as exc:
+                # Report the error and continue watching
+                message = str(exc)
+                sys.stderr.write(message if message.endswith('\n') else f'{message}\n')
+                sys.stderr.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+class Specializer:
+    """
+    Render a template file or directory using a re-usable template environment
+
+    :param src_path: The source template file or directory
+    :param environment: The template environment, created by create_environment - if None, a template environment is
+        created. A template environment may be shared by Specializers with the same source template directory that do
+        not render concurrently.
+    :param environments: The parsed environments dict, loaded by load_environments
+    :param searchpaths: The include search paths - used only when creating the template environment
+    :param hooks: The SpecializerHooks instrumentation object, if any
+    :param jobs: The number of template file render threads
+    :param exclude_patterns: The glob patterns of source files and directories to exclude
+    :param include_patterns: The glob patterns of source files and directories to include, even if excluded
+    :param copy_patterns: The glob patterns of source files to copy verbatim
+    :param no_copy_patterns: The glob patterns of source files to render, even if they match a copy pattern
+    """
+
+    def __init__(self, src_path, environment=None, environments=None, searchpaths=(), hooks=None, jobs=1,
+                 exclude_patterns=(), include_patterns=(), copy_patterns=(), no_copy_patterns=()):
+        self.src_path = src_path
+        self.is_dir = os.path.isdir(src_path) or is_archive_file(src_path)
+        self.src_dir = src_path if self.is_dir else os.path.dirname(src_path)
+        if environment is None:
+            environment = self.create_environment([self.src_dir, *searchpaths], rename=self.is_dir)
+        self.environment = environment
+        self.dependency_index = TemplateDependencyIndex(environment)
+        self.environments = environments if environments is not None else {}
+        self.hooks = hooks
+        self.jobs = jobs
+        self.exclude_patterns = exclude_patterns
+        self.include_patterns = include_patterns
+        self.copy_patterns = copy_patterns
+        self.no_copy_patterns = no_copy_patterns
+
+    @staticmethod
+    def create_environment(searchpaths, rename=True, cache_dir=None, aws_cache=None, aws_cache_ttl=300, aws_cache_refresh=False):
+        """
+        Create a template environment
+
+        :param searchpaths: The template search paths (directories or archives) - the source template directory (or
+            bundle) must be first
+        :param rename: If True, the template_specialize_rename tag is available (only for template directories)
+        :param cache_dir: The compiled template cache directory, if any
+        :param aws_cache: The AWS Parameter Store value cache directory, if any
+        :param aws_cache_ttl: The AWS Parameter Store value cache time-to-live, in seconds
+        :param aws_cache_refresh: If True, cached AWS Parameter Store values are not read
+        """
+
+        # Template extensions
+        extensions = [ParameterStoreExtension]
+        if rename:
+            extensions.append(TemplateSpecializeRenameExtension)
+
+        # Create the compiled template cache, if necessary
+        bytecode_cache = None
+        if cache_dir is not None:
+            bytecode_cache = TemplateBytecodeCache(cache_dir)
+
+        # Create the template environment - template archive search paths are loaded from their member index and
+        # template bundles are loaded from their compiled template modules
+        if is_bundle_file(searchpaths[0]):
+            loader = BundleLoader(searchpaths[0])
+        elif any(is_archive_file(searchpath) for searchpath in searchpaths):
+            loader = ArchiveLoader(searchpaths, encoding='utf-8')
+        else:
+            loader = jinja2.FileSystemLoader(searchpaths, encoding='utf-8')
+        environment = TemplateSpecializeEnvironment(
+            loader=loader,
+            extensions=extensions,
+            undefined=jinja2.StrictUndefined,
+            keep_trailing_newline=True,
+            bytecode_cache=bytecode_cache
+        )
+
+        # Create the Parameter Store value cache, if necessary
+        if aws_cache is not None:
+            environment.aws_parameter_store_cache = ParameterStoreCache(aws_cache, aws_cache_ttl, aws_cache_refresh)
+
+        return environment
+
+    @staticmethod
+    def load_environments(environment_files):
+        """
+        Load and parse environment files
+
+        :returns: The parsed environments dict
+        :raises OSError: An environment file could not be read
+        :raises ValueError: An environment file is invalid
+        """
+
+        return _load_environments(environment_files)
+
+    def variables(self, environment_name=None, variables=None):
+        """
+        Get the template variables dict of an environment, if any, with additional variables merged
+
+        :raises ValueError: The environment is unknown or has circular inheritance
+        """
+
+        template_variables = _environments_variables(self.environments, [environment_name] if environment_name else [], [], [])[0][1]
+        if variables is not None:
+            _merge_values(variables, template_variables)
+        return template_variables
+
+    def render(self, dst_path, environment_name=None, variables=None):
+        """
+        Render the source template file or directory to the destination path and apply its rename operations
+
+        :param environment_name: The environment name, if any
+        :param variables: The additional template variables dict, if any
+        :raises ValueError: A template failed to render - the error message is the command-line error message
+        :raises OSError: A template archive could not be read
+        """
+
+        template_variables = self.variables(environment_name, variables)
+        self.environment.template_specialize_hooks = self.hooks
+        self.environment.aws_parameter_store_hooks = self.hooks
+
+        # Retrieve the templates' literal Parameter Store values using batched requests - template bundles are scanned
+        # when compiled
+        if self.is_dir and is_bundle_file(self.src_path):
+            bundle_manifest = load_bundle(self.src_path)
+            src_files, copy_files, rename_files = _bundle_files(bundle_manifest)
+            parameter_store_names = bundle_manifest['parameter_store_names']
+        else:
+            src_files, copy_files, parameter_store_names, template_scan = self._scan()
+            rename_files = _rename_files(template_scan, src_files, copy_files) if self.is_dir else None
+        if parameter_store_names:
+            self.environment.extensions[ParameterStoreExtension.identifier].prefetch(parameter_store_names)
+
+        dst_archive_format = archive_format(dst_path) if self.is_dir else None
+        _render_environment(
+            self.environment, self.src_dir, src_files, dst_path, template_variables, self.is_dir, {}, self.jobs,
+            copy_files=copy_files, dst_archive_format=dst_archive_format, rename_files=rename_files
+        )
+
+    def compile(self, bundle_path):
+        """
+        Compile the source template directory into a template bundle (a ".zip" file) - a template bundle may be used as
+        the source template directory
+
+        :raises ValueError: The source is not a template directory, or a template has a syntax error - the error message
+            is the command-line error message
+        :raises OSError: A template archive could not be read or the bundle could not be written
+        """
+
+        if not self.is_dir:
+            raise ValueError('a template bundle requires a template directory\n')
+        src_files, copy_files, parameter_store_names, template_scan = self._scan()
+        try:
+            _compile_bundle(self.environment, self.src_dir, src_files, copy_files, parameter_store_names, template_scan, bundle_path)
+        except jinja2.TemplateSyntaxError as exc:
+            raise ValueError(_template_error_message(exc, self.src_dir, exc.name)) from exc
+
+    def _scan(self):
+        # Walk the source files and scan the templates for literal Parameter Store names and rename tags
+        exclude_patterns, include_patterns = \
+            _walk_patterns(self.src_path, self.is_dir, self.exclude_patterns, self.include_patterns)
+        src_files = _src_files(self.src_path, self.is_dir, exclude_patterns, include_patterns)
+        copy_files = _copy_files(src_files, self.copy_patterns, self.no_copy_patterns)
+        parameter_store_names, template_scan = _scan_templates(
+            self.dependency_index, [_posix_path(src_file) for src_file in src_files if src_file not in copy_files]
+        )
+        return src_files, copy_files, parameter_store_names, template_scan
+
+
+def _report_timings(parser, args, timings):
+    if args.timings:
+        sys.stderr.write(timings.format_table(TIMINGS_TABLE_MAX))
+    if args.timings_json is not None:
+        try:
+            with open(args.timings_json, 'w', encoding='utf-8') as f_timings:
+                json.dump(timings.report(), f_timings, indent=4)
+        except OSError as exc:
+            parser.exit(message=f'{exc}\n', status=2)
+
+
+def _serve_request(state, argv, cwd):
+    # Run a render daemon request in its working directory, capturing its output
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    cwd_daemon = os.getcwd()
+    try:
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                main(argv, state=state)
+                status = 0
+            except SystemExit as exc:
+                status = exc.code if isinstance(exc.code, int) else (0 if exc.code is None else 1)
+                if isinstance(exc.code, str):
+                    stderr.write(f'{exc.code}\n')
+            except Exception: # pylint: disable=broad-exception-caught
+                import traceback # pylint: disable=import-outside-toplevel
+
+                traceback.print_exc()
+                status = 1
+    except OSError as exc:
+        return 2, '', f'{exc}\n'
+    finally:
+        os.chdir(cwd_daemon)
+    return status, stdout.getvalue(), stderr.getvalue()
+
+
+def _load_environments(environment_files, state=None):
+    environments = {}
+    for environment_file in environment_files:
+        for environment_name, environment_info in _load_environment_file(environment_file, state).items():
+            if environment_name in environments:
+                raise ValueError(f'redefinition of environment {environment_name!r:.100s}')
+            environments[environment_name] = environment_info
+    return environments
+
+
+def _load_environment_file(environment_file, state):
+    # Daemon requests re-use a parsed environment file until it changes - the entry is keyed by path, so a changed file
+    # replaces its entry
+    if state is not None:
+        environment_stat = os.stat(environment_file)
+        state_key = ('environments', os.path.abspath(environment_file))
+        environment_state = state.get(state_key)
+        if environment_state is not None and \
+           environment_state[:2] == (environment_stat.st_mtime_ns, environment_stat.st_size):
+            return environment_state[2]
+
+    # Parse the environment file
+    environments = {}
+    with open(environment_file, 'r', encoding='utf-8') as f_environment:
+        _parse_environments(f_environment.read(), environments)
+    if state is not None:
+        state[state_key] = (environment_stat.st_mtime_ns, environment_stat.st_size, environments)
+    return environments
+
+
+def _create_environment(args, src_dir, is_dir, state=None, index_path=None):
+    # Re-use the daemon's template environment with the same options, if possible. The daemon's template environments
+    # use absolute paths, since requests may have different working directories.
+    searchpaths = [src_dir, *args.searchpaths]
+    cache_dir = args.cache_dir
+    aws_cache = args.aws_cache
+    if state is not None:
+        searchpaths = [os.path.abspath(searchpath) for searchpath in searchpaths]
+        cache_dir, aws_cache = (os.path.abspath(path) if path is not None else None for path in (cache_dir, aws_cache))
+        state_key = (
+            'environment', is_dir, *searchpaths, cache_dir, aws_cache, args.aws_cache_ttl, args.aws_cache_refresh,
+            args.aws_retries, args.aws_max_pool_connections, args.aws_connect_timeout, args.aws_read_timeout
+        )
+        environment_state = state.pop(state_key, None)
+        if environment_state is not None:
+            environment = environment_state['environment']
+
+            # Mark the template environment most-recently used
+            state[state_key] = environment_state
+
+            # Expire the Parameter Store values
+            if args.aws_cache_refresh or time.time() - environment_state['time'] > args.aws_cache_ttl:
+                environment.aws_parameter_store_values.clear()
+                environment_state['time'] = time.time()
+
+            return environment, environment_state['bytecode_cache'], environment_state['dependency_index']
+
+    # Create the template environment - rename extension is only available for directory destination paths
+    environment = Specializer.create_environment(
+        searchpaths, rename=is_dir, cache_dir=cache_dir, aws_cache=aws_cache, aws_cache_ttl=args.aws_cache_ttl,
+        aws_cache_refresh=args.aws_cache_refresh
+    )
+    bytecode_cache = environment.bytecode_cache
+
+    # Create the template dependency index - cached with the compiled templates (or the incremental manifest), if
+    # possible
+    dependency_index = TemplateDependencyIndex(environment, cache_dir, index_path)
+
+    # Configure the Parameter Store client - throttled requests are retried using botocore's adaptive retry mode
+    environment.aws_parameter_store_client_config = {
+        config_name: config_value for config_name, config_value in (
+            ('retries', {'mode': 'adaptive', 'total_max_attempts': args.aws_retries + 1}),
+            ('max_pool_connections', args.aws_max_pool_connections),
+            ('connect_timeout', args.aws_connect_timeout),
+            ('read_timeout', args.aws_read_timeout)
+        ) if config_value is not None
+    }
+
+    # Save the daemon's template environment - the least-recently used template environments are evicted
+    if state is not None:
+        state[state_key] = {
+            'environment': environment,
+            'bytecode_cache': bytecode_cache,
+            'dependency_index': dependency_index,
+            'time': time.time()
+        }
+        environment_keys = [environment_key for environment_key in state if environment_key[0] == 'environment']
+        for environment_key in environment_keys[:-STATE_ENVIRONMENTS_MAX]:
+            del state[environment_key]
+
+    return environment, bytecode_cache, dependency_index
+
+
+# The maximum number of daemon template environments
+STATE_ENVIRONMENTS_MAX = 8
+
+
+def _environments_variables(environments, environment_names, aws_path_values, keys):
+    # Build the template variables dict for each environment
+    now = datetime.datetime.now()
+    environments_variables = []
+    for environment_name in environment_names or [None]:
+        template_variables = {
+            'now': now
+        }
+        if environment_name is not None:
+            _merge_environment(environments, environment_name, template_variables, set())
+        for key, path_values in aws_path_values:
+            _merge_values({key: path_values}, template_variables)
+        for key, value in keys:
+            try:
+                value_json = json.loads(value)
+            except ValueError:
+                value_json = value
+            _merge_values({key: value_json}, template_variables)
+        environments_variables.append((environment_name, template_variables))
+    return environments_variables
+
+
+def _environment_dst_path(dst_path, environment_name):
+    if environment_name is None:
+        return dst_path
+    return dst_path.replace(ENVIRONMENT_PATTERN, environment_name)
+
+
+def _src_files(src_path, is_dir, exclude_patterns=(), include_patterns=()):
+    if not is_dir:
+        return [os.path.basename(src_path)]
+    if is_archive_file(src_path):
+        return [
+            os.path.join(*name.split('/')) for name in open_archive(src_path).members
+            if not _is_member_excluded(name, exclude_patterns, include_patterns)
+        ]
+    return [src_file for src_file, _ in _walk_files(src_path, exclude_patterns, include_patterns)]
+
+
+def _walk_patterns(src_path, is_dir, exclude_patterns, include_patterns):
+    # Get the source directory's ignore file patterns followed by the command-line patterns. Ignore file lines are
+    # exclude patterns - lines starting with "!" are include patterns. The ignore file itself is always excluded.
+    ignore_exclude_patterns = [f'/{IGNORE_FILE_NAME}']
+    ignore_include_patterns = []
+    if is_dir:
+        try:
+            ignore_lines = _read_src_file(src_path, IGNORE_FILE_NAME).decode('utf-8').splitlines()
+        except (FileNotFoundError, KeyError):
+            ignore_lines = []
+        except UnicodeDecodeError as exc:
+            raise ValueError(f'invalid ignore file {os.path.join(src_path, IGNORE_FILE_NAME)!r}: {exc}') from exc
+        for line in ignore_lines:
+            pattern = line.strip()
+            if pattern.startswith('!'):
+                ignore_include_patterns.append(pattern[1:])
+            elif pattern and not pattern.startswith('#'):
+                ignore_exclude_patterns.append(pattern)
+    return [*ignore_exclude_patterns, *exclude_patterns], [*ignore_include_patterns, *include_patterns]
+
+
+# The source directory ignore file name
+IGNORE_FILE_NAME = '.specializeignore'
+
+
+def _walk_files(path, exclude_patterns=(), include_patterns=()):
+    # Yield the relative path and directory entry of each file under a directory, in os.walk (top-down) order. Excluded
+    # directories are not descended into. Symbolic links to directories are not followed.
+    pending = ['']
+    while pending:
+        dir_rel = pending.pop()
+        try:
+            with os.scandir(os.path.join(path, dir_rel)) as dir_entries:
+                entries = list(dir_entries)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            entry_rel = os.path.join(dir_rel, entry.name)
+            try:
+                is_dir = entry.is_dir()
+            except OSError: # pragma: no cover
+                is_dir = False
+            if _is_excluded(_posix_path(entry_rel), is_dir, exclude_patterns, include_patterns):
+                continue
+            if not is_dir:
+                yield entry_rel, entry
+            elif not entry.is_symlink():
+                subdirs.append(entry_rel)
+        pending.extend(reversed(subdirs))
+
+
+def _read_src_file(src_dir, src_file):
+    # Read a source file from a template directory or archive
+    if is_archive_file(src_dir):
+        return open_archive(src_dir).read(_posix_path(src_file))
+    with open(os.path.join(src_dir, src_file), 'rb') as file_:
+        return file_.read()
+
+
+def _is_member_excluded(name, exclude_patterns, include_patterns):
+    # Archive members are excluded if the member or any of its parent directories is excluded
+    name_parts = name.split('/')
+    return any(
+        _is_excluded('/'.join(name_parts[:ix + 1]), ix < len(name_parts) - 1, exclude_patterns, include_patterns)
+        for ix in range(len(name_parts))
+    )
+
+
+def _is_excluded(path, is_dir, exclude_patterns, include_patterns):
+    return any(_match_pattern(path, pattern, is_dir) for pattern in exclude_patterns) and \
+        not any(_match_pattern(path, pattern, is_dir) for pattern in include_patterns)
+
+
+def _match_pattern(path, pattern, is_dir=False):
+    # Match a POSIX relative path with a glob pattern. Patterns without a slash match the path's file name at any depth.
+    # Patterns ending with a slash match only directories.
+    if pattern.endswith('/'):
+        if not is_dir:
+            return False
+        pattern = pattern.rstrip('/')
+    if '/' in pattern:
+        return fnmatch.fnmatchcase(path, pattern.lstrip('/'))
+    return fnmatch.fnmatchcase(path.rsplit('/', 1)[-1], pattern)
+
+
+def _render_environment(environment, src_dir, src_files, dst_path, template_variables, is_dir, file_renames,
+                        jobs=1, skip_unchanged=False, template_inputs=None, copy_files=frozenset(), dst_archive_format=None,
+                        rename_files=None, apply_renames=True):
+    # Render an environment's template files and apply their rename operations. Template files present in the
+    # file_renames dict are skipped (and their renames replayed) if their destination file exists. If template_inputs
+    # is provided, template files whose source hash and read variables are unchanged since the last run are skipped, as
+    # well. Files in copy_files are copied verbatim. If dst_archive_format is provided, the template files are rendered
+    # into an archive. Template files in rename_files (all template files, if None) may rename or delete files - they
+    # are rendered first. If apply_renames is False, rename operations are collected but not applied. Returns the
+    # file_renames dict. Errors are raised as ValueError with the command-line error message.
 
     # Get the destination template file paths
     if is_dir:
-        dst_files = [os.path.join(args.dst_path, src_file) for src_file in src_files]
+        dst_files = [os.path.join(dst_path, src_file) for src_file in src_files]
     else:
-        dst_files = [args.dst_path]
+        dst_files = [dst_path]
 
-    # Template extensions - rename extension is only available for directory destination paths
-    extensions = [ParameterStoreExtension]
-    if is_dir:
-        extensions.append(TemplateSpecializeRenameExtension)
-
-    # Process the template files
-    environment = jinja2.Environment(
-        loader=jinja2.FileSystemLoader([src_dir, *args.searchpaths], encoding='utf-8'),
-        extensions=extensions,
-        undefined=jinja2.StrictUndefined,
-        keep_trailing_newline=True
+    # Incremental mode? If so, skip template files whose inputs are unchanged since the last run
+    if template_inputs is not None:
+        manifest_path, variables_hashes, unchanged_file_renames = \
+            _incremental_files(dst_path, src_files, template_variables, template_inputs)
+        for src_file, src_file_renames in unchanged_file_renames.items():
+            file_renames.setdefault(src_file, src_file_renames)
+    render_files = [
+        src_file
+        for src_file, dst_file in zip(src_files, dst_files)
+        if src_file not in file_renames or not os.path.isfile(dst_file)
+    ]
+
+    # Render the template files that may rename or delete files first, in memory, so the rename and delete operations
+    # are known before any file is written - archive members are rendered in memory
+    rendered = {}
+    rename_render_files = [
+        src_file for src_file in render_files
+        if is_dir and src_file not in copy_files and (rename_files is None or src_file in rename_files)
+    ]
+    rename_results = _render_files(
+        environment, src_dir, [(src_file, None) for src_file in rename_render_files], template_variables, is_dir, False,
+        copy_files, jobs, rendered
+    )
+    for src_file, (src_file_renames, _) in zip(rename_render_files, rename_results):
+        file_renames[src_file] = src_file_renames
+    renames = list(chain.from_iterable(file_renames.get(src_file, ()) for src_file in src_files))
+
+    # Apply the rename and delete operations to the rendered files' destination names
+    dst_names = {_posix_path(src_file): src_file for src_file in render_files}
+    if is_dir and apply_renames:
+        _apply_renames(environment.template_specialize_hooks, dst_path, dst_archive_format is not None, renames, dst_names)
+
+    # Write the rendered files and render the remaining template files to their destination paths. Deleted files are
+    # never rendered or written.
+    written_count = 0
+    remaining_files = []
+    for dst_name, src_file in dst_names.items():
+        if dst_archive_format is not None:
+            dst_file = None
+        elif is_dir:
+            dst_file = os.path.join(dst_path, *dst_name.split('/'))
+        else:
+            dst_file = dst_path
+        if _posix_path(src_file) not in rendered:
+            remaining_files.append((src_file, dst_file))
+        elif dst_file is not None:
+            try:
+                written_count += _write_rendered_file(dst_file, rendered[_posix_path(src_file)], skip_unchanged)
+            except OSError as exc:
+                raise ValueError(_template_error_message(exc, src_dir, src_file)) from exc
+    remaining_results = _render_files(
+        environment, src_dir, remaining_files, template_variables, is_dir, skip_unchanged, copy_files, jobs,
+        rendered if dst_archive_format is not None else None
     )
-    for src_file, dst_file in zip(src_files, dst_files):
+    for (src_file, _), (src_file_renames, written) in zip(remaining_files, remaining_results):
+        file_renames[src_file] = src_file_renames
+        written_count += written
+
+    # Deleted files are never rendered, so they have no rename operations
+    for src_file in render_files:
+        file_renames.setdefault(src_file, [])
+
+    # Report the written and unchanged file counts - deleted files are not counted
+    if skip_unchanged:
+        unchanged_count = len(src_files) - len(render_files) + len(dst_names) - written_count
+        print(f'{written_count} files written, {unchanged_count} files unchanged')
+
+    # Archive destination? If so, write the archive.
+    if dst_archive_format is not None:
         try:
-            # Translate OS source path to a POSIX path
-            if os.sep == '/': # pragma: no cover
-                posix_src_file = src_file
-            else: # pragma: no cover
-                posix_src_file = pathlib.Path(src_file).as_posix()
+            write_archive(
+                dst_path, dst_archive_format,
+                {dst_name: rendered[_posix_path(src_file)] for dst_name, src_file in dst_names.items()}
+            )
+        except OSError as exc:
+            raise ValueError(f'{exc}\n') from exc
 
-            # Load the template
-            template = environment.get_template(posix_src_file)
+    # Write the incremental manifest
+    if template_inputs is not None:
+        _write_manifest(manifest_path, {
+            'templates': {
+                _posix_path(src_file): {
+                    'hash': template_inputs[src_file][0],
+                    'variables': variables_hashes[src_file],
+                    'renames': file_renames[src_file]
+                }
+                for src_file in src_files
+                if template_inputs[src_file][0] is not None
+            }
+        })
 
-            # Ensure the destination directory exists (only for template directories)
-            if is_dir:
-                os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+    return file_renames
 
-            # Render the template
-            template.stream(**template_variables).dump(dst_file, encoding='utf-8')
-        except jinja2.TemplateNotFound as exc:
-            parser.exit(message=f'{exc}\n', status=2)
-        except jinja2.TemplateSyntaxError as exc:
-            parser.exit(message=f'{exc.filename}:{exc.lineno}: {exc.message}\n', status=2)
-        except Exception as exc:
-            parser.exit(message=f'{os.path.join(src_dir, src_file)}: error: {exc}\n', status=2)
 
-    # Process any template destination path rename and delete operations
-    if is_dir:
-        dst_path_norm = os.path.join(os.path.normpath(args.dst_path), '')
-        for rename_path_rel, rename_name in environment.template_specialize_rename: # pylint: disable=no-member
-            rename_path = os.path.normpath(os.path.join(args.dst_path, rename_path_rel))
+def _incremental_files(dst_path, src_files, template_variables, template_inputs):
+    # Get an environment's incremental manifest path, the hashes of the variables read by each template file, and the
+    # dict of template file to the recorded rename operations of template files whose inputs are unchanged since the
+    # last run
+    manifest_path = os.path.join(dst_path, MANIFEST_NAME)
+    manifest = _load_manifest(manifest_path)
+    variables_hashes = {
+        src_file: _variables_hash(template_variables, variable_names)
+        for src_file, (template_hash, variable_names) in template_inputs.items()
+        if template_hash is not None
+    }
+    unchanged_file_renames = {}
+    for src_file in src_files:
+        manifest_template = manifest['templates'].get(_posix_path(src_file))
+        if template_inputs[src_file][0] is not None and manifest_template is not None and \
+           manifest_template['hash'] == template_inputs[src_file][0] and \
+           manifest_template['variables'] == variables_hashes[src_file]:
+            unchanged_file_renames[src_file] = [tuple(rename) for rename in manifest_template['renames']]
+    return manifest_path, variables_hashes, unchanged_file_renames
 
-            # Ensure the source path is contained by the destination template directory
-            if os.path.commonprefix((dst_path_norm, rename_path)) != dst_path_norm:
-                parser.exit(message=f'template_specialize_rename invalid path {rename_path_rel!r}', status=2)
 
-            # Delete?
+def _render_files(environment, src_dir, render_files, template_variables, is_dir, skip_unchanged, copy_files, jobs,
+                  rendered=None):
+    # Render template files, returning the list of each file's rename operations and written flag. Errors are raised
+    # as ValueError with the command-line error message.
+    results = []
+    jobs = min(jobs, len(render_files))
+    if jobs > 1:
+        import concurrent.futures # pylint: disable=import-outside-toplevel
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(
+                    _render_file, environment, src_dir, src_file, dst_file, template_variables, is_dir, skip_unchanged, copy_files,
+                    rendered
+                )
+                for src_file, dst_file in render_files
+            ]
+
+            # Collect the results in template file order so the first error (and rename order) matches a serial run
+            for (src_file, _), future in zip(render_files, futures):
+                try:
+                    results.append(future.result())
+                except Exception as exc:
+                    executor.shutdown(cancel_futures=True)
+                    raise ValueError(_template_error_message(exc, src_dir, src_file)) from exc
+    else:
+        for src_file, dst_file in render_files:
             try:
-                if rename_name is None:
-                    if os.path.isdir(rename_path):
-                        shutil.rmtree(rename_path)
-                    else:
-                        os.unlink(rename_path)
-                else:
-                    # If destination is a directory, delete it first
+                results.append(_render_file(
+                    environment, src_dir, src_file, dst_file, template_variables, is_dir, skip_unchanged, copy_files, rendered
+                ))
+            except Exception as exc:
+                raise ValueError(_template_error_message(exc, src_dir, src_file)) from exc
+    return results
+
+
+def _apply_renames(hooks, dst_path, is_archive, renames, dst_names):
+    # Apply rename and delete operations to the dict of rendered file destination name (relative POSIX path) to source
+    # file. For destination directories, the operations are also applied to existing destination files.
+    dst_path_norm = os.path.join(os.path.normpath(dst_path), '')
+    for rename_path_rel, rename_name in renames:
+        # Ensure the source path is contained by the destination template directory (or archive)
+        if is_archive:
+            rename_path = None
+            rename_path_posix = posixpath.normpath(_posix_path(rename_path_rel))
+            if rename_path_posix in ('.', '..') or rename_path_posix.startswith(('../', '/')):
+                raise ValueError(f'template_specialize_rename invalid path {rename_path_rel!r}')
+        else:
+            rename_path = os.path.normpath(os.path.join(dst_path, rename_path_rel))
+            if os.path.commonprefix((dst_path_norm, rename_path)) != dst_path_norm:
+                raise ValueError(f'template_specialize_rename invalid path {rename_path_rel!r}')
+            rename_path_posix = _posix_path(os.path.relpath(rename_path, dst_path))
+
+        try:
+            # Rename or delete the rendered files
+            rename_prefix = f'{rename_path_posix}/'
+            is_rendered = any(dst_name == rename_path_posix or dst_name.startswith(rename_prefix) for dst_name in dst_names)
+            if is_rendered or is_archive:
+                rename_member(dst_names, rename_path_posix, rename_name)
+
+            # Rendered files not yet written? If so, only delete an existing destination directory.
+            if is_archive:
+                pass
+            elif is_rendered and not os.path.lexists(rename_path):
+                if rename_name is not None:
                     rename_dst_path = os.path.join(os.path.dirname(rename_path), rename_name)
-                    if os.path.isdir(rename_dst_path) and not os.path.samefile(rename_path, rename_dst_path):
+                    if os.path.isdir(rename_dst_path) and rename_dst_path != rename_path:
                         shutil.rmtree(rename_dst_path)
 
-                    # Rename...
-                    os.rename(rename_path, rename_dst_path)
-            except Exception as exc:
-                parser.exit(message=f'template_specialize_rename error: {exc}', status=2)
+            # Delete?
+            elif rename_name is None:
+                if os.path.isdir(rename_path):
+                    shutil.rmtree(rename_path)
+                else:
+                    os.unlink(rename_path)
+            else:
+                # If destination is a directory, delete it first
+                rename_dst_path = os.path.join(os.path.dirname(rename_path), rename_name)
+                if os.path.isdir(rename_dst_path) and not os.path.samefile(rename_path, rename_dst_path):
+                    shutil.rmtree(rename_dst_path)
+
+                # Rename...
+                os.rename(rename_path, rename_dst_path)
+        except Exception as exc:
+            raise ValueError(f'template_specialize_rename error: {exc}') from exc
+        if hooks is not None:
+            hooks.rename_applied(rename_path_rel, rename_name)
+
+
+def _write_rendered_file(dst_file, content, skip_unchanged):
+    # Write a rendered file - if skipping unchanged files, only write the file if its content differs
+    os.makedirs(os.path.dirname(dst_file) or '.', exist_ok=True)
+    if skip_unchanged and _file_equals(dst_file, content):
+        return False
+    _write_file_atomic(dst_file, content)
+    return True
+
+
+def _watch_snapshot(paths):
+    # Map each file under the paths to its modified time and size
+    snapshot = {}
+    for path in paths:
+        file_stats = []
+        if os.path.isdir(path or '.'):
+            for file_rel, entry in _walk_files(path or '.'):
+                try:
+                    file_stats.append((os.path.join(path or '.', file_rel), entry.stat()))
+                except OSError: # pragma: no cover
+                    pass
+        else:
+            try:
+                file_stats.append((path, os.stat(path)))
+            except OSError:
+                pass
+        for file_path, file_stat in file_stats:
+            snapshot[file_path] = (file_stat.st_mtime_ns, file_stat.st_size)
+    return snapshot
+
+
+def _posix_path(path):
+    # Translate OS source path to a POSIX path
+    if os.sep == '/': # pragma: no cover
+        return path
+    return path.replace(os.sep, '/') # pragma: no cover
+
+
+def _copy_files(src_files, copy_patterns, no_copy_patterns):
+    # Get the source files to copy verbatim - patterns are matched against the POSIX relative source file path
+    return frozenset(
+        src_file for src_file in src_files
+        if any(_match_pattern(_posix_path(src_file), pattern) for pattern in copy_patterns) and
+        not any(_match_pattern(_posix_path(src_file), pattern) for pattern in no_copy_patterns)
+    )
+
+
+def _render_file(environment, src_dir, src_file, dst_file, template_variables, is_dir, skip_unchanged, copy_files,
+                 rendered=None):
+    # Copy or render a template file - if rendered is provided, files are rendered into the dict (and copied files are
+    # added by source file path)
+    if rendered is not None:
+        if src_file in copy_files:
+            rendered[_posix_path(src_file)] = \
+                _read_src_file(src_dir, src_file) if is_archive_file(src_dir) else os.path.join(src_dir, src_file)
+            return [], True
+        return _render_template(environment, src_file, dst_file, template_variables, is_dir, rendered=rendered)
+    if src_file in copy_files:
+        if is_dir:
+            os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+
+        # Template archive members are written only if their content differs
+        if is_archive_file(src_dir):
+            content = _read_src_file(src_dir, src_file)
+            written = not _file_equals(dst_file, content)
+            if written:
+                _write_file_atomic(dst_file, content)
+            return [], written
+        return [], _copy_file(os.path.join(src_dir, src_file), dst_file)
+    return _render_template(environment, src_file, dst_file, template_variables, is_dir, skip_unchanged)
+
+
+def _render_template(environment, src_file, dst_file, template_variables, is_dir, skip_unchanged=False, rendered=None):
+    hooks = environment.template_specialize_hooks
+    if hooks is not None:
+        hooks.before_template(_posix_path(src_file))
+    error = None
+    start_time = time.perf_counter()
+
+    # Collect the template's rename operations separately so templates may be rendered concurrently
+    renames = []
+    renames_token = TEMPLATE_SPECIALIZE_RENAME.set(renames)
+    try:
+        # Load the template
+        template = environment.get_template(_posix_path(src_file))
+
+        # Ensure the destination directory exists (only for template directories)
+        if is_dir and rendered is None:
+            os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+
+        # Render the template - if skipping unchanged files, only write the destination file if its content differs
+        if rendered is not None:
+            rendered[_posix_path(src_file)] = template.render(**template_variables).encode('utf-8')
+            written = True
+        elif skip_unchanged:
+            content = template.render(**template_variables).encode('utf-8')
+            written = not _file_equals(dst_file, content)
+            if written:
+                _write_file_atomic(dst_file, content)
+        else:
+            template.stream(**template_variables).dump(dst_file, encoding='utf-8')
+            written = True
+    except Exception as exc:
+        error = exc
+        raise
+    finally:
+        TEMPLATE_SPECIALIZE_RENAME.reset(renames_token)
+        if hooks is not None:
+            hooks.after_template(_posix_path(src_file), time.perf_counter() - start_time, error)
+
+    return renames, written
+
+
+def _file_equals(path, content):
+    # Compare the file size first and then the content hash
+    try:
+        if os.stat(path).st_size != len(content):
+            return False
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as file_:
+            for chunk in iter(lambda: file_.read(FILE_CHUNK_SIZE), b''):
+                file_hash.update(chunk)
+    except OSError:
+        return False
+    return file_hash.digest() == hashlib.sha256(content).digest()
+
+
+def _write_file_atomic(path, content):
+    # Write to a temporary file and then rename, preserving the existing file's permissions
+    path_tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(path_tmp, 'xb') as file_:
+            file_.write(content)
+        try:
+            shutil.copymode(path, path_tmp)
+        except FileNotFoundError:
+            pass
+        os.replace(path_tmp, path)
+    finally:
+        if os.path.exists(path_tmp):
+            os.unlink(path_tmp)
+
+
+# The file read chunk size
+FILE_CHUNK_SIZE = 1024 * 1024
+
+
+def _copy_file(src_path, dst_path):
+    # Skip identical files - same size and modified time (as written by a previous copy) or same content
+    src_stat = os.stat(src_path)
+    try:
+        dst_stat = os.stat(dst_path)
+        if dst_stat.st_size == src_stat.st_size and \
+           (dst_stat.st_mtime_ns == src_stat.st_mtime_ns or _files_equal(src_path, dst_path)):
+            return False
+    except FileNotFoundError:
+        pass
+
+    # Copy to a temporary file and then rename, preserving the source file's permissions and modified time
+    dst_path_tmp = f'{dst_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(src_path, 'rb', buffering=0) as src_file, open(dst_path_tmp, 'xb', buffering=0) as dst_file:
+            _copy_file_data(src_file.fileno(), dst_file.fileno(), src_stat.st_size)
+        shutil.copystat(src_path, dst_path_tmp)
+        os.replace(dst_path_tmp, dst_path)
+    finally:
+        if os.path.exists(dst_path_tmp):
+            os.unlink(dst_path_tmp)
+    return True
+
+
+def _copy_file_data(src_fd, dst_fd, size):
+    # Clone the file (copy-on-write), if the file system supports it
+    if sys.platform.startswith('linux'): # pragma: no branch
+        import fcntl # pylint: disable=import-outside-toplevel
+
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return
+        except OSError:
+            pass
+
+    # Copy within the kernel, if possible - fall back if the first call fails (e.g. not supported by the file system)
+    offset = 0
+    for copy_fn in (_copy_file_range, _sendfile):
+        try:
+            while offset < size:
+                count = copy_fn(src_fd, dst_fd, offset, size - offset)
+                if count == 0:
+                    break
+                offset += count
+            return
+        except OSError:
+            if offset != 0:
+                raise
+
+    # Copy in user space
+    while True:
+        chunk = os.read(src_fd, FILE_CHUNK_SIZE)
+        if not chunk:
+            break
+        while chunk:
+            chunk = chunk[os.write(dst_fd, chunk):]
+
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    if not hasattr(os, 'copy_file_range'): # pragma: no cover
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+    return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+
+
+def _sendfile(src_fd, dst_fd, offset, count):
+    if not hasattr(os, 'sendfile') or not sys.platform.startswith('linux'): # pragma: no cover
+        raise OSError(errno.ENOSYS, 'sendfile is not available')
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+# The Linux FICLONE ioctl request (clone a file's extents)
+FICLONE = 0x40049409
+
+
+def _files_equal(path, other_path):
+    # Compare two files' content
+    with open(path, 'rb') as file_, open(other_path, 'rb') as other_file:
+        while True:
+            chunk = file_.read(FILE_CHUNK_SIZE)
+            if chunk != other_file.read(FILE_CHUNK_SIZE):
+                return False
+            if not chunk:
+                return True
+
+
+def _template_error_message(exc, src_dir, src_file):
+    if isinstance(exc, jinja2.TemplateNotFound):
+        return f'{exc}\n'
+    if isinstance(exc, jinja2.TemplateSyntaxError):
+        return f'{exc.filename}:{exc.lineno}: {exc.message}\n'
+    return f'{os.path.join(src_dir, src_file)}: error: {exc}\n'
+
+
+# The incremental manifest file name, written to the destination directory
+MANIFEST_NAME = '.template-specialize.json'
+MANIFEST_VERSION = 2
+
+# The incremental template dependency index file name, written to the destination directory if there is no compiled
+# template cache
+INDEX_NAME = '.template-specialize-deps.json'
+
+
+def _load_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f_manifest:
+            manifest = json.load(f_manifest)
+        if isinstance(manifest, dict) and manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {'templates': {}}
+
+
+def _write_manifest(manifest_path, manifest):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    manifest_path_tmp = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(manifest_path_tmp, 'w', encoding='utf-8') as f_manifest:
+        json.dump({'version': MANIFEST_VERSION, **manifest}, f_manifest, sort_keys=True, indent=4)
+    os.replace(manifest_path_tmp, manifest_path)
+
+
+def _src_file_sizes(src_path, src_files, copy_files, bundle_manifest=None):
+    # Get the source files' sizes - template bundle templates are sized by their compiled template module
+    if not is_archive_file(src_path):
+        return {src_file: os.stat(os.path.join(src_path, src_file)).st_size for src_file in src_files}
+    archive = open_archive(src_path)
+    return {
+        src_file: archive.size(
+            BundleLoader.get_module_filename(_posix_path(src_file))
+            if bundle_manifest is not None and src_file not in copy_files else _posix_path(src_file)
+        )
+        for src_file in src_files
+    }
+
+
+def _shard_files(src_files, file_sizes, shard_index, shard_count):
+    # Partition the source files into shards of similar total size and return the shard's files. The largest files are
+    # assigned first, each to the shard with the smallest total size. Files are ordered by path hash (rather than walk
+    # order), so every shard computes the same partition.
+    shard_sizes = [(0, index) for index in range(1, shard_count + 1)]
+    shard_src_files = set()
+    for src_file in sorted(
+        src_files, key=lambda src_file: (-file_sizes[src_file], hashlib.sha256(_posix_path(src_file).encode('utf-8')).digest())
+    ):
+        shard_size, index = heapq.heappop(shard_sizes)
+        if index == shard_index:
+            shard_src_files.add(src_file)
+        heapq.heappush(shard_sizes, (shard_size + file_sizes[src_file] + SHARD_FILE_SIZE, index))
+    return [src_file for src_file in src_files if src_file in shard_src_files]
+
+
+# The shard size added for each file, so many small files are spread across shards
+SHARD_FILE_SIZE = 1024
+
+# The shard argument and the shard rename file name, written to the destination directory
+RE_SHARD = re.compile(r'(\d+)/(\d+)')
+SHARD_RENAMES_NAME = '.template-specialize-shard-{}-of-{}.json'
+RE_SHARD_RENAMES = re.compile(r'\.template-specialize-shard-(\d+)-of-(\d+)\.json')
+SHARD_RENAMES_VERSION = 1
+
+
+def _write_shard_renames(dst_path, shard_index, shard_count, file_renames):
+    # Write the shard's rename operations by source file
+    shard_path = os.path.join(dst_path, SHARD_RENAMES_NAME.format(shard_index, shard_count))
+    os.makedirs(dst_path, exist_ok=True)
+    shard_path_tmp = f'{shard_path}.{os.getpid()}.tmp'
+    with open(shard_path_tmp, 'w', encoding='utf-8') as f_shard:
+        json.dump({
+            'version': SHARD_RENAMES_VERSION,
+            'renames': {_posix_path(src_file): renames for src_file, renames in file_renames.items() if renames}
+        }, f_shard, sort_keys=True, indent=4)
+    os.replace(shard_path_tmp, shard_path)
+
+
+def _merge_shards(dst_path):
+    # Read the shard rename files of a destination directory
+    shards = {}
+    for file_name in os.listdir(dst_path):
+        match_name = RE_SHARD_RENAMES.fullmatch(file_name)
+        if match_name is None:
+            continue
+        shard_path = os.path.join(dst_path, file_name)
+        try:
+            with open(shard_path, 'r', encoding='utf-8') as f_shard:
+                shard = json.load(f_shard)
+        except ValueError as exc:
+            raise ValueError(f'invalid shard rename file {shard_path!r}: {exc}') from exc
+        if not isinstance(shard, dict) or shard.get('version') != SHARD_RENAMES_VERSION or \
+           not isinstance(shard.get('renames'), dict) or not all(isinstance(renames, list) for renames in shard['renames'].values()):
+            raise ValueError(f'invalid shard rename file {shard_path!r}')
+        shards[shard_path] = (int(match_name[1]), int(match_name[2]), shard['renames'])
+
+    # Ensure every shard's rename file is present
+    shard_counts = {shard_count for _, shard_count, _ in shards.values()}
+    if not shard_counts:
+        raise ValueError(f'no shard rename files in {dst_path!r}')
+    if len(shard_counts) != 1:
+        raise ValueError(f'shard rename files in {dst_path!r} have different shard counts')
+    shard_count = shard_counts.pop()
+    shard_indexes = {shard_index for shard_index, _, _ in shards.values()}
+    missing_shards = [f'{shard_index}/{shard_count}' for shard_index in range(1, shard_count + 1) if shard_index not in shard_indexes]
+    if missing_shards:
+        raise ValueError(f'missing shard rename files in {dst_path!r}: {", ".join(missing_shards)}')
+
+    # Apply the rename operations in source file path order and delete the shard rename files
+    file_renames = dict(chain.from_iterable(renames.items() for _, _, renames in shards.values()))
+    renames = [tuple(rename) for src_name in sorted(file_renames) for rename in file_renames[src_name]]
+    _apply_renames(None, dst_path, False, renames, {})
+    for shard_path in shards:
+        os.unlink(shard_path)
+
+
+def _template_inputs(dependency_index, src_file, copy_files=frozenset()):
+    # The template's source hash and the names of the variables it reads - copied files are always copied (unless
+    # identical). Parameter Store values may change at any time, so templates that use them are always rendered.
+    if src_file in copy_files:
+        return None, None
+    template_name = _posix_path(src_file)
+    variable_names = dependency_index.variables(template_name)
+    if dependency_index.uses_parameter_store(template_name) is not False:
+        return None, None
+    return dependency_index.template_hash(template_name), variable_names
+
+
+def _template_dependencies(dependency_index, src_file, copy_files=frozenset()):
+    # Copied files are not parsed - they depend only on themselves
+    if src_file in copy_files:
+        return {_posix_path(src_file)}
+    return dependency_index.dependencies(_posix_path(src_file))
+
+
+def _template_variables(dependency_index, src_file, copy_files=frozenset()):
+    if src_file in copy_files:
+        return set()
+    return dependency_index.variables(_posix_path(src_file))
+
+
+def _variables_hash(template_variables, variable_names):
+    # Hash the values of the variables read by a template - the built-in "now" variable differs on every run, so
+    # templates that read it are always rendered
+    variables = {name: template_variables[name] for name in variable_names if name in template_variables}
+    return hashlib.sha256(JSONEncoder(sort_keys=True).encode(variables).encode('utf-8')).hexdigest()
+
+
+def _changed_variables(template_variables_prev, template_variables):
+    # Get the names of the variables whose values differ - None if there are no previous variables
+    if template_variables_prev is None:
+        return None
+    encoder = JSONEncoder(sort_keys=True)
+    return {
+        name for name in chain(template_variables_prev, template_variables)
+        if name not in template_variables_prev or name not in template_variables or
+        encoder.encode(template_variables_prev[name]) != encoder.encode(template_variables[name])
+    }
+
+
+def _scan_templates(dependency_index, template_names):
+    # Find the literal aws_parameter_store names of the templates and the templates they reference. Only templates that
+    # may contain the tag or references are looked up in the template dependency index (and parsed, if not indexed).
+    # Returns the names and a dict of template name to a tuple of whether the template contains the
+    # template_specialize_rename tag and its referenced template names (None for dynamic references) - the tuple is None
+    # if the template could not be scanned.
+    environment = dependency_index.environment
+    names = []
+    templates = {}
+    pending = list(reversed(template_names))
+    while pending:
+        template_name = pending.pop()
+        if template_name in templates:
+            continue
+        templates[template_name] = None
+        try:
+            source = environment.loader.get_source(environment, template_name)[0]
+            parameter_names = dependency_index.parameter_names(template_name) if PARAMETER_STORE_TAG in source else []
+            references = dependency_index.references(template_name) if RE_REFERENCE_SCAN.search(source) else []
+        except (jinja2.TemplateError, OSError, ValueError):
+            continue
+        names.extend(parameter_names)
+        templates[template_name] = (RENAME_TAG in source, references)
+        pending.extend(name for name in references if name is not None)
+    return names, templates
+
+
+# The aws_parameter_store tag (and filter) name and the template reference keywords - only templates whose source
+# contains them may have literal Parameter Store names or references
+PARAMETER_STORE_TAG = 'aws_parameter_store'
+RE_REFERENCE_SCAN = re.compile(r'include|import|extends')
+
+# The rename tag name - templates whose source contains the tag name may rename or delete files
+RENAME_TAG = 'template_specialize_rename'
+
+
+def _rename_files(template_scan, src_files, copy_files):
+    # Get the template files that may rename or delete files - those that contain the template_specialize_rename tag or
+    # reference a template that does (or whose references can't be determined)
+    rename_files = set()
+    for src_file in src_files:
+        if src_file in copy_files:
+            continue
+        visited = set()
+        pending = [_posix_path(src_file)]
+        while pending:
+            template_name = pending.pop()
+            if template_name in visited:
+                continue
+            visited.add(template_name)
+            template = template_scan.get(template_name)
+            if template is None or template[0] or None in template[1]:
+                rename_files.add(src_file)
+                break
+            pending.extend(template[1])
+    return frozenset(rename_files)
+
+
+def _compile_bundle(environment, src_dir, src_files, copy_files, parameter_store_names, template_scan, bundle_path):
+    # Compile the source templates and the templates they reference into a template bundle - if any template has a
+    # dynamic reference, all templates that parse are compiled. The bundle manifest records the source files and their
+    # scan results.
+    rename_files = _rename_files(template_scan, src_files, copy_files)
+    compile_bundle(
+        environment, bundle_path, template_scan,
+        {
+            _posix_path(src_file): _read_src_file(src_dir, src_file) if is_archive_file(src_dir) else os.path.join(src_dir, src_file)
+            for src_file in src_files if src_file in copy_files
+        },
+        {
+            'files': [_posix_path(src_file) for src_file in src_files],
+            'copy_files': [_posix_path(src_file) for src_file in src_files if src_file in copy_files],
+            'rename_files': [_posix_path(src_file) for src_file in src_files if src_file in rename_files],
+            'parameter_store_names': list(dict.fromkeys(parameter_store_names))
+        },
+        all_templates=any(template is not None and None in template[1] for template in template_scan.values())
+    )
+
+
+def _bundle_files(bundle_manifest):
+    # Get a template bundle's source files, copied files, and template files that may rename or delete files
+    src_files = [os.path.join(*name.split('/')) for name in bundle_manifest['files']]
+    copy_files = frozenset(os.path.join(*name.split('/')) for name in bundle_manifest['copy_files'])
+    rename_files = frozenset(os.path.join(*name.split('/')) for name in bundle_manifest['rename_files'])
+    return src_files, copy_files, rename_files
 
 
 class JSONEncoder(json.JSONEncoder):
@@ -168,6 +1663,51 @@ class JSONEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, o) # pragma: no cover
 
 
+class TemplateSpecializeEnvironment(jinja2.Environment):
+    # The SpecializerHooks object, if any - template loads are reported as cache hits or misses
+    template_specialize_hooks = None
+
+    def get_template(self, name, parent=None, globals=None): # pylint: disable=redefined-builtin
+        hooks = self.template_specialize_hooks
+        if hooks is None or not isinstance(name, str):
+            return super().get_template(name, parent, globals)
+        compile_seconds = []
+        compile_token = TEMPLATE_SPECIALIZE_COMPILE_SECONDS.set(compile_seconds)
+        load_start = time.perf_counter()
+        try:
+            template = super().get_template(name, parent, globals)
+        finally:
+            TEMPLATE_SPECIALIZE_COMPILE_SECONDS.reset(compile_token)
+        load_seconds = time.perf_counter() - load_start
+        if compile_seconds:
+            hooks.cache_miss(name, load_seconds, sum(compile_seconds))
+        else:
+            hooks.cache_hit(name, load_seconds)
+        return template
+
+    def compile(self, source, name=None, filename=None, raw=False, defer_init=False):
+        compile_seconds = TEMPLATE_SPECIALIZE_COMPILE_SECONDS.get(None)
+        if compile_seconds is None:
+            return super().compile(source, name, filename, raw, defer_init)
+        compile_start = time.perf_counter()
+        try:
+            return super().compile(source, name, filename, raw, defer_init)
+        finally:
+            compile_seconds.append(time.perf_counter() - compile_start)
+
+
+# The current template load's compile times
+TEMPLATE_SPECIALIZE_COMPILE_SECONDS = contextvars.ContextVar('TEMPLATE_SPECIALIZE_COMPILE_SECONDS')
+
+
+# The maximum number of timings table rows
+TIMINGS_TABLE_MAX = 40
+
+
+# The current template render's rename operations list - defaults to the environment's "template_specialize_rename" list
+TEMPLATE_SPECIALIZE_RENAME = contextvars.ContextVar('TEMPLATE_SPECIALIZE_RENAME')
+
+
 class TemplateSpecializeRenameExtension(jinja2.ext.Extension):
     tags = set(['template_specialize_rename'])
 
@@ -204,13 +1744,28 @@ class TemplateSpecializeRenameExtension(jinja2.ext.Extension):
         if os_name is not None and \
            not (isinstance(os_name, str) and os.path.basename(os_name).strip() != '' and os.path.dirname(os_name) == ''):
             raise ValueError(f'template_specialize_rename - invalid destination name {os_name!r}')
-        self.environment.template_specialize_rename.append((os_path.strip(), os_name.strip() if os_name is not None else None))
+        renames = TEMPLATE_SPECIALIZE_RENAME.get(self.environment.template_specialize_rename)
+        renames.append((os_path.strip(), os_name.strip() if os_name is not None else None))
         return ''
 
 
 RE_JSON_COMMENT = re.compile(r'^\s*//')
 
 
+# The destination path environment name pattern
+ENVIRONMENT_PATTERN = '{env}'
+
+
+def _match_environments(environments, pattern):
+    # Plain environment names are checked when merged
+    if not any(char in pattern for char in '*?['):
+        return [pattern]
+    names = fnmatch.filter(environments.keys(), pattern)
+    if not names:
+        raise ValueError(f'no environments match {pattern!r:.100}')
+    return names
+
+
 def _parse_environments(text, environments):
     loaded_environments = json.loads('\n'.join(line for line in text.splitlines() if not RE_JSON_COMMENT.match(line)))
     if not isinstance(loaded_environments, dict):
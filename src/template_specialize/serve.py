@@ -0,0 +1,140 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+"""
+template-specialize render daemon and client
+
+Requests and responses are single lines of JSON. A request is an object with the command-line arguments ("argv") and
+working directory ("cwd"). A response is an object with the exit status ("status") and output ("stdout" and "stderr").
+
+This module only imports standard library modules so that the client starts quickly.
+"""
+
+import argparse
+import json
+import os
+import socket
+import stat
+import sys
+
+
+def serve(socket_path, handle_request):
+    """
+    Serve requests on a Unix socket, one at a time, until interrupted
+
+    :param handle_request: The request handler function - called with the request's argv and cwd and returns the
+        response's status, stdout, and stderr
+    :raises OSError: The socket could not be created or is in use
+    """
+
+    if not hasattr(socket, 'AF_UNIX'): # pragma: no cover
+        raise OSError('Unix sockets are not supported on this platform')
+
+    # Remove a stale socket file
+    try:
+        if stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            try:
+                request(socket_path, None)
+            except OSError:
+                os.unlink(socket_path)
+            else:
+                raise OSError(f'socket {socket_path!r} is in use')
+    except FileNotFoundError:
+        pass
+
+    # Create the socket - only the current user may connect
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    try:
+        server.listen()
+        while True:
+            connection = server.accept()[0]
+            with connection:
+                # A client that doesn't send its request in time can't block other clients
+                connection.settimeout(REQUEST_TIMEOUT)
+                try:
+                    # A null request checks that the daemon is running
+                    request_ = json.loads(_receive_line(connection))
+                    if request_ is None:
+                        continue
+                    argv, cwd = request_['argv'], request_['cwd']
+                    if not (isinstance(argv, list) and all(isinstance(arg, str) for arg in argv) and isinstance(cwd, str)):
+                        raise ValueError('"argv" must be a list of strings and "cwd" must be a string')
+                    status, stdout, stderr = handle_request(argv, cwd)
+                except (ValueError, KeyError, TypeError, socket.timeout) as exc:
+                    status, stdout, stderr = 2, '', f'invalid request: {exc}\n'
+                try:
+                    connection.sendall(json.dumps({'status': status, 'stdout': stdout, 'stderr': stderr}).encode('utf-8') + b'\n')
+                except OSError: # pragma: no cover
+                    pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(socket_path)
+
+
+def request(socket_path, argv, cwd=None):
+    """
+    Send a request to a render daemon
+
+    :returns: The response's status, stdout, and stderr
+    :raises OSError: The daemon could not be reached
+    :raises ValueError: The response is invalid
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        request_ = {'argv': argv, 'cwd': cwd if cwd is not None else os.getcwd()} if argv is not None else None
+        client.sendall(json.dumps(request_).encode('utf-8') + b'\n')
+        if request_ is None:
+            return None
+        response = json.loads(_receive_line(client))
+    return response['status'], response['stdout'], response['stderr']
+
+
+def _receive_line(connection):
+    chunks = []
+    while True:
+        chunk = connection.recv(RECEIVE_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b'\n'):
+            break
+    return b''.join(chunks).decode('utf-8')
+
+
+# The socket receive size
+RECEIVE_SIZE = 64 * 1024
+
+# The daemon's request receive timeout, in seconds
+REQUEST_TIMEOUT = 10
+
+
+def client_main(argv=None):
+    """
+    template-specialize-client command-line script main entry point
+    """
+
+    argument_parser_args = {'prog': 'template-specialize-client'}
+    if sys.version_info >= (3, 14): # pragma: no cover
+        argument_parser_args['color'] = False
+    parser = argparse.ArgumentParser(**argument_parser_args)
+    parser.add_argument('socket_path', metavar='SOCKET',
+                        help='the template-specialize daemon socket')
+    parser.add_argument('args', metavar='ARG', nargs=argparse.REMAINDER,
+                        help='the template-specialize arguments')
+    args = parser.parse_args(args=argv)
+
+    try:
+        status, stdout, stderr = request(args.socket_path, args.args)
+    except (OSError, ValueError, KeyError) as exc:
+        parser.exit(message=f'{exc}\n', status=2)
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    sys.exit(status)
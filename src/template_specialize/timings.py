@@ -0,0 +1,116 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+"""
+template-specialize run timings
+"""
+
+import contextlib
+import threading
+import time
+
+from .hooks import SpecializerHooks
+
+
+class Timings(SpecializerHooks):
+    """
+    Thread-safe wall time totals of a run's phases and templates
+
+    Each timing is identified by a phase (e.g. "walk" or "render") and an optional name (e.g. a template name). Template
+    and Parameter Store timings are recorded using the instrumentation hooks. Counts of events that have no wall time
+    (e.g. Parameter Store cache hits) are recorded as counters.
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self._timings = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def time(self, phase, name=None):
+        """
+        Context manager that adds the wall time of its block to a timing
+        """
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, name, time.perf_counter() - start_time)
+
+    def add(self, phase, name, seconds):
+        """
+        Add seconds to a timing and increment its count
+        """
+
+        with self._lock:
+            timing = self._timings.get((phase, name))
+            self._timings[(phase, name)] = (timing[0] + seconds, timing[1] + 1) if timing is not None else (seconds, 1)
+
+    def count(self, name, count=1):
+        """
+        Add to a counter
+        """
+
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + count
+
+    def after_template(self, name, seconds, error):
+        self.add('render', name, seconds)
+
+    def cache_hit(self, name, seconds):
+        self.add('load', name, seconds)
+
+    def cache_miss(self, name, seconds, compile_seconds):
+        self.add('load', name, seconds - compile_seconds)
+        self.add('compile', name, compile_seconds)
+
+    def parameter_fetch(self, method_name, request, seconds, error):
+        self.add('parameter store wait', method_name, seconds)
+
+    def parameter_cache(self, name, hit):
+        self.count('parameter store cache hits' if hit else 'parameter store cache misses')
+
+    def seconds(self, phase, name=None):
+        """
+        Get a timing's total seconds
+        """
+
+        with self._lock:
+            timing = self._timings.get((phase, name))
+        return timing[0] if timing is not None else 0
+
+    def report(self):
+        """
+        Get the timings, sorted by descending time, the counters, and the run's total wall time as a JSON-serializable dict
+        """
+
+        with self._lock:
+            timings = sorted(self._timings.items(), key=lambda item: (-item[1][0], item[0][0], item[0][1] or ''))
+            counts = dict(sorted(self._counts.items()))
+        return {
+            'total': time.perf_counter() - self.start_time,
+            'timings': [
+                {'phase': phase, 'name': name, 'seconds': seconds, 'count': count}
+                for (phase, name), (seconds, count) in timings
+            ],
+            'counts': counts
+        }
+
+    def format_table(self, max_rows=None):
+        """
+        Format the timings report as a text table
+        """
+
+        report = self.report()
+        timings = report['timings']
+        lines = [f'{"Seconds":>10} {"Count":>7}  {"Phase":<24} Name']
+        for timing in timings[:max_rows]:
+            lines.append(f'{timing["seconds"]:>10.3f} {timing["count"]:>7}  {timing["phase"]:<24} {timing["name"] or ""}'.rstrip())
+        if max_rows is not None and len(timings) > max_rows:
+            lines.append(f'({len(timings) - max_rows} more)')
+        for name, count in report['counts'].items():
+            lines.append(f'{"":>10} {count:>7}  {name}')
+        lines.append(f'{report["total"]:>10.3f} {"":>7}  total')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,214 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+import io
+import os
+import tarfile
+from tempfile import TemporaryDirectory
+import unittest
+import zipfile
+
+import jinja2
+from template_specialize.archive import \
+    ArchiveLoader, TemplateArchive, archive_format, is_archive_file, open_archive, rename_member, write_archive
+
+
+def write_tar(path, members, mode='w'):
+    with tarfile.open(path, mode) as archive:
+        for name, content in members.items():
+            member_info = tarfile.TarInfo(name)
+            member_info.size = len(content)
+            archive.addfile(member_info, io.BytesIO(content))
+        member_info = tarfile.TarInfo('subdir')
+        member_info.type = tarfile.DIRTYPE
+        archive.addfile(member_info)
+
+
+def write_zip(path, members):
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('subdir/', b'')
+        for ix, (name, content) in enumerate(members.items()):
+            archive.writestr(name, content, compress_type=zipfile.ZIP_DEFLATED if ix % 2 else zipfile.ZIP_STORED)
+
+
+class TestArchive(unittest.TestCase):
+
+    def test_archive_format(self):
+        self.assertEqual(archive_format('a.tar'), 'tar')
+        self.assertEqual(archive_format('a.TAR.GZ'), 'tar.gz')
+        self.assertEqual(archive_format('a.tgz'), 'tar.gz')
+        self.assertEqual(archive_format('a.zip'), 'zip')
+        self.assertEqual(archive_format('-'), 'tar')
+        self.assertIsNone(archive_format('a.txt'))
+
+    def test_rename_member(self):
+        members = {'a.txt': b'a', 'dir/b.txt': b'b', 'dir/sub/c.txt': b'c', 'other/d.txt': b'd'}
+        rename_member(members, 'dir', 'other')
+        self.assertEqual(members, {'a.txt': b'a', 'other/b.txt': b'b', 'other/sub/c.txt': b'c'})
+        rename_member(members, 'a.txt', 'a.txt')
+        rename_member(members, 'other/sub/c.txt', None)
+        self.assertEqual(members, {'a.txt': b'a', 'other/b.txt': b'b'})
+        with self.assertRaises(ValueError) as cm_exc:
+            rename_member(members, 'dir', 'new')
+        self.assertEqual(str(cm_exc.exception), "no such file or directory: 'dir'")
+
+    def test_write_archive(self):
+        with TemporaryDirectory() as temp_dir:
+            cwd = os.getcwd()
+            try:
+                os.chdir(temp_dir)
+                write_archive('test.zip', 'zip', {'a.txt': b'a'})
+            finally:
+                os.chdir(cwd)
+            with zipfile.ZipFile(os.path.join(temp_dir, 'test.zip')) as archive:
+                self.assertEqual(archive.read('a.txt'), b'a')
+
+            # The temporary file is removed on error
+            archive_path = os.path.join(temp_dir, 'error.tar')
+            with self.assertRaises(FileNotFoundError):
+                write_archive(archive_path, 'tar', {'a.txt': b'a', 'b.txt': os.path.join(temp_dir, 'missing.txt')})
+            self.assertEqual(os.listdir(temp_dir), ['test.zip'])
+
+    def test_template_archive(self):
+        members = {'a.txt': b'a', './subdir/b.txt': b'b' * 1000, '/c.txt': b'', '../outside.txt': b'outside'}
+        with TemporaryDirectory() as temp_dir:
+            for archive_name in ('test.tar', 'test.tar.gz', 'test.zip'):
+                archive_path = os.path.join(temp_dir, archive_name)
+                if archive_name.endswith('.zip'):
+                    write_zip(archive_path, members)
+                else:
+                    write_tar(archive_path, members, 'w:gz' if archive_name.endswith('.gz') else 'w')
+                self.assertTrue(is_archive_file(archive_path))
+
+                archive = TemplateArchive(archive_path)
+                self.assertEqual(list(archive.members), ['a.txt', 'subdir/b.txt', 'c.txt'])
+                self.assertEqual(archive.read('subdir/b.txt'), b'b' * 1000)
+                self.assertEqual(archive.read('a.txt'), b'a')
+                self.assertEqual(archive.read('c.txt'), b'')
+                self.assertEqual(archive.size('subdir/b.txt'), 1000)
+                self.assertEqual(archive.size('c.txt'), 0)
+                with self.assertRaises(KeyError):
+                    archive.read('subdir')
+                archive.close()
+
+    def test_template_archive_invalid(self):
+        with TemporaryDirectory() as temp_dir:
+            for archive_name in ('test.tar', 'test.tar.gz', 'test.zip', 'empty.zip'):
+                archive_path = os.path.join(temp_dir, archive_name)
+                with open(archive_path, 'wb') as archive_file:
+                    archive_file.write(b'' if archive_name.startswith('empty') else b'not an archive' * 100)
+                with self.assertRaises(OSError) as cm_exc:
+                    TemplateArchive(archive_path)
+                self.assertTrue(str(cm_exc.exception).startswith(f'invalid archive {archive_path!r}: '))
+
+            # Corrupt member
+            archive_path = os.path.join(temp_dir, 'corrupt.zip')
+            write_zip(archive_path, {'a.txt': b'a'})
+            with open(archive_path, 'r+b') as archive_file:
+                archive_data = archive_file.read()
+                archive_file.seek(archive_data.index(b'a.txt') + 5)
+                archive_file.write(b'x')
+            archive = TemplateArchive(archive_path)
+            with self.assertRaises(OSError) as cm_exc:
+                archive.read('a.txt')
+            self.assertEqual(str(cm_exc.exception), f"invalid archive {archive_path!r}: Bad CRC-32 for file 'a.txt'")
+            archive.close()
+
+            # Corrupt compressed member
+            with zipfile.ZipFile(archive_path, 'w') as archive:
+                archive.writestr('a.txt', b'a' * 1000, compress_type=zipfile.ZIP_DEFLATED)
+            with open(archive_path, 'r+b') as archive_file:
+                archive_data = archive_file.read()
+                archive_file.seek(archive_data.index(b'a.txt') + 5)
+                archive_file.write(b'\xff\xff')
+            archive = TemplateArchive(archive_path)
+            with self.assertRaises(OSError) as cm_exc:
+                archive.read('a.txt')
+            self.assertEqual(
+                str(cm_exc.exception), f'invalid archive {archive_path!r}: Error -3 while decompressing data: invalid block type'
+            )
+            archive.close()
+
+            # Corrupt local file header
+            with open(archive_path, 'r+b') as archive_file:
+                archive_file.write(b'XX')
+            archive = TemplateArchive(archive_path)
+            with self.assertRaises(OSError) as cm_exc:
+                archive.read('a.txt')
+            self.assertEqual(str(cm_exc.exception), f'invalid archive {archive_path!r}: Bad magic number for file header')
+            archive.close()
+
+    def test_template_archive_compression(self):
+        with TemporaryDirectory() as temp_dir:
+            archive_path = os.path.join(temp_dir, 'test.zip')
+            with zipfile.ZipFile(archive_path, 'w') as archive:
+                archive.writestr('a.txt', b'a' * 1000, compress_type=zipfile.ZIP_BZIP2)
+                archive.writestr('b.txt', b'b' * 1000, compress_type=zipfile.ZIP_LZMA)
+            archive = TemplateArchive(archive_path)
+            self.assertEqual(archive.read('a.txt'), b'a' * 1000)
+            self.assertEqual(archive.read('b.txt'), b'b' * 1000)
+            archive.close()
+
+            # Corrupt local file header
+            with open(archive_path, 'r+b') as archive_file:
+                archive_data = archive_file.read()
+                archive_file.seek(archive_data.index(b'a.txt'))
+                archive_file.write(b'x')
+            archive = TemplateArchive(archive_path)
+            with self.assertRaises(OSError) as cm_exc:
+                archive.read('a.txt')
+            self.assertEqual(
+                str(cm_exc.exception),
+                f"invalid archive {archive_path!r}: File name in directory 'a.txt' and header b'x.txt' differ."
+            )
+            archive.close()
+
+    def test_open_archive(self):
+        with TemporaryDirectory() as temp_dir:
+            archive_path = os.path.join(temp_dir, 'test.zip')
+            write_zip(archive_path, {'a.txt': b'a'})
+            archive = open_archive(archive_path)
+            self.assertIs(open_archive(archive_path), archive)
+
+            # Changed archives are re-opened
+            write_zip(archive_path, {'a.txt': b'a2', 'b.txt': b'b'})
+            os.utime(archive_path, ns=(1000000000, 1000000000))
+            archive2 = open_archive(archive_path)
+            self.assertIsNot(archive2, archive)
+            self.assertEqual(archive2.read('a.txt'), b'a2')
+
+    def test_archive_loader(self):
+        with TemporaryDirectory() as temp_dir:
+            archive_path = os.path.join(temp_dir, 'test.tar')
+            write_tar(archive_path, {'a.txt': b'{% include "b.txt" %}', 'b.txt': b'archive b'})
+            os.makedirs(os.path.join(temp_dir, 'dir'))
+            with open(os.path.join(temp_dir, 'dir', 'b.txt'), 'w', encoding='utf-8') as f_b:
+                f_b.write('dir b')
+            with open(os.path.join(temp_dir, 'dir', 'c.txt'), 'w', encoding='utf-8') as f_c:
+                f_c.write('{% include "b.txt" %}')
+
+            loader = ArchiveLoader([os.path.join(temp_dir, 'dir'), archive_path])
+            environment = jinja2.Environment(loader=loader)
+            self.assertEqual(environment.get_template('a.txt').render(), 'dir b')
+            self.assertEqual(environment.get_template('c.txt').render(), 'dir b')
+            self.assertEqual(loader.list_templates(), ['a.txt', 'b.txt', 'c.txt'])
+            self.assertEqual(loader.template_filename('a.txt'), archive_path)
+            self.assertEqual(loader.template_filename('b.txt'), os.path.join(temp_dir, 'dir', 'b.txt'))
+            self.assertIsNone(loader.template_filename('missing.txt'))
+            self.assertIsNone(loader.template_filename('../a.txt'))
+            with self.assertRaises(jinja2.TemplateNotFound):
+                environment.get_template('missing.txt')
+
+            # Archive templates are up-to-date until the archive changes
+            loader = ArchiveLoader([archive_path, os.path.join(temp_dir, 'dir')])
+            environment = jinja2.Environment(loader=loader)
+            template = environment.get_template('a.txt')
+            self.assertEqual(template.filename, os.path.join(archive_path, 'a.txt'))
+            self.assertEqual(template.render(), 'archive b')
+            self.assertTrue(template.is_up_to_date)
+            write_tar(archive_path, {'a.txt': b'changed'})
+            os.utime(archive_path, ns=(1000000000, 1000000000))
+            self.assertFalse(template.is_up_to_date)
+            self.assertEqual(environment.get_template('a.txt').render(), 'changed')
+            os.unlink(archive_path)
+            self.assertFalse(template.is_up_to_date)
@@ -1,12 +1,21 @@
 # Licensed under the MIT License
 # https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
 
+import errno
+import os
+import shutil
+from tempfile import TemporaryDirectory
+import threading
+import time
 import unittest
 import unittest.mock as unittest_mock
 
+import botocore.awsrequest
 import botocore.exceptions
+import botocore.session
+import botocore.stub
 from jinja2 import Environment, StrictUndefined
-from template_specialize.aws_parameter_store import ParameterStoreExtension
+from template_specialize.aws_parameter_store import ParameterStoreCache, ParameterStoreExtension
 
 
 class TestAWSParameterStore(unittest.TestCase):
@@ -91,3 +100,456 @@ val1 = {% aws_parameter_store 'val1' %}
                 unittest_mock.call(Name='val1', WithDecryption=True)
             ]
         )
+
+    def test_find_parameter_names(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        ast = environment.parse(
+            '''\
+{% set val = 'val3' -%}
+val1 = {% aws_parameter_store 'val1' %}
+{% if val %}val2 = {% aws_parameter_store 'val2' %}{% endif %}
+val3 = {% aws_parameter_store val %}
+val4 = {% aws_parameter_store 4 %}
+'''
+        )
+        self.assertEqual(list(ParameterStoreExtension.find_parameter_names(ast)), ['val1', 'val2'])
+
+    def test_prefetch(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        extension = environment.extensions[ParameterStoreExtension.identifier]
+        template = environment.from_string(
+            '''\
+{% for ix in range(12) %}{% aws_parameter_store 'val' ~ ix %}
+{% endfor %}'''
+        )
+
+        def get_parameters(**kwargs):
+            return {
+                'Parameters': [
+                    {'Name': name, 'Value': f'{name}-{{value}}'} for name in kwargs['Names'] if name not in ('val4', 'val11')
+                ],
+                'InvalidParameters': ['val4', 'val11']
+            }
+
+        with unittest_mock.patch('botocore.session') as mock_session:
+            mock_client = mock_session.get_session.return_value.create_client.return_value
+            mock_client.get_parameters.side_effect = get_parameters
+            mock_client.get_parameter.side_effect = self._get_parameter
+            extension.prefetch([f'val{ix}' for ix in range(12)] + ['val0'])
+            self.assertEqual(
+                template.render(),
+                ''.join(f'val{ix}-{{value}}\n' for ix in range(12))
+            )
+
+        self.assertEqual(
+            mock_client.get_parameters.call_args_list,
+            [
+                unittest_mock.call(Names=[f'val{ix}' for ix in range(10)], WithDecryption=True),
+                unittest_mock.call(Names=['val10', 'val11'], WithDecryption=True)
+            ]
+        )
+        self.assertEqual(
+            mock_client.get_parameter.call_args_list,
+            [
+                unittest_mock.call(Name='val4', WithDecryption=True),
+                unittest_mock.call(Name='val11', WithDecryption=True)
+            ]
+        )
+
+        # Previously-retrieved values are not requested again
+        mock_client.reset_mock()
+        extension.prefetch(['val0', 'val4'])
+        self.assertEqual(mock_client.get_parameters.call_args_list, [])
+
+    def test_prefetch_selector_arn(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        extension = environment.extensions[ParameterStoreExtension.identifier]
+        with unittest_mock.patch('botocore.session') as mock_session:
+            mock_client = mock_session.get_session.return_value.create_client.return_value
+            mock_client.get_parameters.return_value = {
+                'Parameters': [
+                    {'Name': 'val1', 'Selector': ':2', 'Value': 'value1'},
+                    {'Name': 'val2', 'ARN': 'arn:aws:ssm:us-east-1:123:parameter/val2', 'Value': 'value2'}
+                ],
+                'InvalidParameters': []
+            }
+            extension.prefetch(['val1:2', 'arn:aws:ssm:us-east-1:123:parameter/val2'])
+
+        self.assertEqual(
+            environment.aws_parameter_store_values,
+            {'val1:2': 'value1', 'arn:aws:ssm:us-east-1:123:parameter/val2': 'value2'}
+        )
+
+    def test_prefetch_error(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        extension = environment.extensions[ParameterStoreExtension.identifier]
+        template = environment.from_string(
+            '''\
+val1 = {% aws_parameter_store 'val1' %}
+'''
+        )
+        with unittest_mock.patch('botocore.session') as mock_session:
+            mock_client = mock_session.get_session.return_value.create_client.return_value
+            mock_client.get_parameters.side_effect = \
+                botocore.exceptions.ClientError({'Error': {'Code': 'AccessDenied'}}, 'GetParameters')
+            mock_client.get_parameter.side_effect = \
+                botocore.exceptions.ClientError({'Error': {'Code': 'AccessDenied'}}, 'GetParameter')
+            extension.prefetch(['val1'])
+            with self.assertRaises(ValueError) as cm_exc:
+                template.render()
+            self.assertEqual(str(cm_exc.exception), 'Failed to retrieve value "val1" from parameter store with error: AccessDenied')
+
+        self.assertEqual(environment.aws_parameter_store_values, {})
+
+    def test_filter(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        environment.filters['format_name'] = lambda service: f'/svc/{service}'
+        template = environment.from_string(
+            '''\
+{% set values = services|map('format_name')|aws_parameter_store -%}
+{% for service in services -%}
+{{service}} = {{values[loop.index0]}}
+{% endfor %}'''
+        )
+        with unittest_mock.patch('botocore.session') as mock_session:
+            mock_client = mock_session.get_session.return_value.create_client.return_value
+            mock_client.get_parameters.return_value = {
+                'Parameters': [{'Name': '/svc/a', 'Value': 'a-value'}],
+                'InvalidParameters': ['/svc/b', '/svc/c']
+            }
+            mock_client.get_parameter.side_effect = self._get_parameter
+            self.assertEqual(
+                template.render(services=['a', 'b', 'c']),
+                '''\
+a = a-value
+b = /svc/b-{value}
+c = /svc/c-{value}
+'''
+            )
+
+        self.assertEqual(
+            mock_client.get_parameters.call_args_list,
+            [
+                unittest_mock.call(Names=['/svc/a', '/svc/b', '/svc/c'], WithDecryption=True)
+            ]
+        )
+        self.assertEqual(
+            sorted(mock_client.get_parameter.call_args_list, key=lambda call: call.kwargs['Name']),
+            [
+                unittest_mock.call(Name='/svc/b', WithDecryption=True),
+                unittest_mock.call(Name='/svc/c', WithDecryption=True)
+            ]
+        )
+
+    def test_filter_empty(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        template = environment.from_string('{{ []|aws_parameter_store }}')
+        with unittest_mock.patch('botocore.session') as mock_session:
+            self.assertEqual(template.render(), '[]')
+        self.assertEqual(mock_session.get_session.call_args_list, [])
+
+    def test_concurrent(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        template = environment.from_string("{% aws_parameter_store 'val1' %}")
+
+        # The first call blocks until all threads are rendering
+        threads_started = threading.Event()
+
+        def get_parameter(**kwargs):
+            threads_started.wait(timeout=5)
+            return self._get_parameter(**kwargs)
+
+        results = []
+
+        def render():
+            results.append(template.render())
+
+        with unittest_mock.patch('botocore.session') as mock_session:
+            mock_client = mock_session.get_session.return_value.create_client.return_value
+            mock_client.get_parameter.side_effect = get_parameter
+            threads = [threading.Thread(target=render) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            threads_started.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, ['val1-{value}'] * 4)
+        self.assertEqual(mock_session.get_session.return_value.create_client.call_args_list, [unittest_mock.call('ssm')])
+        self.assertEqual(mock_client.get_parameter.call_args_list, [unittest_mock.call(Name='val1', WithDecryption=True)])
+
+    def test_concurrent_error(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        extension = environment.extensions[ParameterStoreExtension.identifier]
+        get_parameter_started = threading.Event()
+        get_parameter_continue = threading.Event()
+
+        def get_parameter(**kwargs):
+            get_parameter_started.set()
+            get_parameter_continue.wait(timeout=5)
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'SomeError'}}, 'GetParameter')
+
+        errors = []
+
+        def get_value():
+            try:
+                extension._get_parameter('val1') # pylint: disable=protected-access
+            except ValueError as exc:
+                errors.append(str(exc))
+
+        with unittest_mock.patch('botocore.session') as mock_session:
+            mock_client = mock_session.get_session.return_value.create_client.return_value
+            mock_client.get_parameter.side_effect = get_parameter
+            thread_owner = threading.Thread(target=get_value)
+            thread_owner.start()
+            get_parameter_started.wait(timeout=5)
+            thread_waiter = threading.Thread(target=get_value)
+            thread_waiter.start()
+            get_parameter_continue.set()
+            thread_owner.join()
+            thread_waiter.join()
+
+        self.assertEqual(errors, ['Failed to retrieve value "val1" from parameter store with error: SomeError'] * 2)
+        self.assertEqual(environment.aws_parameter_store_values, {})
+
+    def test_concurrent_retrieved(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        extension = environment.extensions[ParameterStoreExtension.identifier]
+
+        # Another thread retrieves the value before the lock is acquired
+        class RetrievedValues(dict):
+            __slots__ = ('checked',)
+
+            def __contains__(self, name):
+                checked = getattr(self, 'checked', False)
+                self.checked = True
+                return checked and super().__contains__(name)
+
+        environment.aws_parameter_store_values = RetrievedValues(val1='value1')
+        with unittest_mock.patch('botocore.session') as mock_session:
+            self.assertEqual(extension._get_parameter('val1'), 'value1') # pylint: disable=protected-access
+        self.assertEqual(mock_session.mock_calls, [])
+
+    def test_cache(self):
+        templates_source = '''\
+{% set val = 'val2' -%}
+val1 = {% aws_parameter_store 'val1' %}
+val2 = {% aws_parameter_store val %}
+'''
+        with TemporaryDirectory() as cache_dir:
+            for ix_run in range(2):
+                environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+                environment.aws_parameter_store_cache = ParameterStoreCache(cache_dir, 60)
+                extension = environment.extensions[ParameterStoreExtension.identifier]
+                template = environment.from_string(templates_source)
+                with unittest_mock.patch('botocore.session') as mock_session:
+                    mock_client = mock_session.get_session.return_value.create_client.return_value
+                    mock_client.get_parameters.return_value = {
+                        'Parameters': [{'Name': 'val1', 'Value': 'val1-{value}'}],
+                        'InvalidParameters': []
+                    }
+                    mock_client.get_parameter.side_effect = self._get_parameter
+                    extension.prefetch(['val1'])
+                    self.assertEqual(template.render(), 'val1 = val1-{value}\nval2 = val2-{value}')
+
+                # The second run uses the cached values
+                if ix_run == 0:
+                    self.assertEqual(len(mock_client.get_parameters.call_args_list), 1)
+                    self.assertEqual(len(mock_client.get_parameter.call_args_list), 1)
+                    self.assertEqual(environment.aws_parameter_store_cache.hits, 0)
+                    self.assertEqual(environment.aws_parameter_store_cache.misses, 2)
+                else:
+                    self.assertEqual(mock_client.mock_calls, [])
+                    self.assertEqual(environment.aws_parameter_store_cache.hits, 2)
+                    self.assertEqual(environment.aws_parameter_store_cache.misses, 0)
+
+    def test_cache_get_set(self):
+        with TemporaryDirectory() as temp_dir:
+            cache_dir = os.path.join(temp_dir, 'cache')
+            cache = ParameterStoreCache(cache_dir, 60)
+            if os.name == 'posix':
+                self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o700)
+            self.assertIsNone(cache.get('val1'))
+            cache.set('val1', 'value1')
+            self.assertEqual(cache.get('val1'), 'value1')
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            cache_files = os.listdir(cache_dir)
+            self.assertEqual(len(cache_files), 1)
+            if os.name == 'posix':
+                self.assertEqual(os.stat(os.path.join(cache_dir, cache_files[0])).st_mode & 0o777, 0o600)
+
+            # Refresh
+            cache_refresh = ParameterStoreCache(cache_dir, 60, refresh=True)
+            self.assertIsNone(cache_refresh.get('val1'))
+            cache_refresh.set('val1', 'value2')
+            self.assertEqual(cache.get('val1'), 'value2')
+
+            # Expired
+            with unittest_mock.patch('time.time', return_value=time.time() + 61):
+                self.assertIsNone(cache.get('val1'))
+
+            # Invalid cache file
+            with open(os.path.join(cache_dir, cache_files[0]), 'w', encoding='utf-8') as f_cache:
+                f_cache.write('invalid')
+            self.assertIsNone(cache.get('val1'))
+
+            # The temporary cache file is removed on error
+            with self.assertRaises(TypeError):
+                cache.set('val2', object())
+            self.assertEqual(os.listdir(cache_dir), cache_files)
+
+            # Cache write errors are ignored
+            shutil.rmtree(cache_dir)
+            with open(cache_dir, 'w', encoding='utf-8') as f_cache:
+                f_cache.write('not a directory')
+            cache.set('val1', 'value1')
+            self.assertIsNone(cache.get('val1'))
+
+            # The cache directory path is not a directory
+            with self.assertRaises(NotADirectoryError) as cm_exc:
+                ParameterStoreCache(cache_dir, 60)
+            self.assertEqual(str(cm_exc.exception), f'[Errno {errno.ENOTDIR}] {os.strerror(errno.ENOTDIR)}: {cache_dir!r}')
+
+    def test_cache_profile_region(self):
+        with TemporaryDirectory() as cache_dir:
+            os.chmod(cache_dir, 0o755)
+            for environ, value in (
+                ({}, 'value1'),
+                ({'AWS_PROFILE': 'prod'}, 'value2'),
+                ({'AWS_REGION': 'us-west-2'}, 'value3'),
+                ({'AWS_DEFAULT_REGION': 'us-west-2'}, 'value3'),
+                ({'AWS_PROFILE': 'prod', 'AWS_DEFAULT_REGION': 'us-west-2'}, 'value4')
+            ):
+                with unittest_mock.patch.dict('os.environ', environ):
+                    for name in ('AWS_PROFILE', 'AWS_REGION', 'AWS_DEFAULT_REGION'):
+                        if name not in environ:
+                            os.environ.pop(name, None)
+                    cache = ParameterStoreCache(cache_dir, 60)
+                    if cache.get('val1') is None:
+                        cache.set('val1', value)
+                    self.assertEqual(cache.get('val1'), value)
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+
+            # An existing cache directory's mode is unchanged
+            if os.name == 'posix':
+                self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o755)
+
+    @staticmethod
+    def _create_stubbed_client():
+        client = botocore.session.get_session().create_client(
+            'ssm', region_name='us-east-1', aws_access_key_id='test-key', aws_secret_access_key='test-secret'
+        )
+        return client, botocore.stub.Stubber(client)
+
+    def test_client_config(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        environment.aws_parameter_store_client_config = {
+            'retries': {'mode': 'adaptive', 'total_max_attempts': 3}, 'max_pool_connections': 20, 'connect_timeout': 2.5
+        }
+        template = environment.from_string("{% aws_parameter_store 'val1' %}")
+        with unittest_mock.patch('botocore.session') as mock_session:
+            mock_session.get_session.return_value.create_client.return_value.get_parameter.side_effect = self._get_parameter
+            self.assertEqual(template.render(), 'val1-{value}')
+
+        create_client_args = mock_session.get_session.return_value.create_client.call_args
+        self.assertEqual(create_client_args.args, ('ssm',))
+        self.assertEqual(create_client_args.kwargs['config'].retries, {'mode': 'adaptive', 'total_max_attempts': 3})
+        self.assertEqual(create_client_args.kwargs['config'].max_pool_connections, 20)
+        self.assertEqual(create_client_args.kwargs['config'].connect_timeout, 2.5)
+
+    def test_client_retries(self):
+        # Throttled requests are attempted at most "total_max_attempts" times - the standard retry mode counts attempts the
+        # same as the adaptive retry mode, without its client-side rate limiting
+        attempts = []
+
+        def before_send(request, **_kwargs):
+            attempts.append(request)
+            raw = unittest_mock.Mock(**{'stream.return_value': [b'{"__type": "ThrottlingException"}']})
+            return botocore.awsrequest.AWSResponse(request.url, 400, {}, raw)
+
+        session = botocore.session.get_session()
+        session.register('before-send.ssm', before_send)
+        for total_max_attempts in (1, 3):
+            attempts.clear()
+            environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+            environment.aws_parameter_store_client_config = {'retries': {'mode': 'standard', 'total_max_attempts': total_max_attempts}}
+            template = environment.from_string("{% aws_parameter_store 'val1' %}")
+            with unittest_mock.patch('botocore.session.get_session', return_value=session), \
+                 unittest_mock.patch.dict('os.environ', {
+                     'AWS_ACCESS_KEY_ID': 'test-key', 'AWS_SECRET_ACCESS_KEY': 'test-secret', 'AWS_DEFAULT_REGION': 'us-east-1'
+                 }), \
+                 unittest_mock.patch('time.sleep'):
+                with self.assertRaises(ValueError) as cm_exc:
+                    template.render()
+            self.assertEqual(
+                str(cm_exc.exception), 'Failed to retrieve value "val1" from parameter store with error: ThrottlingException'
+            )
+            self.assertEqual(len(attempts), total_max_attempts)
+
+    def test_get_parameters_by_path(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        extension = environment.extensions[ParameterStoreExtension.identifier]
+        client, stubber = self._create_stubbed_client()
+        environment.aws_parameter_store_client = client
+        expected_params = {'Path': '/svc/prod', 'Recursive': True, 'WithDecryption': True}
+        stubber.add_response('get_parameters_by_path', {
+            'Parameters': [
+                {'Name': '/svc/prod/db/host', 'Value': 'db-host'},
+                {'Name': '/svc/prod/name', 'Value': 'my-service'}
+            ],
+            'NextToken': 'token1'
+        }, expected_params)
+        stubber.add_response('get_parameters_by_path', {
+            'Parameters': [
+                {'Name': '/svc/prod/db/port', 'Value': '5432'}
+            ]
+        }, {**expected_params, 'NextToken': 'token1'})
+        with stubber:
+            self.assertEqual(extension.get_parameters_by_path('/svc/prod'), {
+                'db': {'host': 'db-host', 'port': '5432'},
+                'name': 'my-service'
+            })
+            stubber.assert_no_pending_responses()
+
+        # The values are available to the aws_parameter_store tag
+        template = environment.from_string("{% aws_parameter_store '/svc/prod/db/host' %}")
+        self.assertEqual(template.render(), 'db-host')
+
+    def test_get_parameters_by_path_cache(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        extension = environment.extensions[ParameterStoreExtension.identifier]
+        client, stubber = self._create_stubbed_client()
+        environment.aws_parameter_store_client = client
+        stubber.add_response('get_parameters_by_path', {
+            'Parameters': [
+                {'Name': '/svc/prod/db/host', 'Value': 'db-host'},
+                {'Name': '/svc/prod/db', 'Value': 'db'}
+            ]
+        }, {'Path': '/svc/prod', 'Recursive': True, 'WithDecryption': True})
+        with TemporaryDirectory() as cache_dir:
+            environment.aws_parameter_store_cache = ParameterStoreCache(cache_dir, 60)
+            with stubber:
+                # A parameter value doesn't replace a nested path's dict
+                self.assertEqual(extension.get_parameters_by_path('/svc/prod'), {'db': {'host': 'db-host'}})
+                stubber.assert_no_pending_responses()
+
+            # The values are cached
+            cache = ParameterStoreCache(cache_dir, 60)
+            self.assertEqual(cache.get('/svc/prod/db/host'), 'db-host')
+            self.assertEqual(cache.get('/svc/prod/db'), 'db')
+
+    def test_get_parameters_by_path_error(self):
+        environment = Environment(extensions=[ParameterStoreExtension], undefined=StrictUndefined)
+        extension = environment.extensions[ParameterStoreExtension.identifier]
+        client, stubber = self._create_stubbed_client()
+        environment.aws_parameter_store_client = client
+        stubber.add_client_error('get_parameters_by_path', service_error_code='AccessDeniedException')
+        with stubber:
+            with self.assertRaises(ValueError) as cm_exc:
+                extension.get_parameters_by_path('/svc/prod')
+
+        self.assertEqual(
+            str(cm_exc.exception),
+            'Failed to retrieve path "/svc/prod" from parameter store with error: AccessDeniedException'
+        )
+
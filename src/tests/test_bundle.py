@@ -0,0 +1,143 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+import json
+import os
+from tempfile import TemporaryDirectory
+import unittest
+import zipfile
+
+import jinja2
+from template_specialize.bundle import BUNDLE_MANIFEST_NAME, BundleLoader, compile_bundle, is_bundle_file, load_bundle
+from template_specialize.main import Specializer, TEMPLATE_SPECIALIZE_RENAME
+
+
+def write_files(path, files):
+    for name, content in files.items():
+        file_path = os.path.join(path, *name.split('/'))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as file_:
+            file_.write(content)
+
+
+class TestBundle(unittest.TestCase):
+
+    def test_bundle(self):
+        with TemporaryDirectory() as temp_dir:
+            template_dir = os.path.join(temp_dir, 'template')
+            write_files(template_dir, {
+                'a.txt': b'a {{ a }} {% include "subdir/inc.txt" %}',
+                'subdir/inc.txt': b'inc{% template_specialize_rename "x.txt" %}',
+                'other.txt': b'{{ other }}',
+                'raw.css': b'{{ raw'
+            })
+            bundle_path = os.path.join(temp_dir, 'bundle', 'templates.zip')
+            environment = Specializer.create_environment([template_dir])
+            compile_bundle(
+                environment, bundle_path, ['a.txt', 'subdir/inc.txt'], {'raw.css': os.path.join(template_dir, 'raw.css')},
+                {'files': ['a.txt', 'raw.css']}
+            )
+            self.assertEqual(sorted(os.listdir(os.path.dirname(bundle_path))), ['templates.zip'])
+            self.assertTrue(is_bundle_file(bundle_path))
+            self.assertEqual(load_bundle(bundle_path), {'version': 1, 'jinja2': jinja2.__version__, 'files': ['a.txt', 'raw.css']})
+            with zipfile.ZipFile(bundle_path) as bundle:
+                self.assertEqual(bundle.read('raw.css'), b'{{ raw')
+                self.assertEqual(len(bundle.namelist()), 4)
+
+            # Render from the compiled template modules
+            bundle_environment = Specializer.create_environment([bundle_path])
+            self.assertIsInstance(bundle_environment.loader, BundleLoader)
+            renames = []
+            renames_token = TEMPLATE_SPECIALIZE_RENAME.set(renames)
+            try:
+                self.assertEqual(bundle_environment.get_template('a.txt').render(a=1), 'a 1 inc')
+            finally:
+                TEMPLATE_SPECIALIZE_RENAME.reset(renames_token)
+            self.assertEqual(renames, [('x.txt', None)])
+            with self.assertRaises(jinja2.TemplateNotFound):
+                bundle_environment.get_template('other.txt')
+
+            # Re-compile - the changed bundle's templates are re-loaded
+            write_files(template_dir, {'a.txt': b'A {{ a }}!'})
+            compile_bundle(environment, bundle_path, ['a.txt'], {}, {})
+            self.assertEqual(bundle_environment.get_template('a.txt').render(a=2), 'A 2!')
+
+    def test_bundle_relative(self):
+        with TemporaryDirectory() as temp_dir:
+            template_dir = os.path.join(temp_dir, 'template')
+            write_files(template_dir, {'a.txt': b'a {{ a }}'})
+            environment = Specializer.create_environment([template_dir])
+            cwd = os.getcwd()
+            try:
+                os.chdir(temp_dir)
+                compile_bundle(environment, 'templates.zip', ['a.txt'], {'b.css': b'{{ b'}, {})
+            finally:
+                os.chdir(cwd)
+            bundle_path = os.path.join(temp_dir, 'templates.zip')
+            with zipfile.ZipFile(bundle_path) as bundle:
+                self.assertEqual(bundle.read('b.css'), b'{{ b')
+
+            # Templates of a removed bundle are not up-to-date
+            template = Specializer.create_environment([bundle_path]).get_template('a.txt')
+            self.assertEqual(template.render(a=1), 'a 1')
+            self.assertTrue(template.is_up_to_date)
+            os.unlink(bundle_path)
+            self.assertFalse(template.is_up_to_date)
+
+    def test_bundle_all_templates(self):
+        with TemporaryDirectory() as temp_dir:
+            template_dir = os.path.join(temp_dir, 'template')
+            write_files(template_dir, {
+                'a.txt': b'{% include name %}',
+                'b.txt': b'b',
+                'error.txt': b'{{ error',
+                'binary.bin': b'\xff\xfe'
+            })
+            bundle_path = os.path.join(temp_dir, 'templates.zip')
+            compile_bundle(Specializer.create_environment([template_dir]), bundle_path, ['a.txt'], {}, {}, all_templates=True)
+            bundle_environment = Specializer.create_environment([bundle_path])
+            self.assertEqual(bundle_environment.get_template('a.txt').render(name='b.txt'), 'b')
+            for name in ('error.txt', 'binary.bin'):
+                with self.assertRaises(jinja2.TemplateNotFound):
+                    bundle_environment.get_template(name)
+
+    def test_bundle_errors(self):
+        with TemporaryDirectory() as temp_dir:
+            template_dir = os.path.join(temp_dir, 'template')
+            write_files(template_dir, {'a.txt': b'{{ error'})
+            environment = Specializer.create_environment([template_dir])
+            bundle_path = os.path.join(temp_dir, 'templates.zip')
+
+            with self.assertRaises(jinja2.TemplateSyntaxError):
+                compile_bundle(environment, bundle_path, ['a.txt'], {}, {})
+            with self.assertRaises(ValueError) as cm_exc:
+                compile_bundle(environment, bundle_path, [], {BUNDLE_MANIFEST_NAME: b''}, {})
+            self.assertEqual(str(cm_exc.exception), f'file name conflicts with the bundle manifest: {BUNDLE_MANIFEST_NAME!r}')
+            self.assertEqual(os.listdir(temp_dir), ['template'])
+
+            # Not bundles
+            self.assertFalse(is_bundle_file(template_dir))
+            self.assertFalse(is_bundle_file(os.path.join(template_dir, 'a.txt')))
+            self.assertFalse(is_bundle_file(bundle_path))
+            with open(bundle_path, 'wb') as bundle_file:
+                bundle_file.write(b'not a zip file')
+            self.assertFalse(is_bundle_file(bundle_path))
+            with zipfile.ZipFile(bundle_path, 'w') as bundle:
+                bundle.writestr('a.txt', 'a')
+            self.assertFalse(is_bundle_file(bundle_path))
+            with self.assertRaises(ValueError) as cm_exc:
+                load_bundle(bundle_path)
+            self.assertEqual(str(cm_exc.exception), f'invalid bundle {bundle_path!r}: no manifest')
+
+            # Unsupported bundles
+            for manifest, message in (
+                ({'version': 2, 'jinja2': jinja2.__version__}, f'invalid bundle {bundle_path!r}: unsupported version'),
+                ({'version': 1, 'jinja2': '1.0'},
+                 f'bundle {bundle_path!r} was compiled with Jinja2 1.0, not Jinja2 {jinja2.__version__}')
+            ):
+                with zipfile.ZipFile(bundle_path, 'w') as bundle:
+                    bundle.writestr(BUNDLE_MANIFEST_NAME, json.dumps(manifest))
+                self.assertTrue(is_bundle_file(bundle_path))
+                with self.assertRaises(ValueError) as cm_exc:
+                    load_bundle(bundle_path)
+                self.assertEqual(str(cm_exc.exception), message)
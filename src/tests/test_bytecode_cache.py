@@ -0,0 +1,86 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+import os
+from tempfile import TemporaryDirectory
+import time
+import unittest
+
+from jinja2 import DictLoader, Environment
+from template_specialize.bytecode_cache import TemplateBytecodeCache
+from template_specialize.main import TemplateSpecializeRenameExtension
+
+
+class TestTemplateBytecodeCache(unittest.TestCase):
+
+    def test_bytecode_cache(self):
+        templates = {'template.txt': 'Hello, {{name}}!'}
+        with TemporaryDirectory() as cache_dir:
+            environment = Environment(loader=DictLoader(templates), bytecode_cache=TemplateBytecodeCache(cache_dir))
+            self.assertEqual(environment.get_template('template.txt').render(name='Roy'), 'Hello, Roy!')
+            cache_files = os.listdir(cache_dir)
+            self.assertEqual(len(cache_files), 1)
+            self.assertTrue(cache_files[0].startswith('template-specialize-'))
+            self.assertTrue(cache_files[0].endswith('.cache'))
+
+            # A new environment loads the compiled template from the cache
+            environment = Environment(loader=DictLoader(templates), bytecode_cache=TemplateBytecodeCache(cache_dir))
+            environment.compile = None
+            self.assertEqual(environment.get_template('template.txt').render(name='Roy'), 'Hello, Roy!')
+            self.assertEqual(os.listdir(cache_dir), cache_files)
+
+            # A different extension set is cached separately
+            environment = Environment(
+                loader=DictLoader(templates),
+                extensions=[TemplateSpecializeRenameExtension],
+                bytecode_cache=TemplateBytecodeCache(cache_dir)
+            )
+            self.assertEqual(environment.get_template('template.txt').render(name='Roy'), 'Hello, Roy!')
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            # A changed template source is re-compiled
+            templates['template.txt'] = 'Goodbye, {{name}}!'
+            environment = Environment(loader=DictLoader(templates), bytecode_cache=TemplateBytecodeCache(cache_dir))
+            self.assertEqual(environment.get_template('template.txt').render(name='Roy'), 'Goodbye, Roy!')
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_bytecode_cache_create_directory(self):
+        with TemporaryDirectory() as temp_dir:
+            cache_dir = os.path.join(temp_dir, 'sub', 'cache')
+            TemplateBytecodeCache(cache_dir)
+            self.assertTrue(os.path.isdir(cache_dir))
+
+    def test_prune(self):
+        templates = {f'template{ix}.txt': f'Hello {ix}, {{{{name}}}}!' for ix in range(3)}
+        with TemporaryDirectory() as cache_dir:
+            bytecode_cache = TemplateBytecodeCache(cache_dir)
+            environment = Environment(loader=DictLoader(templates), bytecode_cache=bytecode_cache)
+            for name in sorted(templates):
+                environment.get_template(name)
+            cache_paths = sorted((os.path.join(cache_dir, name) for name in os.listdir(cache_dir)))
+            self.assertEqual(len(cache_paths), 3)
+
+            # Age the cache files
+            now = time.time()
+            for ix, cache_path in enumerate(cache_paths):
+                os.utime(cache_path, (now - ix * 100, now - ix * 100))
+
+            # Nothing to prune
+            bytecode_cache.prune()
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+            # Prune by age
+            bytecode_cache.prune(max_age=150)
+            self.assertEqual(sorted(os.path.join(cache_dir, name) for name in os.listdir(cache_dir)), cache_paths[:2])
+
+            # Prune by size - least-recently-used first
+            bytecode_cache.prune(max_size=os.path.getsize(cache_paths[0]))
+            self.assertEqual(sorted(os.path.join(cache_dir, name) for name in os.listdir(cache_dir)), cache_paths[:1])
+
+            # Non-cache files are ignored
+            other_path = os.path.join(cache_dir, 'other.txt')
+            with open(other_path, 'w', encoding='utf-8') as f_other:
+                f_other.write('other')
+            os.utime(other_path, (now - 1000, now - 1000))
+            bytecode_cache.prune(max_age=0, max_size=0)
+            self.assertEqual(os.listdir(cache_dir), ['other.txt'])
@@ -0,0 +1,170 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+import os
+from tempfile import TemporaryDirectory
+import unittest
+import unittest.mock as unittest_mock
+
+from jinja2 import DictLoader, Environment, FileSystemLoader, TemplateNotFound
+from template_specialize.aws_parameter_store import ParameterStoreExtension
+from template_specialize.dependencies import TemplateDependencyIndex
+
+
+class TestTemplateDependencyIndex(unittest.TestCase):
+
+    def test_dependencies(self):
+        environment = Environment(loader=DictLoader({
+            'a.txt': '{% extends "base.txt" %}{% block body %}{% include "inc.txt" %}{% endblock %}',
+            'base.txt': '{% import "macros.txt" as macros %}{% block body %}{% endblock %}',
+            'inc.txt': 'inc',
+            'macros.txt': '{% macro foo() %}foo{% endmacro %}',
+            'dynamic.txt': '{% include name %}',
+            'missing.txt': '{% include "unknown.txt" %}',
+            'cycle.txt': '{% if false %}{% include "cycle.txt" %}{% endif %}'
+        }))
+        index = TemplateDependencyIndex(environment)
+        self.assertEqual(index.references('a.txt'), ['base.txt', 'inc.txt'])
+        self.assertEqual(index.references('dynamic.txt'), [None])
+        self.assertEqual(index.dependencies('a.txt'), {'a.txt', 'base.txt', 'inc.txt', 'macros.txt'})
+        self.assertEqual(index.dependencies('inc.txt'), {'inc.txt'})
+        self.assertEqual(index.dependencies('cycle.txt'), {'cycle.txt'})
+        self.assertIsNone(index.dependencies('dynamic.txt'))
+        self.assertIsNone(index.dependencies('missing.txt'))
+        with self.assertRaises(TemplateNotFound):
+            index.references('unknown.txt')
+
+        # Variables read by the template and its dependencies
+        environment.loader.mapping['inc.txt'] = '{% for item in items %}{{item}}{{sep}}{% endfor %}'
+        self.assertEqual(index.variables('a.txt'), {'items', 'sep'})
+        self.assertEqual(index.variables('macros.txt'), set())
+        self.assertIsNone(index.variables('dynamic.txt'))
+
+        # The template hash changes when any dependency changes
+        a_hash = index.template_hash('a.txt')
+        self.assertEqual(len(a_hash), 64)
+        self.assertEqual(index.template_hash('a.txt'), a_hash)
+        self.assertNotEqual(index.template_hash('inc.txt'), a_hash)
+        self.assertIsNone(index.template_hash('dynamic.txt'))
+        environment.loader.mapping['macros.txt'] = '{% macro foo() %}bar{% endmacro %}'
+        self.assertNotEqual(index.template_hash('a.txt'), a_hash)
+
+        # Literal aws_parameter_store names
+        self.assertEqual(index.parameter_names('a.txt'), [])
+        with self.assertRaises(TemplateNotFound):
+            index.parameter_names('unknown.txt')
+
+        # Saving an index without a cache directory does nothing
+        index.save()
+        self.assertIsNone(index.path)
+
+    def test_parameter_names(self):
+        environment = Environment(extensions=[ParameterStoreExtension], loader=DictLoader({
+            'a.txt': "{% aws_parameter_store 'a' %}{% aws_parameter_store name %}{% include 'b.txt' %}",
+            'b.txt': "{% aws_parameter_store 'b' %}"
+        }))
+        index = TemplateDependencyIndex(environment)
+        self.assertEqual(index.parameter_names('a.txt'), ['a'])
+        self.assertEqual(index.parameter_names('b.txt'), ['b'])
+
+    def test_uses_parameter_store(self):
+        environment = Environment(extensions=[ParameterStoreExtension], loader=DictLoader({
+            'tag.txt': '{% aws_parameter_store name %}',
+            'filter.txt': '{{ names|aws_parameter_store }}',
+            'map.txt': "{{ names|map('aws_parameter_store')|list }}",
+            'include.txt': '{% include "tag.txt" %}',
+            'static.txt': '{{ aws_parameter_store }}',
+            'dynamic.txt': '{% include name %}'
+        }))
+        index = TemplateDependencyIndex(environment)
+        for name in ('tag.txt', 'filter.txt', 'map.txt', 'include.txt'):
+            self.assertIs(index.uses_parameter_store(name), True)
+        self.assertIs(index.uses_parameter_store('static.txt'), False)
+        self.assertIsNone(index.uses_parameter_store('dynamic.txt'))
+
+    def test_variables_parse(self):
+        environment = Environment(loader=DictLoader({
+            'a.txt': '{{ a }}{% include "b.txt" %}',
+            'b.txt': '{{ b }}'
+        }))
+        index = TemplateDependencyIndex(environment)
+
+        # Variables are found only when requested - templates are parsed again to find them
+        with unittest_mock.patch.object(environment, 'parse', wraps=environment.parse) as mock_parse:
+            self.assertEqual(index.dependencies('a.txt'), {'a.txt', 'b.txt'})
+            self.assertEqual(mock_parse.call_count, 2)
+            self.assertEqual(index.variables('a.txt'), {'a', 'b'})
+            self.assertEqual(mock_parse.call_count, 4)
+            self.assertEqual(index.variables('a.txt'), {'a', 'b'})
+            self.assertEqual(index.template_hash('a.txt'), index.template_hash('a.txt'))
+            self.assertEqual(mock_parse.call_count, 4)
+
+        # Variables requested first - templates are parsed once
+        index = TemplateDependencyIndex(environment)
+        with unittest_mock.patch.object(environment, 'parse', wraps=environment.parse) as mock_parse:
+            self.assertEqual(index.variables('a.txt'), {'a', 'b'})
+            self.assertEqual(index.dependencies('a.txt'), {'a.txt', 'b.txt'})
+            self.assertEqual(mock_parse.call_count, 2)
+
+    def test_cache_dir(self):
+        with TemporaryDirectory() as temp_dir:
+            template_dir = os.path.join(temp_dir, 'template')
+            cache_dir = os.path.join(temp_dir, 'cache')
+            os.mkdir(template_dir)
+            os.mkdir(cache_dir)
+            a_path = os.path.join(template_dir, 'a.txt')
+            with open(a_path, 'w', encoding='utf-8') as f_template:
+                f_template.write('{% include "b.txt" %}')
+            with open(os.path.join(template_dir, 'b.txt'), 'w', encoding='utf-8') as f_template:
+                f_template.write('b')
+            environment = Environment(loader=FileSystemLoader(template_dir))
+
+            # Build and save the index
+            index = TemplateDependencyIndex(environment, cache_dir)
+            self.assertEqual(index.dependencies('a.txt'), {'a.txt', 'b.txt'})
+            for name in ('missing.txt', '../a.txt'):
+                with self.assertRaises(TemplateNotFound):
+                    index.references(name)
+            index.save()
+            self.assertEqual(os.listdir(cache_dir), [os.path.basename(index.path)])
+            self.assertTrue(os.path.basename(index.path).startswith('template-specialize-deps-'))
+
+            # A new index loads the saved index - unchanged templates are not parsed
+            with unittest_mock.patch.object(environment, 'parse') as mock_parse:
+                index = TemplateDependencyIndex(environment, cache_dir)
+                self.assertEqual(index.dependencies('a.txt'), {'a.txt', 'b.txt'})
+
+                # Modified time change with unchanged source
+                a_stat = os.stat(a_path)
+                os.utime(a_path, ns=(a_stat.st_atime_ns, a_stat.st_mtime_ns + 1000000000))
+                self.assertEqual(index.dependencies('a.txt'), {'a.txt', 'b.txt'})
+            self.assertEqual(mock_parse.call_count, 0)
+
+            # Source change
+            with open(a_path, 'w', encoding='utf-8') as f_template:
+                f_template.write('a')
+            os.utime(a_path, ns=(a_stat.st_atime_ns, a_stat.st_mtime_ns + 2000000000))
+            self.assertEqual(index.dependencies('a.txt'), {'a.txt'})
+
+            # An index file path - the index is re-used only with the same search paths and extensions
+            index_path = os.path.join(temp_dir, 'index.json')
+            index = TemplateDependencyIndex(environment, path=index_path)
+            self.assertEqual(index.dependencies('a.txt'), {'a.txt'})
+            index.save()
+            with unittest_mock.patch.object(environment, 'parse') as mock_parse:
+                index = TemplateDependencyIndex(environment, path=index_path)
+                self.assertEqual(index.dependencies('a.txt'), {'a.txt'})
+            self.assertEqual(mock_parse.call_count, 0)
+            other_environment = Environment(loader=FileSystemLoader([template_dir, cache_dir]))
+            with unittest_mock.patch.object(other_environment, 'parse', wraps=other_environment.parse) as mock_parse:
+                index = TemplateDependencyIndex(other_environment, path=index_path)
+                self.assertEqual(index.dependencies('a.txt'), {'a.txt'})
+            self.assertEqual(mock_parse.call_count, 1)
+
+            # Invalid index file
+            index = TemplateDependencyIndex(environment, cache_dir)
+            index.save()
+            with open(index.path, 'w', encoding='utf-8') as f_index:
+                f_index.write('invalid')
+            index = TemplateDependencyIndex(environment, cache_dir)
+            self.assertEqual(index.dependencies('a.txt'), {'a.txt'})
@@ -3,17 +3,30 @@
 
 from contextlib import contextmanager
 import datetime
-from io import StringIO
+import errno
+from io import BytesIO, StringIO, TextIOWrapper
+from itertools import chain
+import json
 import os
 import platform
+import pstats
+import shutil
+import subprocess
 import sys
+import tarfile
 from tempfile import TemporaryDirectory
+import time
 import unittest
 import unittest.mock as unittest_mock
+import zipfile
 
 import botocore.exceptions
+import botocore.session
+import jinja2
 import template_specialize.__main__
-from template_specialize.main import main, _parse_environments, _merge_environment, _merge_values
+from template_specialize.hooks import SpecializerHooks
+from template_specialize.main import Specializer, TemplateSpecializeEnvironment, main, _parse_environments, _merge_environment, \
+    _merge_values, _scan_templates
 
 
 # Helper context manager to create a list of files in a temporary directory
@@ -50,6 +63,26 @@ class TestMain(unittest.TestCase):
     def test_module_main(self):
         self.assertTrue(template_specialize.__main__)
 
+    def test_import_time(self):
+        # Slow-to-import modules that are only needed by some runs must not be imported at startup
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import template_specialize.main'],
+            capture_output=True, check=True, encoding='utf-8'
+        )
+        module_names = {
+            line.split('|')[-1].strip() for line in result.stderr.splitlines()
+            if line.startswith('import time:') and not line.endswith('imported package')
+        }
+        self.assertIn('template_specialize.main', module_names)
+        self.assertEqual(
+            sorted(
+                module_name for module_name in module_names
+                if module_name.split('.')[0] in ('botocore', 'urllib3') or
+                module_name in ('concurrent.futures', 'socket', 'template_specialize.serve', 'traceback')
+            ),
+            []
+        )
+
     def test_sys_argv(self):
         test_files = [
             ('template.txt', 'the value of "foo" is "{{foo}}"')
@@ -363,6 +396,437 @@ unknown environment 'unknown'
 '''
                 )
 
+    def test_environment_matrix(self):
+        test_files = [
+            (
+                'config.config',
+                '''\
+{
+    "base": {
+        "values": {
+            "name": "base"
+        }
+    },
+    "env_test": {
+        "parents": ["base"],
+        "values": {
+            "host": "test-host"
+        }
+    },
+    "env_live": {
+        "parents": ["base"],
+        "values": {
+            "host": "live-host"
+        }
+    },
+    "other": {
+        "values": {
+            "name": "other",
+            "host": "other-host"
+        }
+    }
+}
+'''
+            ),
+            (('template', 'template.txt'), '{{name}} host is "{{host}}"'),
+            (('template', 'subdir', 'subtemplate.txt'), '{{host}} {{foo}}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            config_path = os.path.join(input_dir, 'config.config')
+            template_path = os.path.join(input_dir, 'template')
+            output_pattern = os.path.join(output_dir, 'out-{env}')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([template_path, output_pattern, '-c', config_path, '-e', 'env_*', '-e', 'other', '-k', 'foo', 'bar'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(sorted(os.listdir(output_dir)), ['out-env_live', 'out-env_test', 'out-other'])
+            for environment_name, name, host in (
+                    ('env_test', 'base', 'test-host'),
+                    ('env_live', 'base', 'live-host'),
+                    ('other', 'other', 'other-host')
+            ):
+                environment_output_dir = os.path.join(output_dir, f'out-{environment_name}')
+                with open(os.path.join(environment_output_dir, 'template.txt'), 'r', encoding='utf-8') as f_output:
+                    self.assertEqual(f_output.read(), f'{name} host is "{host}"')
+                with open(os.path.join(environment_output_dir, 'subdir', 'subtemplate.txt'), 'r', encoding='utf-8') as f_output:
+                    self.assertEqual(f_output.read(), f'{host} bar')
+
+    def test_environment_matrix_file(self):
+        test_files = [
+            (
+                'config.config',
+                '''\
+{
+    "env1": {"values": {"host": "host1"}},
+    "env2": {"values": {"host": "host2"}}
+}
+'''
+            ),
+            ('template.txt', 'host is "{{host}}"')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            config_path = os.path.join(input_dir, 'config.config')
+            input_path = os.path.join(input_dir, 'template.txt')
+            output_pattern = os.path.join(output_dir, '{env}.txt')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_path, output_pattern, '-c', config_path, '-e', 'env?', '-j', '2'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(sorted(os.listdir(output_dir)), ['env1.txt', 'env2.txt'])
+            with open(os.path.join(output_dir, 'env1.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'host is "host1"')
+            with open(os.path.join(output_dir, 'env2.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'host is "host2"')
+
+    def test_environment_matrix_dump(self):
+        test_files = [
+            (
+                'config.config',
+                '''\
+{
+    "env1": {"values": {"host": "host1"}},
+    "env2": {"values": {"host": "host2"}}
+}
+'''
+            )
+        ]
+        with create_test_files(test_files) as input_dir:
+            config_path = os.path.join(input_dir, 'config.config')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main.datetime.datetime', MockDateTime):
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main(['src.txt', 'dst.txt', '-c', config_path, '-e', 'env*', '--dump'])
+
+            self.assertEqual(cm_exc.exception.code, 0)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '''\
+{
+    "env1": {
+        "host": "host1",
+        "now": "2017-12-01T07:33:00"
+    },
+    "env2": {
+        "host": "host2",
+        "now": "2017-12-01T07:33:00"
+    }
+}
+''')
+
+    def test_environment_matrix_errors(self):
+        test_files = [
+            (
+                'config.config',
+                '''\
+{
+    "env1": {"values": {"host": "host1"}},
+    "env2": {"values": {"host": "host2"}}
+}
+'''
+            )
+        ]
+        with create_test_files(test_files) as input_dir:
+            config_path = os.path.join(input_dir, 'config.config')
+            for argv, message in (
+                    (['-c', config_path, '-e', 'env*', 'src.txt', 'dst.txt'],
+                     "multiple environments require a destination path containing '{env}'\n"),
+                    (['-c', config_path, '-e', 'env1', '-e', 'env2', 'src.txt', 'dst.txt'],
+                     "multiple environments require a destination path containing '{env}'\n"),
+                    (['-c', config_path, '-e', 'unknown*', 'src.txt', '{env}.txt'],
+                     "no environments match 'unknown*'\n")
+            ):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    with self.assertRaises(SystemExit) as cm_exc:
+                        main(argv)
+
+                self.assertEqual(cm_exc.exception.code, 2)
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), message)
+
+    def test_missing_src_dst(self):
+        for argv, message in (
+            ([], 'the following arguments are required: SRC, DST'),
+            (['template.txt'], 'the following arguments are required: DST'),
+            (['--deps'], 'the following arguments are required: SRC'),
+            (['--serve', 'test.sock', 'template.txt'], 'argument --serve: not allowed with SRC and DST')
+        ):
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main(argv)
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertTrue(stderr.getvalue().endswith(f'template-specialize: error: {message}\n'))
+
+    def test_specializer(self):
+        test_files = [
+            (('template', 'a.txt'), '{% include "inc.txt" %}{{a}}{% template_specialize_rename "b.txt", "c.txt" %}'),
+            (('template', 'b.txt'), '{{b}}'),
+            (('include', 'inc.txt'), '{{env}}-'),
+            ('environments.json', '{"test": {"values": {"env": "test", "a": 1, "b": 2}}}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            environments = Specializer.load_environments([os.path.join(input_dir, 'environments.json')])
+            specializer = Specializer(
+                os.path.join(input_dir, 'template'), environments=environments, searchpaths=[os.path.join(input_dir, 'include')]
+            )
+            self.assertEqual(specializer.variables('test', {'b': 3})['b'], 3)
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout:
+                specializer.render(os.path.join(output_dir, 'test'), 'test', {'a': 'A'})
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(sorted(os.listdir(os.path.join(output_dir, 'test'))), ['a.txt', 'c.txt'])
+            with open(os.path.join(output_dir, 'test', 'a.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'test-A')
+            with open(os.path.join(output_dir, 'test', 'c.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), '2')
+
+            # Re-use the template environment for a template file
+            specializer_file = Specializer(
+                os.path.join(input_dir, 'template', 'b.txt'), environment=specializer.environment, environments=environments
+            )
+            specializer_file.render(os.path.join(output_dir, 'b.txt'), variables={'b': 'B'})
+            with open(os.path.join(output_dir, 'b.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'B')
+
+            # Errors
+            with self.assertRaises(ValueError) as cm_exc:
+                specializer.render(os.path.join(output_dir, 'unknown'), 'unknown')
+            self.assertEqual(str(cm_exc.exception), "unknown environment 'unknown'")
+            with self.assertRaises(ValueError) as cm_exc:
+                specializer.render(os.path.join(output_dir, 'error'), variables={'a': 1, 'b': 2})
+            self.assertEqual(str(cm_exc.exception), f"{os.path.join(input_dir, 'template', 'a.txt')}: error: 'env' is undefined\n")
+
+    def test_specializer_hooks(self):
+        test_files = [
+            ('a.txt', "{% include 'inc.txt' %}{% template_specialize_rename 'b.txt' %}"),
+            ('b.txt', '{{b}}'),
+            ('c.txt', '{{c}}'),
+            ('inc.txt', "{% aws_parameter_store 'name1' %}")
+        ]
+
+        class TestHooks(SpecializerHooks):
+            def __init__(self):
+                self.calls = []
+
+            def before_template(self, name):
+                self.calls.append(('before_template', name))
+
+            def after_template(self, name, seconds, error):
+                self.calls.append(('after_template', name, seconds >= 0, str(error) if error is not None else None))
+
+            def cache_hit(self, name, seconds):
+                self.calls.append(('cache_hit', name, seconds >= 0))
+
+            def cache_miss(self, name, seconds, compile_seconds):
+                self.calls.append(('cache_miss', name, seconds >= compile_seconds > 0))
+
+            def parameter_fetch(self, method_name, request, seconds, error):
+                self.calls.append(('parameter_fetch', method_name, request, seconds >= 0, error))
+
+            def rename_applied(self, path, name):
+                self.calls.append(('rename_applied', path, name))
+
+        def get_parameters(**kwargs):
+            return {
+                'Parameters': [{'Name': name, 'Value': f'{name}-value'} for name in kwargs['Names']],
+                'InvalidParameters': []
+            }
+
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            hooks = TestHooks()
+            specializer = Specializer(input_dir, hooks=hooks)
+            with unittest_mock.patch('botocore.session') as mock_session:
+                mock_session.get_session.return_value.create_client.return_value.get_parameters.side_effect = get_parameters
+                specializer.render(os.path.join(output_dir, 'output'), variables={'c': 1})
+                hooks.calls.sort()
+                self.assertEqual(hooks.calls, [
+                    ('after_template', 'a.txt', True, None),
+                    ('after_template', 'c.txt', True, None),
+                    ('after_template', 'inc.txt', True, None),
+                    ('before_template', 'a.txt'),
+                    ('before_template', 'c.txt'),
+                    ('before_template', 'inc.txt'),
+                    ('cache_hit', 'inc.txt', True),
+                    ('cache_miss', 'a.txt', True),
+                    ('cache_miss', 'c.txt', True),
+                    ('cache_miss', 'inc.txt', True),
+                    ('parameter_fetch', 'get_parameters', {'Names': ['name1'], 'WithDecryption': True}, True, None),
+                    ('rename_applied', 'b.txt', None)
+                ])
+
+                # Template errors are reported
+                hooks.calls.clear()
+                with self.assertRaises(ValueError):
+                    specializer.render(os.path.join(output_dir, 'error'))
+                self.assertIn(('after_template', 'c.txt', True, "'c' is undefined"), hooks.calls)
+
+    def test_specializer_hooks_base(self):
+        test_files = [
+            ('a.txt', "{% template_specialize_rename 'a.txt', 'b.txt' %}{% aws_parameter_store 'name1' %}")
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            specializer = Specializer(input_dir, hooks=SpecializerHooks())
+            with unittest_mock.patch('botocore.session') as mock_session:
+                mock_session.get_session.return_value.create_client.return_value.get_parameters.side_effect = \
+                    botocore.exceptions.ClientError({'Error': {'Code': 'AccessDenied'}}, 'GetParameters')
+                mock_session.get_session.return_value.create_client.return_value.get_parameter.return_value = \
+                    {'Parameter': {'Value': 'value1'}}
+                specializer.render(output_dir)
+            with open(os.path.join(output_dir, 'b.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'value1')
+
+    def test_serve(self):
+        with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+             unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+             unittest_mock.patch('template_specialize.serve.serve') as mock_serve:
+            main(['--serve', 'test.sock'])
+
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertEqual(stderr.getvalue(), '')
+        self.assertEqual(len(mock_serve.call_args_list), 1)
+        self.assertEqual(mock_serve.call_args.args[0], 'test.sock')
+
+        # Serve a request
+        test_files = [
+            ('env.json', '{"test": {"values": {"foo": "bar"}}}'),
+            (('template', 'a.txt'), '{{foo}}{% template_specialize_rename "a.txt", "b.txt" %}')
+        ]
+        with create_test_files(test_files) as input_dir:
+            handle_request = mock_serve.call_args.args[1]
+            self.assertEqual(
+                handle_request(['template', 'output', '-c', 'env.json', '-e', 'test'], input_dir),
+                (0, '', '')
+            )
+            with open(os.path.join(input_dir, 'output', 'b.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'bar')
+
+            # Requests re-use the template environment and parsed environments
+            state = handle_request.args[0]
+            self.assertEqual(sorted(state_key[0] for state_key in state), ['environment', 'environments'])
+            environment = next(state_value for state_key, state_value in state.items() if state_key[0] == 'environment')['environment']
+            self.assertEqual(
+                handle_request(['template', 'output2', '-c', 'env.json', '-e', 'test', '-k', 'foo', 'baz'], input_dir),
+                (0, '', '')
+            )
+            with open(os.path.join(input_dir, 'output2', 'b.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'baz')
+            self.assertEqual(len(state), 2)
+            self.assertIs(
+                next(state_value for state_key, state_value in state.items() if state_key[0] == 'environment')['environment'],
+                environment
+            )
+            self.assertEqual(environment.template_specialize_rename, [])
+
+            # Changed environment file
+            with open(os.path.join(input_dir, 'env.json'), 'w', encoding='utf-8') as f_env:
+                f_env.write('{"test": {"values": {"foo": "bonk"}}}')
+            self.assertEqual(handle_request(['template', 'output', '-c', 'env.json', '-e', 'test'], input_dir), (0, '', ''))
+            with open(os.path.join(input_dir, 'output', 'b.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'bonk')
+            self.assertEqual(len(state), 2)
+            self.assertEqual(state[('environments', os.path.join(input_dir, 'env.json'))][2], {'test': {'values': {'foo': 'bonk'}}})
+
+            # Least-recently used template environments are evicted
+            with unittest_mock.patch('template_specialize.main.STATE_ENVIRONMENTS_MAX', 1):
+                self.assertEqual(
+                    handle_request(['template', 'output3', '-k', 'foo', 'x', '--aws-cache-ttl', '60'], input_dir), (0, '', '')
+                )
+                self.assertEqual(len(state), 2)
+                self.assertIsNot(
+                    next(state_value for state_key, state_value in state.items() if state_key[0] == 'environment')['environment'],
+                    environment
+                )
+
+            # Re-used template environments' Parameter Store values expire
+            environment = next(state_value for state_key, state_value in state.items() if state_key[0] == 'environment')['environment']
+            environment.aws_parameter_store_values['name'] = 'value'
+            self.assertEqual(
+                handle_request(['template', 'output3', '-k', 'foo', 'x', '--aws-cache-ttl', '60'], input_dir), (0, '', '')
+            )
+            self.assertEqual(environment.aws_parameter_store_values, {'name': 'value'})
+            with unittest_mock.patch('template_specialize.main.time.time', return_value=time.time() + 61):
+                self.assertEqual(
+                    handle_request(['template', 'output3', '-k', 'foo', 'x', '--aws-cache-ttl', '60'], input_dir), (0, '', '')
+                )
+            self.assertEqual(environment.aws_parameter_store_values, {})
+
+            # Errors
+            status, stdout, stderr = handle_request(['template', 'output', '-e', 'unknown'], input_dir)
+            self.assertEqual((status, stdout, stderr), (2, '', "unknown environment 'unknown'\n"))
+            status, stdout, stderr = handle_request(['template', '-'], input_dir)
+            self.assertEqual((status, stdout), (2, ''))
+            self.assertTrue(stderr.endswith("template-specialize: error: argument DST: '-' not allowed in a daemon request\n"))
+            status, stdout, stderr = handle_request(['template', 'output', '--watch'], input_dir)
+            self.assertEqual((status, stdout), (2, ''))
+            self.assertTrue(stderr.endswith('template-specialize: error: argument --watch: not allowed in a daemon request\n'))
+            status, stdout, stderr = handle_request(['--serve', 'other.sock'], input_dir)
+            self.assertEqual((status, stdout), (2, ''))
+            self.assertTrue(stderr.endswith('template-specialize: error: argument --serve: not allowed in a daemon request\n'))
+            status, stdout, stderr = handle_request(['--help'], input_dir)
+            self.assertEqual((status, stderr), (0, ''))
+            self.assertTrue(stdout.startswith('usage: template-specialize'))
+            self.assertEqual(handle_request([], os.path.join(input_dir, 'unknown'))[0], 2)
+            with unittest_mock.patch('template_specialize.main._render_environment', side_effect=RuntimeError('BOOM')):
+                status, stdout, stderr = handle_request(['template', 'output'], input_dir)
+            self.assertEqual((status, stdout), (1, ''))
+            self.assertTrue(stderr.endswith('RuntimeError: BOOM\n'))
+            with unittest_mock.patch('template_specialize.main._render_environment', side_effect=SystemExit('exit message')):
+                self.assertEqual(handle_request(['template', 'output'], input_dir), (1, '', 'exit message\n'))
+
+            # Redefined environments across environment files
+            with open(os.path.join(input_dir, 'env2.json'), 'w', encoding='utf-8') as f_env:
+                f_env.write('{"test": {}}')
+            self.assertEqual(
+                handle_request(['template', 'output', '-c', 'env.json', '-c', 'env2.json', '-e', 'test'], input_dir),
+                (2, '', "redefinition of environment 'test'\n")
+            )
+
+    def test_serve_cwd(self):
+        with unittest_mock.patch('template_specialize.serve.serve') as mock_serve:
+            main(['--serve', 'test.sock'])
+        handle_request = mock_serve.call_args.args[1]
+
+        # Requests from other working directories re-use the template environment's absolute cache paths
+        test_files = [
+            (('template', 'a.txt'), 'a'),
+            (('a', 'empty.txt'), ''),
+            (('b', 'empty.txt'), '')
+        ]
+        with create_test_files(test_files) as input_dir:
+            argv = ['../template', 'output', '--cache-dir', '.cache', '--aws-cache', '.aws-cache']
+            self.assertEqual(handle_request(argv, os.path.join(input_dir, 'a')), (0, '', ''))
+            with open(os.path.join(input_dir, 'template', 'b.txt'), 'w', encoding='utf-8') as f_template:
+                f_template.write('b')
+            argv = ['../template', 'output', '--cache-dir', '../a/.cache', '--aws-cache', '../a/.aws-cache']
+            self.assertEqual(handle_request(argv, os.path.join(input_dir, 'b')), (0, '', ''))
+            self.assertEqual(len(handle_request.args[0]), 1)
+            self.assertEqual(sorted(os.listdir(os.path.join(input_dir, 'a'))), ['.aws-cache', '.cache', 'empty.txt', 'output'])
+            self.assertEqual(sorted(os.listdir(os.path.join(input_dir, 'b'))), ['empty.txt', 'output'])
+            with open(os.path.join(input_dir, 'b', 'output', 'b.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'b')
+
+    def test_serve_error(self):
+        with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+             unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+             unittest_mock.patch('template_specialize.serve.serve', side_effect=OSError('socket error')):
+            with self.assertRaises(SystemExit) as cm_exc:
+                main(['--serve', 'test.sock'])
+
+        self.assertEqual(cm_exc.exception.code, 2)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertEqual(stderr.getvalue(), 'socket error\n')
+
     def test_file_to_file(self):
         test_files = [
             ('template.txt', 'the value of "foo" is "{{foo}}"')
@@ -475,96 +939,1820 @@ unknown environment 'unknown'
             self.assertTrue(os.path.isdir(input_path))
             self.assertTrue(os.path.isfile(output_path))
 
-    def test_file_not_exist(self):
-        with create_test_files([]) as input_dir, \
+    def test_dir_to_dir_jobs(self):
+        test_files = [
+            (f'template{ix}.txt', f'{ix}: the value of "foo" is "{{{{foo}}}}"') for ix in range(10)
+        ]
+        test_files.append((
+            'rename.txt',
+            '''\
+{% template_specialize_rename "rename.txt" %}
+{% template_specialize_rename "template0.txt", "renamed0.txt" %}
+'''
+        ))
+        with create_test_files(test_files) as input_dir, \
              create_test_files([]) as output_dir:
-            input_path = os.path.join(input_dir, 'template.txt')
-            output_path = os.path.join(output_dir, 'other.txt')
             with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
                  unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
-                with self.assertRaises(SystemExit) as cm_exc:
-                    main([input_path, output_path])
+                main([input_dir, output_dir, '--key', 'foo', 'bar', '-j', '4'])
 
-            self.assertEqual(cm_exc.exception.code, 2)
             self.assertEqual(stdout.getvalue(), '')
-            self.assertEqual(stderr.getvalue(), f"'template.txt' not found in search path: {input_dir!r}\n")
-            self.assertFalse(os.path.exists(input_path))
-            self.assertFalse(os.path.exists(output_path))
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(
+                sorted(os.listdir(output_dir)),
+                ['renamed0.txt', *(f'template{ix}.txt' for ix in range(1, 10))]
+            )
+            with open(os.path.join(output_dir, 'renamed0.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), '0: the value of "foo" is "bar"')
+            for ix in range(1, 10):
+                with open(os.path.join(output_dir, f'template{ix}.txt'), 'r', encoding='utf-8') as f_output:
+                    self.assertEqual(f_output.read(), f'{ix}: the value of "foo" is "bar"')
 
-    def test_rename(self):
+    def test_dir_to_dir_jobs_error(self):
         test_files = [
-            (
-                'template.txt',
-                '''\
-{# Delete template.txt #}
-{% template_specialize_rename "template.txt" %}
-
-{# Rename the file and the sub-directory #}
-{% template_specialize_rename "subdir/subtemplate.txt", "newtemplate.txt" %}
-{% template_specialize_rename "subdir", "newdir" %}
-'''
-            ),
-            (('subdir', 'subtemplate.txt'), 'agree, "{{foo}}" is the value of "foo"')
+            ('template.txt', 'the value of "foo" is "{{foo}}"'),
+            (('subdir', 'subtemplate.txt'), 'the value of "bar" is "{{bar}}"')
         ]
         with create_test_files(test_files) as input_dir, \
              create_test_files([]) as output_dir:
             with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
                  unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
-                main([input_dir, output_dir, '--key', 'foo', 'bar'])
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([input_dir, output_dir, '--jobs', '2'])
 
+            self.assertEqual(cm_exc.exception.code, 2)
             self.assertEqual(stdout.getvalue(), '')
-            self.assertEqual(stderr.getvalue(), '')
-            self.assertFalse(os.path.exists(os.path.join(output_dir, 'template.txt')))
-            self.assertFalse(os.path.exists(os.path.join(output_dir, 'subdir')))
-            with open(os.path.join(output_dir, 'newdir', 'newtemplate.txt'), 'r', encoding='utf-8') as f_output:
-                self.assertEqual(f_output.read(), 'agree, "bar" is the value of "foo"')
+            self.assertEqual(stderr.getvalue(), f"{os.path.join(input_dir, 'template.txt')}: error: 'foo' is undefined\n")
 
-    def test_rename_directory_exists(self):
-        test_files = [
-            (
-                'template.txt',
-                '''\
-{# Delete template.txt #}
-{% template_specialize_rename "template.txt" %}
+    def test_jobs_invalid(self):
+        with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+             unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+            with self.assertRaises(SystemExit) as cm_exc:
+                main(['template.txt', 'other.txt', '-j', '0'])
 
-{# Rename the file and the sub-directory #}
-{% template_specialize_rename "subdir", "newdir" %}
-'''
-            ),
-            (('subdir', 'subtemplate.txt'), 'agree, "{{foo}}" is the value of "foo"')
+        self.assertEqual(cm_exc.exception.code, 2)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertTrue(stderr.getvalue().endswith('error: argument -j/--jobs: invalid job count: 0\n'))
+
+    def test_aws_retries_invalid(self):
+        with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+             unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+            with self.assertRaises(SystemExit) as cm_exc:
+                main(['template.txt', 'other.txt', '--aws-retries', '-1'])
+
+        self.assertEqual(cm_exc.exception.code, 2)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertTrue(stderr.getvalue().endswith('error: argument --aws-retries: invalid retry count: -1\n'))
+
+    def test_incremental(self):
+        test_files = [
+            ('template.txt', 'the value of "foo" is "{{foo}}"'),
+            ('include.txt', "{% include 'sub/included.txt' %}"),
+            ('now.txt', '{{now.year}}'),
+            (('sub', 'included.txt'), 'included')
         ]
         with create_test_files(test_files) as input_dir, \
              create_test_files([]) as output_dir:
+            template_path = os.path.join(output_dir, 'template.txt')
+            include_path = os.path.join(output_dir, 'include.txt')
+            now_path = os.path.join(output_dir, 'now.txt')
             with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
                  unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
-
-                # Destination directory exists and is non-empty
-                os.mkdir(os.path.join(output_dir, 'newdir'))
-                os.mkdir(os.path.join(output_dir, 'newdir', 'newsubdir'))
-
-                main([input_dir, output_dir, '--key', 'foo', 'bar'])
-
+                main([input_dir, output_dir, '--key', 'foo', 'bar', '--incremental'])
             self.assertEqual(stdout.getvalue(), '')
             self.assertEqual(stderr.getvalue(), '')
-            self.assertFalse(os.path.exists(os.path.join(output_dir, 'template.txt')))
-            self.assertFalse(os.path.exists(os.path.join(output_dir, 'subdir')))
-            with open(os.path.join(output_dir, 'newdir', 'subtemplate.txt'), 'r', encoding='utf-8') as f_output:
-                self.assertEqual(f_output.read(), 'agree, "bar" is the value of "foo"')
+            self.assertTrue(os.path.isfile(os.path.join(output_dir, '.template-specialize.json')))
+            with open(template_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'the value of "foo" is "bar"')
+            with open(include_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'included')
+
+            # Unchanged inputs - output files are not rendered (or scanned), except templates that read the "now" variable
+            with open(template_path, 'w', encoding='utf-8') as f_output:
+                f_output.write('unchanged')
+            with open(now_path, 'w', encoding='utf-8') as f_output:
+                f_output.write('unchanged')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main._scan_templates', wraps=_scan_templates) as mock_scan, \
+                 unittest_mock.patch.object(
+                     TemplateSpecializeEnvironment, 'parse', autospec=True, side_effect=jinja2.Environment.parse
+                 ) as mock_parse:
+                main([input_dir, output_dir, '--key', 'foo', 'bar', '--incremental'])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(mock_scan.call_args.args[1], ['now.txt'])
+
+            # The template dependency index is saved with the incremental manifest - unchanged templates aren't parsed
+            self.assertTrue(os.path.isfile(os.path.join(output_dir, '.template-specialize-deps.json')))
+            self.assertEqual(mock_parse.call_count, 0)
+            with open(template_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'unchanged')
+            with open(now_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), str(datetime.datetime.now().year))
+
+            # Changed included template - only the including template is rendered
+            with open(os.path.join(input_dir, 'sub', 'included.txt'), 'w', encoding='utf-8') as f_input:
+                f_input.write('included2')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_dir, output_dir, '--key', 'foo', 'bar', '--incremental'])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            with open(template_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'unchanged')
+            with open(include_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'included2')
+
+            # Changed variables - only the templates that read the changed variables are rendered
+            with open(include_path, 'w', encoding='utf-8') as f_output:
+                f_output.write('unchanged')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_dir, output_dir, '--key', 'foo', 'baz', '--key', 'other', 'value', '--incremental'])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            with open(template_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'the value of "foo" is "baz"')
+            with open(include_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'unchanged')
+
+            # Unsupported manifest version - all templates are rendered
+            manifest_path = os.path.join(output_dir, '.template-specialize.json')
+            with open(manifest_path, 'r', encoding='utf-8') as f_manifest:
+                manifest = json.load(f_manifest)
+            with open(manifest_path, 'w', encoding='utf-8') as f_manifest:
+                json.dump({**manifest, 'version': 0}, f_manifest)
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_dir, output_dir, '--key', 'foo', 'baz', '--key', 'other', 'value', '--incremental'])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            with open(include_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'included2')
 
-    def test_rename_unchanged(self):
+    def test_incremental_rename(self):
         test_files = [
             (
                 'template.txt',
                 '''\
-{# Delete template.txt #}
 {% template_specialize_rename "template.txt" %}
-
-{# Rename the file and the sub-directory #}
-{% template_specialize_rename "subdir/subtemplate.txt", "subtemplate.txt" %}
-{% template_specialize_rename "subdir", "subdir" %}
+{% template_specialize_rename "subdir/subtemplate.txt", "newtemplate.txt" %}
+{% template_specialize_rename "subdir", "newdir" %}
 '''
             ),
-            (('subdir', 'subtemplate.txt'), 'agree, "{{foo}}" is the value of "foo"')
+            (('subdir', 'subtemplate.txt'), 'agree, "{{foo}}" is the value of "foo"'),
+            ('other.txt', 'other')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            for _ in range(2):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    main([input_dir, output_dir, '--key', 'foo', 'bar', '--incremental'])
+
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), '')
+                self.assertEqual(
+                    sorted(os.listdir(output_dir)),
+                    ['.template-specialize-deps.json', '.template-specialize.json', 'newdir', 'other.txt']
+                )
+                with open(os.path.join(output_dir, 'newdir', 'newtemplate.txt'), 'r', encoding='utf-8') as f_output:
+                    self.assertEqual(f_output.read(), 'agree, "bar" is the value of "foo"')
+
+    def test_incremental_delete(self):
+        test_files = [
+            ('a.txt', '{% template_specialize_rename "gone.txt" %}A'),
+            ('gone.txt', 'G')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            for _ in range(2):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    main([input_dir, output_dir, '--incremental'])
+
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), '')
+                self.assertEqual(
+                    sorted(os.listdir(output_dir)),
+                    ['.template-specialize-deps.json', '.template-specialize.json', 'a.txt']
+                )
+                with open(os.path.join(output_dir, '.template-specialize.json'), 'r', encoding='utf-8') as f_manifest:
+                    self.assertEqual(json.load(f_manifest)['templates']['gone.txt']['renames'], [])
+
+    def test_incremental_parameter_store(self):
+        test_files = [
+            ('tag.txt', "{% aws_parameter_store 'secret' %}"),
+            ('include.txt', "{% include 'sub/filter.txt' %}"),
+            ('static.txt', 'static'),
+            (('sub', 'filter.txt'), "{{ ['secret']|aws_parameter_store|first }}")
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+
+            # Templates that use Parameter Store values (directly or through includes) are always rendered
+            for value in ('value1', 'value2'):
+                with open(os.path.join(output_dir, 'static.txt'), 'w', encoding='utf-8') as f_output:
+                    f_output.write('unchanged')
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                     unittest_mock.patch('botocore.session') as mock_session:
+                    mock_session.get_session.return_value.create_client.return_value.get_parameters.return_value = {
+                        'Parameters': [{'Name': 'secret', 'Value': value}], 'InvalidParameters': []
+                    }
+                    main([input_dir, output_dir, '--incremental'])
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), '')
+                for name, expected in (
+                    ('tag.txt', value),
+                    ('include.txt', value),
+                    ('sub/filter.txt', value),
+                    ('static.txt', 'static' if value == 'value1' else 'unchanged')
+                ):
+                    with open(os.path.join(output_dir, *name.split('/')), 'r', encoding='utf-8') as f_output:
+                        self.assertEqual(f_output.read(), expected)
+
+    def test_incremental_file(self):
+        test_files = [
+            ('template.txt', 'the value of "foo" is "{{foo}}"')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            input_path = os.path.join(input_dir, 'template.txt')
+            output_path = os.path.join(output_dir, 'other.txt')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([input_path, output_path, '--incremental'])
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '--incremental requires a template directory\n')
+            self.assertFalse(os.path.exists(output_path))
+
+    def test_watch(self):
+        test_files = [
+            ('a.txt', 'a {% include "inc.txt" %}'),
+            ('b.txt', 'b {{foo}}'),
+            ('inc.txt', 'inc')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+
+            def watch_sleep(interval):
+                self.assertEqual(interval, 0.5)
+                watch_sleep.count += 1
+                if watch_sleep.count == 1:
+                    # Modify the included template - mark b.txt's output to verify that it is not re-rendered
+                    with open(os.path.join(output_dir, 'b.txt'), 'w', encoding='utf-8') as file_:
+                        file_.write('b stale')
+                    with open(os.path.join(input_dir, 'inc.txt'), 'w', encoding='utf-8') as file_:
+                        file_.write('inc2')
+                elif watch_sleep.count == 2:
+                    # Add a template
+                    with open(os.path.join(input_dir, 'c.txt'), 'w', encoding='utf-8') as file_:
+                        file_.write('c {{foo}}')
+                elif watch_sleep.count == 4:
+                    raise KeyboardInterrupt()
+            watch_sleep.count = 0
+
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main.time.sleep', side_effect=watch_sleep):
+                main([input_dir, output_dir, '--key', 'foo', 'bar', '--watch', '--watch-interval', '0.5'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(watch_sleep.count, 4)
+            self.assertEqual(sorted(os.listdir(output_dir)), ['a.txt', 'b.txt', 'c.txt', 'inc.txt'])
+            for name, content in (('a.txt', 'a inc2'), ('b.txt', 'b stale'), ('c.txt', 'c bar'), ('inc.txt', 'inc2')):
+                with open(os.path.join(output_dir, name), 'r', encoding='utf-8') as file_:
+                    self.assertEqual(file_.read(), content)
+
+    def test_watch_exclude(self):
+        test_files = [
+            ('a.txt', 'a {% include "_inc/h.txt" %}'),
+            (('_inc', 'h.txt'), 'h')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+
+            def watch_sleep(unused_interval):
+                watch_sleep.count += 1
+                if watch_sleep.count == 1:
+                    # Modify the included template of the excluded directory
+                    with open(os.path.join(input_dir, '_inc', 'h.txt'), 'w', encoding='utf-8') as file_:
+                        file_.write('h2')
+                elif watch_sleep.count == 3:
+                    raise KeyboardInterrupt()
+            watch_sleep.count = 0
+
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main.time.sleep', side_effect=watch_sleep):
+                main([input_dir, output_dir, '--exclude', '_inc/', '--watch'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(os.listdir(output_dir), ['a.txt'])
+            with open(os.path.join(output_dir, 'a.txt'), 'r', encoding='utf-8') as file_:
+                self.assertEqual(file_.read(), 'a h2')
+
+    def test_watch_archive(self):
+        with create_test_files([]) as input_dir, \
+             create_test_files([]) as output_dir:
+            archive_path = os.path.join(input_dir, 'templates.zip')
+            with zipfile.ZipFile(archive_path, 'w') as archive:
+                archive.writestr('a.txt', 'a {{foo}}')
+                archive.writestr('b.txt', 'b')
+
+            def watch_sleep(unused_interval):
+                watch_sleep.count += 1
+                if watch_sleep.count == 1:
+                    # Change the template archive - all template files are re-rendered
+                    with open(os.path.join(output_dir, 'b.txt'), 'w', encoding='utf-8') as file_:
+                        file_.write('b stale')
+                    with zipfile.ZipFile(archive_path, 'w') as archive:
+                        archive.writestr('a.txt', 'a2 {{foo}}')
+                        archive.writestr('b.txt', 'b')
+                    os.utime(archive_path, ns=(1000000000, 1000000000))
+                elif watch_sleep.count == 3:
+                    raise KeyboardInterrupt()
+            watch_sleep.count = 0
+
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main.time.sleep', side_effect=watch_sleep):
+                main([archive_path, output_dir, '--key', 'foo', 'bar', '--watch'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(sorted(os.listdir(output_dir)), ['a.txt', 'b.txt'])
+            for name, content in (('a.txt', 'a2 bar'), ('b.txt', 'b')):
+                with open(os.path.join(output_dir, name), 'r', encoding='utf-8') as file_:
+                    self.assertEqual(file_.read(), content)
+
+    def test_watch_environment(self):
+        test_files = [
+            ('env.json', '{"test": {"values": {"foo": "bar"}}}'),
+            (('template', 'a.txt'), 'a {{foo}}'),
+            (('template', 'b.txt'), 'b'),
+            (('template', 'c.txt'), 'c')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            env_path = os.path.join(input_dir, 'env.json')
+            template_dir = os.path.join(input_dir, 'template')
+
+            def watch_sleep(unused_interval):
+                watch_sleep.count += 1
+                if watch_sleep.count == 1:
+                    # Template error
+                    with open(os.path.join(template_dir, 'b.txt'), 'w', encoding='utf-8') as file_:
+                        file_.write('b {{')
+                elif watch_sleep.count == 2:
+                    # Fix the template error
+                    with open(os.path.join(template_dir, 'b.txt'), 'w', encoding='utf-8') as file_:
+                        file_.write('b fixed')
+                elif watch_sleep.count == 3:
+                    # Change the environment file - c.txt doesn't read the changed variable
+                    with open(os.path.join(output_dir, 'c.txt'), 'w', encoding='utf-8') as file_:
+                        file_.write('c stale')
+                    with open(env_path, 'w', encoding='utf-8') as file_:
+                        file_.write('{"test": {"values": {"foo": "baz"}}}')
+                elif watch_sleep.count == 4:
+                    # Environment file change that doesn't change the template variables
+                    with open(env_path, 'w', encoding='utf-8') as file_:
+                        file_.write('{"test": {"values": {"foo": "baz"}}}\n')
+                    with open(os.path.join(output_dir, 'a.txt'), 'w', encoding='utf-8') as file_:
+                        file_.write('a stale')
+                elif watch_sleep.count == 5:
+                    # Remove the environment file
+                    os.unlink(env_path)
+                elif watch_sleep.count == 6:
+                    # Restore the environment file
+                    with open(env_path, 'w', encoding='utf-8') as file_:
+                        file_.write('{"test": {"values": {"foo": "qux"}}}')
+                elif watch_sleep.count == 7:
+                    raise KeyboardInterrupt()
+            watch_sleep.count = 0
+
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main.time.sleep', side_effect=watch_sleep):
+                main([template_dir, output_dir, '-c', env_path, '-e', 'test', '--watch'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(
+                stderr.getvalue(),
+                f"{os.path.join(template_dir, 'b.txt')}:1: unexpected 'end of template'\n"
+                f"[Errno {errno.ENOENT}] {os.strerror(errno.ENOENT)}: {env_path!r}\n"
+            )
+            for name, content in (('a.txt', 'a qux'), ('b.txt', 'b fixed'), ('c.txt', 'c stale')):
+                with open(os.path.join(output_dir, name), 'r', encoding='utf-8') as file_:
+                    self.assertEqual(file_.read(), content)
+
+    def test_watch_file(self):
+        test_files = [
+            ('template.txt', 'a {{foo}}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            input_path = os.path.join(input_dir, 'template.txt')
+            output_path = os.path.join(output_dir, 'other.txt')
+
+            def watch_sleep(unused_interval):
+                watch_sleep.count += 1
+                if watch_sleep.count == 1:
+                    with open(input_path, 'w', encoding='utf-8') as file_:
+                        file_.write('a2 {{foo}}')
+                elif watch_sleep.count == 2:
+                    raise KeyboardInterrupt()
+            watch_sleep.count = 0
+
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main.time.sleep', side_effect=watch_sleep):
+                main([input_path, output_path, '-k', 'foo', 'bar', '--watch'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            with open(output_path, 'r', encoding='utf-8') as file_:
+                self.assertEqual(file_.read(), 'a2 bar')
+
+    def test_watch_parameter_store(self):
+        test_files = [
+            ('env.json', '{"test": {"values": {"foo": "bar"}}}'),
+            (('template', 'a.txt'), 'a {{foo}}'),
+            (('template', 'b.txt'), 'b')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            env_path = os.path.join(input_dir, 'env.json')
+            template_dir = os.path.join(input_dir, 'template')
+
+            def watch_sleep(unused_interval):
+                watch_sleep.count += 1
+                if watch_sleep.count == 1:
+                    # Change the environment file - without "-e", the template variables are unchanged
+                    with open(env_path, 'w', encoding='utf-8') as file_:
+                        file_.write('{"test": {"values": {"foo": "baz"}}}')
+                elif watch_sleep.count == 2:
+                    # Add a literal Parameter Store value - it's retrieved before rendering
+                    with open(os.path.join(template_dir, 'b.txt'), 'w', encoding='utf-8') as file_:
+                        file_.write("b {% aws_parameter_store 'name1' %}")
+                elif watch_sleep.count == 3:
+                    raise KeyboardInterrupt()
+            watch_sleep.count = 0
+
+            def get_parameters(**kwargs):
+                return {
+                    'Parameters': [{'Name': name, 'Value': f'{name}-value'} for name in kwargs['Names']],
+                    'InvalidParameters': []
+                }
+
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main.time.sleep', side_effect=watch_sleep), \
+                 unittest_mock.patch('botocore.session') as mock_session:
+                mock_client = mock_session.get_session.return_value.create_client.return_value
+                mock_client.get_parameters.side_effect = get_parameters
+                main([template_dir, output_dir, '-c', env_path, '-k', 'foo', 'bar', '--watch'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(mock_client.get_parameters.call_args_list, [unittest_mock.call(Names=['name1'], WithDecryption=True)])
+            for name, content in (('a.txt', 'a bar'), ('b.txt', 'b name1-value')):
+                with open(os.path.join(output_dir, name), 'r', encoding='utf-8') as file_:
+                    self.assertEqual(file_.read(), content)
+
+    def test_watch_incremental(self):
+        test_files = [
+            ('a.txt', 'a {{foo}}'),
+            ('raw.css', '{{ raw }}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+
+            def watch_sleep(unused_interval):
+                watch_sleep.count += 1
+                if watch_sleep.count == 1:
+                    # Change a template - its incremental inputs are re-computed
+                    with open(os.path.join(input_dir, 'a.txt'), 'w', encoding='utf-8') as file_:
+                        file_.write('a2 {{foo}}')
+                elif watch_sleep.count == 2:
+                    raise KeyboardInterrupt()
+            watch_sleep.count = 0
+
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main.time.sleep', side_effect=watch_sleep):
+                main([input_dir, output_dir, '-k', 'foo', 'bar', '--copy', '*.css', '--incremental', '--watch'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            for name, content in (('a.txt', 'a2 bar'), ('raw.css', '{{ raw }}')):
+                with open(os.path.join(output_dir, name), 'r', encoding='utf-8') as file_:
+                    self.assertEqual(file_.read(), content)
+
+            # The incremental manifest is up-to-date
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_dir, output_dir, '-k', 'foo', 'bar', '--copy', '*.css', '--incremental', '--skip-unchanged'])
+            self.assertEqual(stdout.getvalue(), '0 files written, 2 files unchanged\n')
+            self.assertEqual(stderr.getvalue(), '')
+
+    def test_watch_new_environment(self):
+        test_files = [
+            ('env.json', '{"test": {"values": {"foo": "bar"}}}'),
+            (('template', 'a.txt'), 'a {{foo}}'),
+            (('template', 'b.txt'), 'b')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            env_path = os.path.join(input_dir, 'env.json')
+
+            def watch_sleep(unused_interval):
+                watch_sleep.count += 1
+                if watch_sleep.count == 1:
+                    # Add an environment - all of its template files are rendered
+                    with open(env_path, 'w', encoding='utf-8') as file_:
+                        file_.write('{"test": {"values": {"foo": "bar"}}, "test2": {"values": {"foo": "baz"}}}')
+                elif watch_sleep.count == 2:
+                    raise KeyboardInterrupt()
+            watch_sleep.count = 0
+
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main.time.sleep', side_effect=watch_sleep):
+                main([os.path.join(input_dir, 'template'), os.path.join(output_dir, '{env}'), '-c', env_path, '-e', '*', '--watch'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(sorted(os.listdir(output_dir)), ['test', 'test2'])
+            for name, content in (('test/a.txt', 'a bar'), ('test2/a.txt', 'a baz'), ('test2/b.txt', 'b')):
+                with open(os.path.join(output_dir, *name.split('/')), 'r', encoding='utf-8') as file_:
+                    self.assertEqual(file_.read(), content)
+
+    def test_deps(self):
+        test_files = [
+            ('a.txt', '{% include "inc.txt" %}'),
+            ('b.txt', 'b'),
+            ('dynamic.txt', '{% include name %}'),
+            ('inc.txt', '{% include "macros.txt" %}'),
+            ('macros.txt', 'macros')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            cache_dir = os.path.join(output_dir, 'cache')
+
+            # The destination path is optional
+            for dst_argv in ([os.path.join(output_dir, 'output')], []):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    with self.assertRaises(SystemExit) as cm_exc:
+                        main([input_dir, *dst_argv, '--deps', '--cache-dir', cache_dir])
+
+                self.assertEqual(cm_exc.exception.code, 0)
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), '''\
+{
+    "a.txt": [
+        "inc.txt",
+        "macros.txt"
+    ],
+    "b.txt": [],
+    "dynamic.txt": null,
+    "inc.txt": [
+        "macros.txt"
+    ],
+    "macros.txt": []
+}
+''')
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+                self.assertFalse(os.path.exists(os.path.join(output_dir, 'output')))
+
+    def test_timings(self):
+        test_files = [
+            ('a.txt', '{% include "inc.txt" %}{{a}}'),
+            ('inc.txt', "{% aws_parameter_store 'name1' %}")
+        ]
+
+        def get_parameters(**kwargs):
+            return {
+                'Parameters': [{'Name': name, 'Value': f'{name}-value'} for name in kwargs['Names']],
+                'InvalidParameters': []
+            }
+
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            timings_path = os.path.join(output_dir, 'timings.json')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('botocore.session') as mock_session:
+                mock_session.get_session.return_value.create_client.return_value.get_parameters.side_effect = get_parameters
+                main([input_dir, os.path.join(output_dir, 'output'), '-k', 'a', '1', '--timings', '--timings-json', timings_path])
+
+            self.assertEqual(stdout.getvalue(), '')
+            stderr_lines = stderr.getvalue().splitlines()
+            self.assertEqual(stderr_lines[0].split(), ['Seconds', 'Count', 'Phase', 'Name'])
+            self.assertEqual(stderr_lines[-1].split()[1], 'total')
+            self.assertIn(['1', 'render', 'a.txt'], [line.split()[1:] for line in stderr_lines])
+            with open(os.path.join(output_dir, 'output', 'a.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'name1-value1')
+
+            # The JSON report has the same timings, sorted by descending time
+            with open(timings_path, 'r', encoding='utf-8') as f_timings:
+                timings = json.load(f_timings)
+            self.assertEqual(len(timings['timings']), len(stderr_lines) - 2)
+            self.assertEqual(
+                [timing['seconds'] for timing in timings['timings']],
+                sorted((timing['seconds'] for timing in timings['timings']), reverse=True)
+            )
+            self.assertEqual(
+                sorted((timing['phase'], timing['name'], timing['count']) for timing in timings['timings']),
+                [
+                    ('compile', 'a.txt', 1),
+                    ('compile', 'inc.txt', 1),
+                    ('create environment', None, 1),
+                    ('load', 'a.txt', 1),
+                    ('load', 'inc.txt', 2),
+                    ('merge', None, 1),
+                    ('parameter store prefetch', None, 1),
+                    ('parameter store wait', 'get_parameters', 1),
+                    ('render', 'a.txt', 1),
+                    ('render', 'inc.txt', 1),
+                    ('render environment', None, 1),
+                    ('save caches', None, 1),
+                    ('scan', None, 1),
+                    ('walk', None, 1)
+                ]
+            )
+
+    def test_timings_json_error(self):
+        test_files = [
+            ('template.txt', '{{a}}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            timings_path = os.path.join(output_dir, 'missing', 'timings.json')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([os.path.join(input_dir, 'template.txt'), os.path.join(output_dir, 'output.txt'), '-k', 'a', '1',
+                          '--timings-json', timings_path])
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), f"[Errno 2] No such file or directory: {timings_path!r}\n")
+            with open(os.path.join(output_dir, 'output.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), '1')
+
+    def test_profile(self):
+        test_files = [
+            ('template.txt', '{{a}}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            profile_path = os.path.join(output_dir, 'profile.prof')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([os.path.join(input_dir, 'template.txt'), os.path.join(output_dir, 'output.txt'), '-k', 'a', '1',
+                      '--profile', profile_path])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            with open(os.path.join(output_dir, 'output.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), '1')
+            stats = pstats.Stats(profile_path)
+            self.assertTrue(any(function_name == '_main' for _, _, function_name in stats.stats))
+
+    def test_profile_error(self):
+        with create_test_files([]) as output_dir:
+            profile_path = os.path.join(output_dir, 'profile.prof')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([os.path.join(output_dir, 'missing.txt'), os.path.join(output_dir, 'output.txt'), '--profile', profile_path])
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertNotEqual(stderr.getvalue(), '')
+            self.assertTrue(os.path.isfile(profile_path))
+
+    def test_cache_dir(self):
+        test_files = [
+            ('template.txt', 'the value of "foo" is "{{foo}}"'),
+            (('subdir', 'subtemplate.txt'), 'agree, "{{foo}}" is the value of "foo"')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir, \
+             create_test_files([]) as cache_dir:
+            for _ in range(2):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    main([input_dir, output_dir, '--key', 'foo', 'bar', '--cache-dir', cache_dir])
+
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), '')
+                self.assertEqual(len(os.listdir(cache_dir)), 2)
+                with open(os.path.join(output_dir, 'template.txt'), 'r', encoding='utf-8') as f_output:
+                    self.assertEqual(f_output.read(), 'the value of "foo" is "bar"')
+                with open(os.path.join(output_dir, 'subdir', 'subtemplate.txt'), 'r', encoding='utf-8') as f_output:
+                    self.assertEqual(f_output.read(), 'agree, "bar" is the value of "foo"')
+
+            # Prune the cache
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_dir, output_dir, '--key', 'foo', 'bar', '--cache-dir', cache_dir, '--cache-max-size', '0'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_cache_dir_error(self):
+        test_files = [
+            ('template.txt', 'the value of "foo" is "{{foo}}"')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            input_path = os.path.join(input_dir, 'template.txt')
+            output_path = os.path.join(output_dir, 'other.txt')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([input_path, output_path, '--key', 'foo', 'bar', '--cache-dir', input_path])
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertTrue(stderr.getvalue().endswith(f': {input_path!r}\n'))
+            self.assertFalse(os.path.exists(output_path))
+
+    def test_skip_unchanged(self):
+        test_files = [
+            ('template.txt', 'the value of "foo" is "{{foo}}"'),
+            (('subdir', 'subtemplate.txt'), 'agree, "{{foo}}" is the value of "foo"'),
+            ('static.txt', 'static')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            template_path = os.path.join(output_dir, 'template.txt')
+            static_path = os.path.join(output_dir, 'static.txt')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_dir, output_dir, '--key', 'foo', 'bar', '--skip-unchanged'])
+            self.assertEqual(stdout.getvalue(), '3 files written, 0 files unchanged\n')
+            self.assertEqual(stderr.getvalue(), '')
+            with open(template_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'the value of "foo" is "bar"')
+
+            # Set the output files' modified times to detect writes
+            os.utime(template_path, (0, 0))
+            os.utime(static_path, (0, 0))
+            os.chmod(static_path, 0o600)
+
+            # Same size, different content
+            with open(os.path.join(output_dir, 'subdir', 'subtemplate.txt'), 'w', encoding='utf-8') as f_output:
+                f_output.write('agree, "baz" is the value of "foo"')
+
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_dir, output_dir, '--key', 'foo', 'bar', '--skip-unchanged'])
+            self.assertEqual(stdout.getvalue(), '1 files written, 2 files unchanged\n')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(os.stat(template_path).st_mtime, 0)
+            self.assertEqual(os.stat(static_path).st_mtime, 0)
+            with open(os.path.join(output_dir, 'subdir', 'subtemplate.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'agree, "bar" is the value of "foo"')
+
+            # Changed content - the existing file's permissions are preserved
+            with open(os.path.join(input_dir, 'static.txt'), 'w', encoding='utf-8') as f_input:
+                f_input.write('static2')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_dir, output_dir, '--key', 'foo', 'bar', '--skip-unchanged', '-j', '2'])
+            self.assertEqual(stdout.getvalue(), '1 files written, 2 files unchanged\n')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(os.stat(template_path).st_mtime, 0)
+            self.assertNotEqual(os.stat(static_path).st_mtime, 0)
+            if os.name == 'posix':
+                self.assertEqual(os.stat(static_path).st_mode & 0o777, 0o600)
+            with open(static_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'static2')
+            self.assertEqual(sorted(os.listdir(output_dir)), ['static.txt', 'subdir', 'template.txt'])
+
+    def test_skip_unchanged_error(self):
+        test_files = [
+            ('template.txt', 'the value of "foo" is "{{foo}}"')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([('other.txt', 'other')]) as output_dir:
+            input_path = os.path.join(input_dir, 'template.txt')
+            output_path = os.path.join(output_dir, 'other.txt')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([input_path, output_path, '--skip-unchanged'])
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), f"{input_path}: error: 'foo' is undefined\n")
+            with open(output_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'other')
+
+    def test_skip_unchanged_write_error(self):
+        test_files = [
+            ('template.txt', 'template')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([(('other.txt', 'file.txt'), 'file')]) as output_dir:
+            input_path = os.path.join(input_dir, 'template.txt')
+            output_path = os.path.join(output_dir, 'other.txt')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([input_path, output_path, '--skip-unchanged'])
+
+            # The temporary file is removed
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertTrue(stderr.getvalue().startswith(f'{input_path}: error: [Errno '), stderr.getvalue())
+            self.assertEqual(os.listdir(output_dir), ['other.txt'])
+            self.assertEqual(os.listdir(output_path), ['file.txt'])
+
+    def test_exclude(self):
+        test_files = [
+            ('.specializeignore', '# Dependencies\nnode_modules/\n\n*.tmp\n!keep.tmp\n'),
+            ('a.txt', 'a'),
+            ('keep.tmp', 'keep'),
+            ('skip.tmp', '{{ skip'),
+            (('.git', 'config'), '{{ git'),
+            (('node_modules', 'pkg', 'index.js'), '{{ node_modules'),
+            (('build', 'out.txt'), '{{ build'),
+            (('build', 'keep.txt'), 'build keep'),
+            (('sub', 'b.txt'), 'b'),
+            (('sub', 'node_modules'), 'file, not a directory'),
+            (('sub', 'build', 'out.txt'), 'sub build')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            scandir_paths = []
+            scandir_original = os.scandir
+            def scandir(path):
+                scandir_paths.append(os.path.relpath(path, input_dir))
+                return scandir_original(path)
+
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main.os.scandir', side_effect=scandir):
+                main([input_dir, output_dir, '--exclude', '.git', '--exclude', '/build/*', '--include', 'keep.txt'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(sorted(scandir_paths), ['.', 'build', 'sub', os.path.join('sub', 'build')])
+            output_files = sorted(
+                os.path.relpath(os.path.join(root, file_), output_dir) for root, _, files in os.walk(output_dir) for file_ in files
+            )
+            self.assertEqual(output_files, [
+                'a.txt',
+                os.path.join('build', 'keep.txt'),
+                'keep.tmp',
+                os.path.join('sub', 'b.txt'),
+                os.path.join('sub', 'build', 'out.txt'),
+                os.path.join('sub', 'node_modules')
+            ])
+
+    def test_exclude_walk(self):
+        test_files = [
+            ('a.txt', 'a'),
+            (('sub', 'b.txt'), 'b'),
+            (('unreadable', 'c.txt'), 'c')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            os.symlink(os.path.join(input_dir, 'sub'), os.path.join(input_dir, 'link'))
+
+            # Unreadable directories are skipped and symbolic links to directories are not followed
+            scandir_original = os.scandir
+            def scandir(path):
+                if os.path.basename(path) == 'unreadable':
+                    raise PermissionError(errno.EACCES, 'Permission denied', path)
+                return scandir_original(path)
+
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main.os.scandir', side_effect=scandir):
+                main([input_dir, output_dir])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            output_files = sorted(
+                os.path.relpath(os.path.join(root, file_), output_dir) for root, _, files in os.walk(output_dir) for file_ in files
+            )
+            self.assertEqual(output_files, ['a.txt', os.path.join('sub', 'b.txt')])
+
+    def test_exclude_ignore_file_error(self):
+        test_files = [
+            ('a.txt', 'a')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            ignore_path = os.path.join(input_dir, '.specializeignore')
+            with open(ignore_path, 'wb') as f_ignore:
+                f_ignore.write(b'\xff\xfe\n')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([input_dir, output_dir])
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(
+                stderr.getvalue(),
+                f"invalid ignore file {ignore_path!r}: 'utf-8' codec can't decode byte 0xff in position 0: invalid start byte\n"
+            )
+            self.assertEqual(os.listdir(output_dir), [])
+
+    def test_copy(self):
+        test_files = [
+            ('a.txt', '{{a}}'),
+            (('static', 'raw.css'), '{{ raw }}'),
+            (('static', 'page.txt'), 'page {{a}}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            with open(os.path.join(input_dir, 'static', 'logo.png'), 'wb') as f_binary:
+                f_binary.write(b'\x89PNG\r\n\x1a\n\xff\xfe{{')
+            os.utime(os.path.join(input_dir, 'static', 'logo.png'), ns=(1000000000, 1000000000))
+            argv = [input_dir, output_dir, '-k', 'a', '1', '--copy', '*.png', '--copy', 'static/*', '--no-copy', 'static/*.txt',
+                    '--incremental', '--skip-unchanged']
+
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main(argv)
+            self.assertEqual(stdout.getvalue(), '4 files written, 0 files unchanged\n')
+            self.assertEqual(stderr.getvalue(), '')
+            with open(os.path.join(output_dir, 'static', 'logo.png'), 'rb') as f_output:
+                self.assertEqual(f_output.read(), b'\x89PNG\r\n\x1a\n\xff\xfe{{')
+            self.assertEqual(os.stat(os.path.join(output_dir, 'static', 'logo.png')).st_mtime_ns, 1000000000)
+            with open(os.path.join(output_dir, 'static', 'raw.css'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), '{{ raw }}')
+            with open(os.path.join(output_dir, 'static', 'page.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'page 1')
+
+            # Identical copied files are not copied - same modified time or same content
+            os.utime(os.path.join(output_dir, 'static', 'raw.css'), ns=(2000000000, 2000000000))
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main(argv)
+            self.assertEqual(stdout.getvalue(), '0 files written, 4 files unchanged\n')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(os.stat(os.path.join(output_dir, 'static', 'raw.css')).st_mtime_ns, 2000000000)
+
+            # Changed copied files are copied
+            with open(os.path.join(input_dir, 'static', 'raw.css'), 'w', encoding='utf-8') as f_input:
+                f_input.write('{{ raw2 }}')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main(argv)
+            self.assertEqual(stdout.getvalue(), '1 files written, 3 files unchanged\n')
+            self.assertEqual(stderr.getvalue(), '')
+            with open(os.path.join(output_dir, 'static', 'raw.css'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), '{{ raw2 }}')
+
+            # Changed destination files of the same size are copied
+            with open(os.path.join(output_dir, 'static', 'raw.css'), 'w', encoding='utf-8') as f_output:
+                f_output.write('{{ raw3 }}')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main(argv)
+            self.assertEqual(stdout.getvalue(), '1 files written, 3 files unchanged\n')
+            self.assertEqual(stderr.getvalue(), '')
+            with open(os.path.join(output_dir, 'static', 'raw.css'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), '{{ raw2 }}')
+
+            # Copied template file
+            output_path = os.path.join(output_dir, 'raw2.css')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([os.path.join(input_dir, 'static', 'raw.css'), output_path, '--copy', '*.css'])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            with open(output_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), '{{ raw2 }}')
+
+            # Copied files have no dependencies
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([input_dir, output_dir, '--copy', 'static/*', '--deps'])
+            self.assertEqual(cm_exc.exception.code, 0)
+            self.assertEqual(json.loads(stderr.getvalue())['static/logo.png'], [])
+
+    def test_copy_fallback(self):
+        test_files = [
+            ('a.txt', 'a' * 100)
+        ]
+        for copy_file_range_error, sendfile_error in ((None, None), (OSError(errno.EXDEV, 'cross-device'), None),
+                                                      (OSError(errno.EXDEV, 'cross-device'), OSError(errno.EINVAL, 'invalid'))):
+            with create_test_files(test_files) as input_dir, \
+                 create_test_files([]) as output_dir:
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                     unittest_mock.patch('fcntl.ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'not supported')), \
+                     unittest_mock.patch('os.copy_file_range', side_effect=copy_file_range_error,
+                                         wraps=os.copy_file_range) as mock_copy_file_range, \
+                     unittest_mock.patch('os.sendfile', side_effect=sendfile_error, wraps=os.sendfile) as mock_sendfile:
+                    main([input_dir, output_dir, '--copy', '*'])
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), '')
+                self.assertEqual(mock_copy_file_range.call_count, 1)
+                self.assertEqual(mock_sendfile.call_count, 1 if copy_file_range_error is not None else 0)
+                with open(os.path.join(output_dir, 'a.txt'), 'r', encoding='utf-8') as f_output:
+                    self.assertEqual(f_output.read(), 'a' * 100)
+
+    def test_copy_clone(self):
+        test_files = [
+            ('a.txt', 'a' * 100)
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            # Cloned files are not copied
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('fcntl.ioctl', return_value=0) as mock_ioctl, \
+                 unittest_mock.patch('os.copy_file_range') as mock_copy_file_range:
+                main([input_dir, output_dir, '--copy', '*'])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(mock_ioctl.call_count, 1)
+            self.assertEqual(mock_copy_file_range.call_count, 0)
+            self.assertEqual(os.listdir(output_dir), ['a.txt'])
+
+    def test_copy_truncated(self):
+        test_files = [
+            ('a.txt', 'a' * 100)
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            # A source file truncated during the copy ends the copy
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('fcntl.ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'not supported')), \
+                 unittest_mock.patch('os.copy_file_range', side_effect=[10, 0]) as mock_copy_file_range, \
+                 unittest_mock.patch('os.sendfile') as mock_sendfile:
+                main([input_dir, output_dir, '--copy', '*'])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(mock_copy_file_range.call_count, 2)
+            self.assertEqual(mock_sendfile.call_count, 0)
+            self.assertEqual(os.listdir(output_dir), ['a.txt'])
+
+    def test_copy_error(self):
+        test_files = [
+            ('a.txt', 'a' * 100)
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('fcntl.ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'not supported')), \
+                 unittest_mock.patch('os.copy_file_range', side_effect=[10, OSError(errno.ENOSPC, 'No space left on device')]):
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([input_dir, output_dir, '--copy', '*'])
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), f'{os.path.join(input_dir, "a.txt")}: error: [Errno 28] No space left on device\n')
+            self.assertEqual(os.listdir(output_dir), [])
+
+    def test_file_not_exist(self):
+        with create_test_files([]) as input_dir, \
+             create_test_files([]) as output_dir:
+            input_path = os.path.join(input_dir, 'template.txt')
+            output_path = os.path.join(output_dir, 'other.txt')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([input_path, output_path])
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), f"'template.txt' not found in search path: {input_dir!r}\n")
+            self.assertFalse(os.path.exists(input_path))
+            self.assertFalse(os.path.exists(output_path))
+
+    def test_archive(self):
+        test_files = [
+            ('a.txt', 'a {{a}}'),
+            (('subdir', 'b.txt'), '{% template_specialize_rename "subdir", "newdir" %}b {{a}}'),
+            (('static', 'raw.css'), '{{ raw }}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            for archive_name in ('out.tar', 'out.tar.gz', 'out.TGZ', os.path.join('sub', 'out.zip')):
+                output_path = os.path.join(output_dir, archive_name)
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    main([input_dir, output_path, '-k', 'a', '1', '--copy', 'static/*'])
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), '')
+                if archive_name.endswith('.zip'):
+                    with zipfile.ZipFile(output_path) as archive:
+                        members = {name: archive.read(name) for name in archive.namelist()}
+                else:
+                    with tarfile.open(output_path) as archive:
+                        members = {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+                self.assertEqual(members, {
+                    'a.txt': b'a 1',
+                    'newdir/b.txt': b'b 1',
+                    'static/raw.css': b'{{ raw }}'
+                })
+            self.assertEqual(sorted(os.listdir(output_dir)), ['out.TGZ', 'out.tar', 'out.tar.gz', 'sub'])
+
+    def test_archive_stdout(self):
+        test_files = [
+            ('a.txt', '{% template_specialize_rename "b.txt" %}a {{a}}'),
+            ('b.txt', 'b')
+        ]
+        with create_test_files(test_files) as input_dir:
+            with unittest_mock.patch('sys.stdout', new=TextIOWrapper(BytesIO())) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_dir, '-', '-k', 'a', '1'])
+                with tarfile.open(fileobj=BytesIO(stdout.buffer.getvalue())) as archive:
+                    members = {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(members, {'a.txt': b'a 1'})
+
+    def test_archive_file(self):
+        test_files = [
+            ('a.txt', 'a {{a}}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            # A template file is rendered to an archive-named destination file as-is
+            for archive_name in ('out.tar', 'out.zip', '-'):
+                output_path = os.path.join(output_dir, archive_name)
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    main([os.path.join(input_dir, 'a.txt'), output_path, '-k', 'a', '1', '--skip-unchanged'])
+                self.assertEqual(stdout.getvalue(), '1 files written, 0 files unchanged\n')
+                self.assertEqual(stderr.getvalue(), '')
+                with open(output_path, 'r', encoding='utf-8') as f_output:
+                    self.assertEqual(f_output.read(), 'a 1')
+
+            output_path = os.path.join(output_dir, 'out2.tgz')
+            Specializer(os.path.join(input_dir, 'a.txt')).render(output_path, variables={'a': 2})
+            with open(output_path, 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'a 2')
+
+    def test_archive_error(self):
+        test_files = [
+            ('a.txt', '{% template_specialize_rename "missing.txt", "b.txt" %}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            output_path = os.path.join(output_dir, 'out.zip')
+            for argv, error in (
+                ([input_dir, output_path], "template_specialize_rename error: no such file or directory: 'missing.txt'"),
+                ([input_dir, output_path, '--incremental'], 'argument --incremental: not allowed with an archive destination\n'),
+                ([input_dir, output_path, '--skip-unchanged'], 'argument --skip-unchanged: not allowed with an archive destination\n')
+            ):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    with self.assertRaises(SystemExit) as cm_exc:
+                        main(argv)
+                self.assertEqual(cm_exc.exception.code, 2)
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertTrue(stderr.getvalue().endswith(error), stderr.getvalue())
+            self.assertEqual(os.listdir(output_dir), [])
+
+    def test_archive_write_error(self):
+        test_files = [
+            ('a.txt', 'a')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([('file.txt', 'file')]) as output_dir:
+            output_path = os.path.join(output_dir, 'file.txt', 'out.zip')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([input_dir, output_path])
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), f"[Errno 17] File exists: {os.path.join(output_dir, 'file.txt')!r}\n")
+            self.assertEqual(os.listdir(output_dir), ['file.txt'])
+
+    def test_archive_rename_invalid(self):
+        test_files = [
+            ('a.txt', '{% template_specialize_rename "../a.txt", "b.txt" %}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit):
+                    main([input_dir, os.path.join(output_dir, 'out.tar')])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), "template_specialize_rename invalid path '../a.txt'")
+
+    def test_archive_src(self):
+        with create_test_files([]) as input_dir, \
+             create_test_files([]) as output_dir:
+            archive_path = os.path.join(input_dir, 'templates.tar.gz')
+            with tarfile.open(archive_path, 'w:gz') as archive:
+                for name, content in (
+                    ('.specializeignore', b'node_modules/\n'),
+                    ('a.txt', b'a {{a}} {% include "inc.txt" %}'),
+                    ('inc.txt', b'inc'),
+                    ('subdir/b.txt', b'{% template_specialize_rename "subdir", "newdir" %}b {{a}}'),
+                    ('static/raw.css', b'{{ raw }}'),
+                    ('node_modules/c.txt', b'{{ c }}'),
+                    ('skip.tmp', b'{{ skip }}')
+                ):
+                    member_info = tarfile.TarInfo(name)
+                    member_info.size = len(content)
+                    archive.addfile(member_info, BytesIO(content))
+
+            for _ in range(2):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    main([archive_path, output_dir, '-k', 'a', '1', '--copy', 'static/*', '--exclude', '*.tmp', '--skip-unchanged'])
+                self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(stdout.getvalue(), '1 files written, 3 files unchanged\n')
+            self.assertEqual(sorted(os.listdir(output_dir)), ['a.txt', 'inc.txt', 'newdir', 'static'])
+            with open(os.path.join(output_dir, 'a.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'a 1 inc')
+            with open(os.path.join(output_dir, 'newdir', 'b.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'b 1')
+            with open(os.path.join(output_dir, 'static', 'raw.css'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), '{{ raw }}')
+
+            # Template archive to archive destination
+            output_path = os.path.join(output_dir, 'out.zip')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([archive_path, output_path, '-k', 'a', '1', '--copy', 'static/*', '--exclude', '*.tmp', '-j', '2'])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            with zipfile.ZipFile(output_path) as archive:
+                self.assertEqual({name: archive.read(name) for name in archive.namelist()}, {
+                    'a.txt': b'a 1 inc',
+                    'inc.txt': b'inc',
+                    'newdir/b.txt': b'b 1',
+                    'static/raw.css': b'{{ raw }}'
+                })
+
+    def test_archive_searchpath(self):
+        test_files = [
+            ('template.txt', '{% include "inc.txt" %} {% include "other.txt" %}'),
+            (('include', 'other.txt'), 'other {{a}}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            archive_path = os.path.join(input_dir, 'include.zip')
+            with zipfile.ZipFile(archive_path, 'w') as archive:
+                archive.writestr('inc.txt', 'inc {{a}}')
+            argv = [os.path.join(input_dir, 'template.txt'), os.path.join(output_dir, 'output.txt'), '-k', 'a', '1',
+                    '-i', archive_path, '-i', os.path.join(input_dir, 'include'),
+                    '--incremental', '--cache-dir', os.path.join(output_dir, 'cache')]
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit):
+                    main(argv)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '--incremental requires a template directory\n')
+
+            # Render a template directory using an archive search path
+            os.unlink(os.path.join(input_dir, 'include', 'other.txt'))
+            os.rmdir(os.path.join(input_dir, 'include'))
+            with open(os.path.join(input_dir, 'include.zip'), 'rb') as f_archive:
+                archive_data = f_archive.read()
+            os.unlink(archive_path)
+            archive_path = os.path.join(output_dir, 'include.zip')
+            with open(archive_path, 'wb') as f_archive:
+                f_archive.write(archive_data)
+            with zipfile.ZipFile(archive_path, 'a') as archive:
+                archive.writestr('other.txt', 'other {{a}}')
+            argv = [input_dir, os.path.join(output_dir, 'output'), '-k', 'a', '1', '-i', archive_path,
+                    '--incremental', '--cache-dir', os.path.join(output_dir, 'cache')]
+            for _ in range(2):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    main(argv)
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), '')
+                with open(os.path.join(output_dir, 'output', 'template.txt'), 'r', encoding='utf-8') as f_output:
+                    self.assertEqual(f_output.read(), 'inc 1 other 1')
+
+            # Changing the archive re-renders the template
+            with zipfile.ZipFile(archive_path, 'w') as archive:
+                archive.writestr('inc.txt', 'inc2 {{a}}')
+                archive.writestr('other.txt', 'other2')
+            os.utime(archive_path, ns=(1000000000, 1000000000))
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main(argv)
+            self.assertEqual(stderr.getvalue(), '')
+            with open(os.path.join(output_dir, 'output', 'template.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'inc2 1 other2')
+
+    def test_archive_src_error(self):
+        with create_test_files([('templates.zip', 'not a zip file')]) as input_dir, \
+             create_test_files([]) as output_dir:
+            archive_path = os.path.join(input_dir, 'templates.zip')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([archive_path, output_dir])
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertTrue(stderr.getvalue().startswith(f'invalid archive {archive_path!r}: '))
+
+    def test_compile(self):
+        test_files = [
+            (('template', 'a.txt'), "a {{a}} {% aws_parameter_store 'name1' %} {% include 'inc.txt' %}"),
+            (('template', 'subdir', 'b.txt'), '{% template_specialize_rename "subdir", "newdir" %}b {{a}}'),
+            (('template', 'static', 'raw.css'), '{{ raw }}'),
+            (('template', 'skip.tmp'), '{{ skip'),
+            (('include', 'inc.txt'), "inc {% aws_parameter_store 'name2' %}"),
+            (('include', 'unused.txt'), '{{ unused')
+        ]
+
+        def get_parameters(**kwargs):
+            return {
+                'Parameters': [{'Name': name, 'Value': f'{name}-value'} for name in kwargs['Names']],
+                'InvalidParameters': []
+            }
+
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            bundle_path = os.path.join(output_dir, 'bundle', 'templates.zip')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('botocore.session') as mock_session:
+                main([
+                    os.path.join(input_dir, 'template'), bundle_path, '-i', os.path.join(input_dir, 'include'),
+                    '--copy', 'static/*', '--exclude', '*.tmp', '--compile'
+                ])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(mock_session.get_session.return_value.create_client.return_value.get_parameters.call_args_list, [])
+            with zipfile.ZipFile(bundle_path) as bundle:
+                self.assertEqual(len(bundle.namelist()), 5)
+                self.assertEqual(bundle.read('static/raw.css'), b'{{ raw }}')
+                self.assertEqual(json.loads(bundle.read('template-specialize-bundle.json')), {
+                    'version': 1,
+                    'jinja2': jinja2.__version__,
+                    'files': ['a.txt', 'static/raw.css', 'subdir/b.txt'],
+                    'copy_files': ['static/raw.css'],
+                    'rename_files': ['subdir/b.txt'],
+                    'parameter_store_names': ['name1', 'name2']
+                })
+
+            # Render the bundle - the templates are not compiled
+            for _ in range(2):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                     unittest_mock.patch('botocore.session') as mock_session:
+                    mock_session.get_session.return_value.create_client.return_value.get_parameters.side_effect = get_parameters
+                    main([bundle_path, os.path.join(output_dir, 'output'), '-k', 'a', '1', '--skip-unchanged', '-j', '2',
+                          '--timings-json', os.path.join(output_dir, 'timings.json')])
+                self.assertEqual(stderr.getvalue(), '')
+                self.assertEqual(
+                    mock_session.get_session.return_value.create_client.return_value.get_parameters.call_args.kwargs['Names'],
+                    ['name1', 'name2']
+                )
+            self.assertEqual(stdout.getvalue(), '1 files written, 2 files unchanged\n')
+            self.assertEqual(sorted(os.listdir(os.path.join(output_dir, 'output'))), ['a.txt', 'newdir', 'static'])
+            with open(os.path.join(output_dir, 'output', 'a.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'a 1 name1-value inc name2-value')
+            with open(os.path.join(output_dir, 'output', 'newdir', 'b.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'b 1')
+            with open(os.path.join(output_dir, 'output', 'static', 'raw.css'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), '{{ raw }}')
+            with open(os.path.join(output_dir, 'timings.json'), 'r', encoding='utf-8') as f_timings:
+                timings = json.load(f_timings)['timings']
+            self.assertEqual(
+                sorted(timing['name'] for timing in timings if timing['phase'] == 'load'), ['a.txt', 'inc.txt', 'subdir/b.txt']
+            )
+            self.assertEqual([timing for timing in timings if timing['phase'] == 'compile'], [])
+
+            # Template bundle to archive destination
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('botocore.session') as mock_session:
+                mock_session.get_session.return_value.create_client.return_value.get_parameters.side_effect = get_parameters
+                main([bundle_path, os.path.join(output_dir, 'output.tar'), '-k', 'a', '2'])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            with tarfile.open(os.path.join(output_dir, 'output.tar')) as archive:
+                self.assertEqual({member.name: archive.extractfile(member).read() for member in archive.getmembers()}, {
+                    'a.txt': b'a 2 name1-value inc name2-value',
+                    'newdir/b.txt': b'b 2',
+                    'static/raw.css': b'{{ raw }}'
+                })
+
+    def test_compile_dynamic(self):
+        test_files = [
+            (('template', 'a.txt'), '{% include name %}'),
+            (('template', 'error.txt'), '{% raw %}{{ error{% endraw %}'),
+            (('include', 'inc.txt'), 'inc {{a}}'),
+            (('include', 'broken.txt'), '{{ error')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            bundle_path = os.path.join(output_dir, 'templates.zip')
+            specializer = Specializer(os.path.join(input_dir, 'template'), searchpaths=[os.path.join(input_dir, 'include')])
+            specializer.compile(bundle_path)
+            specializer_bundle = Specializer(bundle_path)
+            specializer_bundle.render(os.path.join(output_dir, 'output'), variables={'a': 1, 'name': 'inc.txt'})
+            self.assertEqual(sorted(os.listdir(os.path.join(output_dir, 'output'))), ['a.txt', 'error.txt'])
+            with open(os.path.join(output_dir, 'output', 'a.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'inc 1')
+            with open(os.path.join(output_dir, 'output', 'error.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), '{{ error')
+
+            # Errors
+            with self.assertRaises(ValueError) as cm_exc:
+                Specializer(os.path.join(input_dir, 'include', 'inc.txt')).compile(bundle_path)
+            self.assertEqual(str(cm_exc.exception), 'a template bundle requires a template directory\n')
+            with self.assertRaises(ValueError) as cm_exc:
+                Specializer(os.path.join(input_dir, 'include')).compile(bundle_path)
+            self.assertEqual(
+                str(cm_exc.exception),
+                f"{os.path.join(input_dir, 'include', 'broken.txt')}:1: unexpected end of template, "
+                "expected 'end of print statement'.\n"
+            )
+            with self.assertRaises(ValueError) as cm_exc:
+                specializer_bundle.render(os.path.join(output_dir, 'error'), variables={'a': 1, 'name': 'broken.txt'})
+            self.assertEqual(str(cm_exc.exception), 'broken.txt\n')
+
+    def test_compile_error(self):
+        test_files = [
+            (('template', 'a.txt'), 'a {{ a'),
+            (('template2', 'template-specialize-bundle.json'), '{}'),
+            ('template.txt', 'a')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            bundle_path = os.path.join(output_dir, 'templates.zip')
+            for argv, message in (
+                ([os.path.join(input_dir, 'template'), bundle_path],
+                 f"{os.path.join(input_dir, 'template', 'a.txt')}:1: unexpected end of template, "
+                 "expected 'end of print statement'.\n"),
+                ([os.path.join(input_dir, 'template.txt'), bundle_path], 'a template bundle requires a template directory\n'),
+                ([os.path.join(input_dir, 'template2'), bundle_path, '--copy', '*.json'],
+                 "file name conflicts with the bundle manifest: 'template-specialize-bundle.json'\n")
+            ):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    with self.assertRaises(SystemExit) as cm_exc:
+                        main([*argv, '--compile'])
+                self.assertEqual(cm_exc.exception.code, 2)
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), message)
+            self.assertEqual(os.listdir(output_dir), [])
+
+            # Invalid arguments
+            with zipfile.ZipFile(bundle_path, 'w') as bundle:
+                bundle.writestr('template-specialize-bundle.json', '{"version": 1, "jinja2": "1.0"}')
+            for argv, message in (
+                ([os.path.join(input_dir, 'template'), os.path.join(output_dir, 'templates.tar'), '--compile'],
+                 'argument --compile: DST must be a .zip file'),
+                ([os.path.join(input_dir, 'template'), bundle_path, '--compile', '--watch'],
+                 'argument --watch: not allowed with --compile'),
+                ([bundle_path, output_dir, '-i', input_dir], 'argument -i: not allowed with a template bundle source'),
+                ([bundle_path, output_dir, '--incremental'], 'argument --incremental: not allowed with a template bundle source')
+            ):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    with self.assertRaises(SystemExit) as cm_exc:
+                        main(argv)
+                self.assertEqual(cm_exc.exception.code, 2)
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertTrue(stderr.getvalue().endswith(f'template-specialize: error: {message}\n'), stderr.getvalue())
+
+            # Bundle compiled by another Jinja2 version
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([bundle_path, output_dir])
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(
+                stderr.getvalue(), f'bundle {bundle_path!r} was compiled with Jinja2 1.0, not Jinja2 {jinja2.__version__}\n'
+            )
+
+    def test_shard(self):
+        test_files = [
+            *((f'file{ix}.txt', f'file{ix} {{{{a}}}}' + ' ' * (ix * 100)) for ix in range(10)),
+            ('rename.txt', '{% template_specialize_rename "subdir", "newdir" %}{% template_specialize_rename "file0.txt" %}'),
+            (('subdir', 'sub.txt'), 'sub {{a}}'),
+            (('static', 'raw.css'), '{{ raw }}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            # Render the template directory without sharding
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_dir, os.path.join(output_dir, 'expected'), '-k', 'a', '1', '--copy', 'static/*'])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+
+            # Render each shard into its own directory - the shards are disjoint
+            shard_names = []
+            for shard_index in range(1, 4):
+                shard_dir = os.path.join(output_dir, f'shard{shard_index}')
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    main([input_dir, shard_dir, '-k', 'a', '1', '--copy', 'static/*', '--shard', f'{shard_index}/3'])
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), '')
+                shard_names.append(sorted(
+                    os.path.relpath(os.path.join(dir_path, file_name), shard_dir)
+                    for dir_path, _, file_names in os.walk(shard_dir) for file_name in file_names
+                    if file_name != f'.template-specialize-shard-{shard_index}-of-3.json'
+                ))
+                self.assertTrue(shard_names[-1])
+            self.assertEqual(sorted(chain.from_iterable(shard_names)), sorted(
+                os.path.join(*test_file[0]) if isinstance(test_file[0], tuple) else test_file[0] for test_file in test_files
+            ))
+            with open(os.path.join(output_dir, 'shard1', '.template-specialize-shard-1-of-3.json'), 'r', encoding='utf-8') as f_shard:
+                shard_renames = json.load(f_shard)
+            self.assertEqual(shard_renames['version'], 1)
+            self.assertEqual(
+                shard_renames['renames'],
+                {'rename.txt': [['subdir', 'newdir'], ['file0.txt', None]]} if 'rename.txt' in shard_names[0] else {}
+            )
+
+            # Render each shard into the same directory and merge
+            merge_dir = os.path.join(output_dir, 'merge')
+            for shard_index in (3, 1, 2):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    main([input_dir, merge_dir, '-k', 'a', '1', '--copy', 'static/*', '--shard', f'{shard_index}/3', '-j', '2'])
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), '')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main(['--merge-shards', merge_dir])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(sorted(os.listdir(merge_dir)), sorted(os.listdir(os.path.join(output_dir, 'expected'))))
+            self.assertNotIn('file0.txt', os.listdir(merge_dir))
+            for dir_path, _, file_names in os.walk(os.path.join(output_dir, 'expected')):
+                for file_name in file_names:
+                    file_path = os.path.join(dir_path, file_name)
+                    with open(file_path, 'r', encoding='utf-8') as f_expected, \
+                         open(os.path.join(merge_dir, os.path.relpath(file_path, os.path.join(output_dir, 'expected'))), 'r',
+                              encoding='utf-8') as f_output:
+                        self.assertEqual(f_output.read(), f_expected.read())
+
+    def test_shard_partition(self):
+        test_files = [(f'file{ix}.txt', 'x' * (ix * 1000)) for ix in range(20)]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            bundle_path = os.path.join(output_dir, 'templates.zip')
+            with unittest_mock.patch('sys.stdout', new=StringIO()), \
+                 unittest_mock.patch('sys.stderr', new=StringIO()):
+                main([input_dir, bundle_path, '--compile'])
+
+            # The directory and template bundle shards are balanced by file size
+            for src_path in (input_dir, bundle_path):
+                shard_sizes = []
+                for shard_index in range(1, 5):
+                    shard_dir = os.path.join(output_dir, f'shard{shard_index}')
+                    with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                         unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                        main([src_path, shard_dir, '--shard', f'{shard_index}/4'])
+                    self.assertEqual(stdout.getvalue(), '')
+                    self.assertEqual(stderr.getvalue(), '')
+                    os.unlink(os.path.join(shard_dir, f'.template-specialize-shard-{shard_index}-of-4.json'))
+                    shard_sizes.append(sum(os.path.getsize(os.path.join(shard_dir, file_name)) for file_name in os.listdir(shard_dir)))
+                    shutil.rmtree(shard_dir)
+                self.assertEqual(sum(shard_sizes), sum(len(content) for _, content in test_files))
+                self.assertLess(max(shard_sizes) - min(shard_sizes), 20000)
+
+    def test_shard_error(self):
+        test_files = [
+            ('template.txt', 'a'),
+            (('template', 'rename.txt'), '{% template_specialize_rename "unknown.txt" %}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            for argv, message in (
+                ([os.path.join(input_dir, 'template'), output_dir, '--shard', '0/2'], "argument --shard: invalid shard: '0/2'"),
+                ([os.path.join(input_dir, 'template'), output_dir, '--shard', '3/2'], "argument --shard: invalid shard: '3/2'"),
+                ([os.path.join(input_dir, 'template'), output_dir, '--shard', 'a/b'], "argument --shard: invalid shard: 'a/b'"),
+                ([os.path.join(input_dir, 'template'), output_dir, '--shard', '1/2', '--incremental'],
+                 'argument --incremental: not allowed with --shard'),
+                ([os.path.join(input_dir, 'template'), os.path.join(output_dir, 'out.tar'), '--shard', '1/2'],
+                 'argument --shard: not allowed with an archive destination'),
+                (['--merge-shards', output_dir, os.path.join(input_dir, 'template')],
+                 'argument --merge-shards: not allowed with SRC and DST')
+            ):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    with self.assertRaises(SystemExit) as cm_exc:
+                        main(argv)
+                self.assertEqual(cm_exc.exception.code, 2)
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertTrue(stderr.getvalue().endswith(f'template-specialize: error: {message}\n'), stderr.getvalue())
+
+            # Merge errors
+            def merge_error(message):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    with self.assertRaises(SystemExit) as cm_exc:
+                        main(['--merge-shards', output_dir])
+                self.assertEqual(cm_exc.exception.code, 2)
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), message)
+
+            merge_error(f'no shard rename files in {output_dir!r}\n')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([os.path.join(input_dir, 'template'), output_dir, '--shard', '1/1'])
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([os.path.join(input_dir, 'template.txt'), output_dir, '--shard', '1/1'])
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '--shard requires a template directory\n')
+            merge_error("template_specialize_rename error: [Errno 2] No such file or directory: "
+                        f"{os.path.join(output_dir, 'unknown.txt')!r}\n")
+            shard_path = os.path.join(output_dir, '.template-specialize-shard-1-of-1.json')
+            self.assertTrue(os.path.isfile(shard_path))
+
+            with open(os.path.join(output_dir, '.template-specialize-shard-2-of-3.json'), 'w', encoding='utf-8') as f_shard:
+                f_shard.write('{"version": 1, "renames": {}}')
+            merge_error(f'shard rename files in {output_dir!r} have different shard counts\n')
+            os.unlink(shard_path)
+            merge_error(f'missing shard rename files in {output_dir!r}: 1/3, 3/3\n')
+            with open(shard_path, 'w', encoding='utf-8') as f_shard:
+                f_shard.write('{"version": 2}')
+            merge_error(f'invalid shard rename file {shard_path!r}\n')
+            for shard_content in ('{"version": 1}', '{"version": 1, "renames": []}', '{"version": 1, "renames": {"a.txt": "b.txt"}}'):
+                with open(shard_path, 'w', encoding='utf-8') as f_shard:
+                    f_shard.write(shard_content)
+                merge_error(f'invalid shard rename file {shard_path!r}\n')
+            with open(shard_path, 'w', encoding='utf-8') as f_shard:
+                f_shard.write('invalid')
+            merge_error(f'invalid shard rename file {shard_path!r}: Expecting value: line 1 column 1 (char 0)\n')
+
+            # Shard rename file write error
+            os.unlink(shard_path)
+            os.makedirs(os.path.join(shard_path, 'subdir'))
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([os.path.join(input_dir, 'template'), output_dir, '--shard', '1/1'])
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertTrue(stderr.getvalue().startswith('[Errno '), stderr.getvalue())
+            self.assertTrue(stderr.getvalue().endswith(f'{shard_path!r}\n'), stderr.getvalue())
+
+    def test_rename(self):
+        test_files = [
+            (
+                'template.txt',
+                '''\
+{# Delete template.txt #}
+{% template_specialize_rename "template.txt" %}
+
+{# Rename the file and the sub-directory #}
+{% template_specialize_rename "subdir/subtemplate.txt", "newtemplate.txt" %}
+{% template_specialize_rename "subdir", "newdir" %}
+'''
+            ),
+            (('subdir', 'subtemplate.txt'), 'agree, "{{foo}}" is the value of "foo"')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_dir, output_dir, '--key', 'foo', 'bar'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertFalse(os.path.exists(os.path.join(output_dir, 'template.txt')))
+            self.assertFalse(os.path.exists(os.path.join(output_dir, 'subdir')))
+            with open(os.path.join(output_dir, 'newdir', 'newtemplate.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'agree, "bar" is the value of "foo"')
+
+    def test_rename_before_write(self):
+        test_files = [
+            (
+                'template.txt',
+                '''\
+{% template_specialize_rename "template.txt" %}
+{% template_specialize_rename "error.txt" %}
+{% template_specialize_rename "file.txt", "renamed.txt" %}
+'''
+            ),
+            ('error.txt', '{{ undefined }}'),
+            ('file.txt', 'file {{foo}}'),
+            ('other.txt', 'other')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            for written_message in ('2 files written, 0 files unchanged\n', '0 files written, 2 files unchanged\n'):
+                # Deleted files are never rendered and renamed files are written to their destination path
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                     unittest_mock.patch('template_specialize.main.os.rename') as mock_rename, \
+                     unittest_mock.patch('template_specialize.main.os.unlink') as mock_unlink:
+                    main([input_dir, output_dir, '--key', 'foo', 'bar', '--skip-unchanged', '-j', '2'])
+
+                self.assertEqual(stdout.getvalue(), written_message)
+                self.assertEqual(stderr.getvalue(), '')
+                self.assertEqual(mock_rename.call_count, 0)
+                self.assertEqual(mock_unlink.call_count, 0)
+                self.assertEqual(sorted(os.listdir(output_dir)), ['other.txt', 'renamed.txt'])
+                with open(os.path.join(output_dir, 'renamed.txt'), 'r', encoding='utf-8') as f_output:
+                    self.assertEqual(f_output.read(), 'file bar')
+
+            # Previously written files are renamed and deleted
+            with open(os.path.join(output_dir, 'file.txt'), 'w', encoding='utf-8') as f_output:
+                f_output.write('stale')
+            with open(os.path.join(output_dir, 'template.txt'), 'w', encoding='utf-8') as f_output:
+                f_output.write('stale')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                main([input_dir, output_dir, '--key', 'foo', 'bar'])
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(sorted(os.listdir(output_dir)), ['other.txt', 'renamed.txt'])
+            with open(os.path.join(output_dir, 'renamed.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'file bar')
+
+    def test_rename_include(self):
+        test_files = [
+            (('template', 'template.txt'), '{% include "renames.txt" %}'),
+            (('template', 'dynamic.txt'), '{% include name %}'),
+            (('template', 'file.txt'), 'file'),
+            (('include', 'renames.txt'), '{% template_specialize_rename "file.txt", "renamed.txt" %}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('template_specialize.main.os.rename') as mock_rename:
+                main([os.path.join(input_dir, 'template'), output_dir, '-i', os.path.join(input_dir, 'include'),
+                      '--key', 'name', 'file.txt'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertEqual(mock_rename.call_count, 0)
+            self.assertEqual(sorted(os.listdir(output_dir)), ['dynamic.txt', 'renamed.txt', 'template.txt'])
+
+    def test_rename_directory_exists(self):
+        test_files = [
+            (
+                'template.txt',
+                '''\
+{# Delete template.txt #}
+{% template_specialize_rename "template.txt" %}
+
+{# Rename the file and the sub-directory #}
+{% template_specialize_rename "subdir", "newdir" %}
+'''
+            ),
+            (('subdir', 'subtemplate.txt'), 'agree, "{{foo}}" is the value of "foo"')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+
+                # Destination directory exists and is non-empty
+                os.mkdir(os.path.join(output_dir, 'newdir'))
+                os.mkdir(os.path.join(output_dir, 'newdir', 'newsubdir'))
+
+                main([input_dir, output_dir, '--key', 'foo', 'bar'])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertFalse(os.path.exists(os.path.join(output_dir, 'template.txt')))
+            self.assertFalse(os.path.exists(os.path.join(output_dir, 'subdir')))
+            with open(os.path.join(output_dir, 'newdir', 'subtemplate.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'agree, "bar" is the value of "foo"')
+
+    def test_rename_unchanged(self):
+        test_files = [
+            (
+                'template.txt',
+                '''\
+{# Delete template.txt #}
+{% template_specialize_rename "template.txt" %}
+
+{# Rename the file and the sub-directory #}
+{% template_specialize_rename "subdir/subtemplate.txt", "subtemplate.txt" %}
+{% template_specialize_rename "subdir", "subdir" %}
+'''
+            ),
+            (('subdir', 'subtemplate.txt'), 'agree, "{{foo}}" is the value of "foo"')
         ]
         with create_test_files(test_files) as input_dir, \
              create_test_files([]) as output_dir:
@@ -584,6 +2772,57 @@ unknown environment 'unknown'
             with open(os.path.join(output_dir, 'subdir', 'subtemplate.txt'), 'r', encoding='utf-8') as f_output:
                 self.assertEqual(f_output.read(), 'agree, "bar" is the value of "foo"')
 
+    def test_rename_existing(self):
+        test_files = [
+            (
+                'template.txt',
+                '''\
+{# Delete an existing directory #}
+{% template_specialize_rename "olddir" %}
+
+{# Rename an existing file, replacing an existing directory #}
+{% template_specialize_rename "old.txt", "newdir" %}
+template'''
+            ),
+            ('cycle.txt', '{% if false %}{% include "cycle.txt" %}{% endif %}cycle')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            for written_message in ('2 files written, 0 files unchanged\n', '0 files written, 2 files unchanged\n'):
+                os.makedirs(os.path.join(output_dir, 'olddir', 'subdir'))
+                os.makedirs(os.path.join(output_dir, 'newdir', 'subdir'))
+                with open(os.path.join(output_dir, 'old.txt'), 'w', encoding='utf-8') as f_output:
+                    f_output.write('old')
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    main([input_dir, output_dir, '--skip-unchanged'])
+
+                self.assertEqual(stdout.getvalue(), written_message)
+                self.assertEqual(stderr.getvalue(), '')
+                self.assertEqual(sorted(os.listdir(output_dir)), ['cycle.txt', 'newdir', 'template.txt'])
+                with open(os.path.join(output_dir, 'newdir'), 'r', encoding='utf-8') as f_output:
+                    self.assertEqual(f_output.read(), 'old')
+                os.unlink(os.path.join(output_dir, 'newdir'))
+
+    def test_rename_write_error(self):
+        test_files = [
+            ('template.txt', '{% template_specialize_rename "other.txt", "renamed.txt" %}'),
+            ('other.txt', 'other')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([(('template.txt', 'file.txt'), 'file')]) as output_dir:
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([input_dir, output_dir])
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertTrue(
+                stderr.getvalue().startswith(f"{os.path.join(input_dir, 'template.txt')}: error: [Errno "), stderr.getvalue()
+            )
+            self.assertEqual(sorted(os.listdir(output_dir)), ['template.txt'])
+
     def test_delete_directory(self):
         test_files = [
             (
@@ -866,6 +3105,12 @@ template_specialize_rename invalid path {os.path.join('..', 'bar.txt')!r}''')
                 }
             }
 
+        def get_parameters(**kwargs):
+            return {
+                'Parameters': [{'Name': name, 'Value': f'{name}-{{value}}'} for name in kwargs['Names']],
+                'InvalidParameters': []
+            }
+
         with create_test_files(test_files) as input_dir, \
              create_test_files([]) as output_dir:
             input_path = os.path.join(input_dir, 'template.txt')
@@ -874,6 +3119,7 @@ template_specialize_rename invalid path {os.path.join('..', 'bar.txt')!r}''')
                  unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
                  unittest_mock.patch('botocore.session') as mock_session:
                 mock_session.get_session.return_value.create_client.return_value.get_parameter.side_effect = get_parameter
+                mock_session.get_session.return_value.create_client.return_value.get_parameters.side_effect = get_parameters
                 main([input_path, output_path, '--key', 'foo', 'a"[bar}'])
 
             self.assertEqual(stdout.getvalue(), '')
@@ -889,12 +3135,201 @@ a"[bar}-{value}
 '''
                 )
 
-            # get_parameter results should be cached between blocks.
-            mock_session.get_session.return_value.create_client.return_value.assert_has_calls([
-                unittest_mock.call.get_parameter(Name='some/string', WithDecryption=True),
+            # Literal parameter names are retrieved up-front - get_parameter results should be cached between blocks.
+            self.assertEqual(mock_session.get_session.return_value.create_client.return_value.mock_calls, [
+                unittest_mock.call.get_parameters(Names=['some/string'], WithDecryption=True),
                 unittest_mock.call.get_parameter(Name='a"[bar}', WithDecryption=True)
             ])
 
+    def test_aws_parameter_store_prefetch(self):
+        test_files = [
+            (('template', 'template.txt'), "{% aws_parameter_store 'name1' %}\n{% include 'include.txt' %}"),
+            (('template', 'subdir', 'subtemplate.txt'), "{% aws_parameter_store 'name2' %}"),
+            (('template', 'static.txt'), 'static'),
+            (('include', 'include.txt'), "{% aws_parameter_store 'name3' %}")
+        ]
+
+        def get_parameters(**kwargs):
+            return {
+                'Parameters': [{'Name': name, 'Value': f'{name}-value'} for name in kwargs['Names']],
+                'InvalidParameters': []
+            }
+
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('botocore.session') as mock_session:
+                mock_session.get_session.return_value.create_client.return_value.get_parameters.side_effect = get_parameters
+                main([os.path.join(input_dir, 'template'), output_dir, '-i', os.path.join(input_dir, 'include')])
+
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '')
+            with open(os.path.join(output_dir, 'template.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'name1-value\nname3-value')
+            with open(os.path.join(output_dir, 'subdir', 'subtemplate.txt'), 'r', encoding='utf-8') as f_output:
+                self.assertEqual(f_output.read(), 'name2-value')
+            self.assertEqual(
+                sorted(mock_session.get_session.return_value.create_client.return_value.get_parameters.call_args.kwargs['Names']),
+                ['name1', 'name2', 'name3']
+            )
+            self.assertEqual(mock_session.get_session.return_value.create_client.return_value.get_parameter.call_args_list, [])
+
+    def test_aws_parameter_store_cache(self):
+        test_files = [
+            ('template.txt', "{% aws_parameter_store 'some/string' %}")
+        ]
+
+        def get_parameters(**kwargs):
+            return {
+                'Parameters': [{'Name': name, 'Value': f'{name}-{{value}}'} for name in kwargs['Names']],
+                'InvalidParameters': []
+            }
+
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir, \
+             create_test_files([]) as cache_dir:
+            input_path = os.path.join(input_dir, 'template.txt')
+            output_path = os.path.join(output_dir, 'other.txt')
+            timings_path = os.path.join(output_dir, 'timings.json')
+            for argv, expected_calls, expected_counts in (
+                    ([], 1, {'parameter store cache misses': 1}),
+                    ([], 0, {'parameter store cache hits': 1}),
+                    (['--aws-cache-refresh'], 1, {'parameter store cache misses': 1}),
+                    (['--aws-cache-ttl', '0'], 1, {'parameter store cache misses': 1})
+            ):
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                     unittest_mock.patch('botocore.session') as mock_session:
+                    mock_session.get_session.return_value.create_client.return_value.get_parameters.side_effect = get_parameters
+                    main([input_path, output_path, '--aws-cache', cache_dir, '--timings-json', timings_path, *argv])
+
+                self.assertEqual(stdout.getvalue(), '')
+                self.assertEqual(stderr.getvalue(), '')
+                mock_client = mock_session.get_session.return_value.create_client.return_value
+                self.assertEqual(len(mock_client.get_parameters.call_args_list), expected_calls)
+                with open(timings_path, 'r', encoding='utf-8') as f_timings:
+                    self.assertEqual(json.load(f_timings)['counts'], expected_counts)
+                self.assertEqual(mock_client.get_parameter.call_args_list, [])
+                with open(output_path, 'r', encoding='utf-8') as f_output:
+                    self.assertEqual(f_output.read(), 'some/string-{value}')
+
+    def test_aws_parameter_store_cache_not_directory(self):
+        test_files = [
+            ('template.txt', '{% aws_parameter_store "some/string" %}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            input_path = os.path.join(input_dir, 'template.txt')
+            output_path = os.path.join(output_dir, 'other.txt')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('botocore.session') as mock_session:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([input_path, output_path, '--aws-cache', input_path])
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), f'[Errno {errno.ENOTDIR}] {os.strerror(errno.ENOTDIR)}: {input_path!r}\n')
+            self.assertEqual(mock_session.mock_calls, [])
+            self.assertFalse(os.path.exists(output_path))
+
+    def test_aws_parameter_store_client_options(self):
+        test_files = [
+            ('template.txt', '{% aws_parameter_store foo %}')
+        ]
+        with create_test_files(test_files) as input_dir, \
+             create_test_files([]) as output_dir:
+            input_path = os.path.join(input_dir, 'template.txt')
+            output_path = os.path.join(output_dir, 'other.txt')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+                 unittest_mock.patch('botocore.session') as mock_session:
+                mock_session.get_session.return_value.create_client.return_value.get_parameter.side_effect = \
+                    botocore.exceptions.ClientError({'Error': {'Code': 'ThrottlingException'}}, 'GetParameter')
+                with self.assertRaises(SystemExit) as cm_exc:
+                    main([
+                        input_path, output_path, '-k', 'foo', 'bar',
+                        '--aws-retries', '1', '--aws-max-pool-connections', '20',
+                        '--aws-connect-timeout', '2', '--aws-read-timeout', '3'
+                    ])
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(
+                stderr.getvalue(),
+                f'{input_path}: error: Failed to retrieve value "bar" from parameter store with error: ThrottlingException\n'
+            )
+            client_config = mock_session.get_session.return_value.create_client.call_args.kwargs['config']
+            self.assertEqual(client_config.retries, {'mode': 'adaptive', 'total_max_attempts': 2})
+            self.assertEqual(client_config.max_pool_connections, 20)
+            self.assertEqual(client_config.connect_timeout, 2)
+            self.assertEqual(client_config.read_timeout, 3)
+
+    def test_aws_path(self):
+        with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+             unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+             unittest_mock.patch('template_specialize.main.datetime.datetime', MockDateTime), \
+             unittest_mock.patch('botocore.session') as mock_session:
+            mock_client = mock_session.get_session.return_value.create_client.return_value
+            mock_client.get_parameters_by_path.return_value = {
+                'Parameters': [
+                    {'Name': '/svc/prod/db/host', 'Value': 'db-host'},
+                    {'Name': '/svc/prod/db/name', 'Value': 'db-name'}
+                ]
+            }
+            with self.assertRaises(SystemExit) as cm_exc:
+                main([
+                    'template.txt', 'other.txt', '--aws-path', 'config', '/svc/prod', '-k', 'config', '{"db": {"name": "other"}}',
+                    '--dump'
+                ])
+
+        self.assertEqual(cm_exc.exception.code, 0)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertEqual(stderr.getvalue(), '''\
+{
+    "config": {
+        "db": {
+            "host": "db-host",
+            "name": "other"
+        }
+    },
+    "now": "2017-12-01T07:33:00"
+}
+''')
+        self.assertEqual(
+            mock_client.get_parameters_by_path.call_args_list,
+            [unittest_mock.call(Path='/svc/prod', Recursive=True, WithDecryption=True)]
+        )
+
+    def test_aws_path_error(self):
+        with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+             unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+             unittest_mock.patch('botocore.session') as mock_session:
+            mock_session.get_session.return_value.create_client.return_value.get_parameters_by_path.side_effect = \
+                botocore.exceptions.ClientError({'Error': {'Code': 'SomeError'}}, 'GetParametersByPath')
+            with self.assertRaises(SystemExit) as cm_exc:
+                main(['template.txt', 'other.txt', '--aws-path', 'config', '/svc/prod', '--dump'])
+
+        self.assertEqual(cm_exc.exception.code, 2)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertEqual(stderr.getvalue(), 'Failed to retrieve path "/svc/prod" from parameter store with error: SomeError\n')
+
+    def test_aws_path_error_credentials(self):
+        with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+             unittest_mock.patch('sys.stderr', new=StringIO()) as stderr, \
+             unittest_mock.patch('botocore.session') as mock_session:
+            mock_session.get_session.return_value.create_client.return_value.get_parameters_by_path.side_effect = \
+                botocore.exceptions.NoCredentialsError()
+            with self.assertRaises(SystemExit) as cm_exc:
+                main(['template.txt', 'other.txt', '--aws-path', 'config', '/svc/prod', '--dump'])
+
+        self.assertEqual(cm_exc.exception.code, 2)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertEqual(
+            stderr.getvalue(), 'Failed to retrieve path "/svc/prod" from parameter store with error: NoCredentialsError\n'
+        )
+
     def test_aws_parameter_store_error(self):
         test_files = [
             (
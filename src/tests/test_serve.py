@@ -0,0 +1,169 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+from io import StringIO
+import json
+import os
+import platform
+import socket
+import sys
+from tempfile import TemporaryDirectory
+import threading
+import time
+import unittest
+import unittest.mock as unittest_mock
+
+from template_specialize.serve import client_main, request, serve
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix sockets are not supported')
+class TestServe(unittest.TestCase):
+
+    def test_console_script(self):
+        script_ext = '.exe' if platform.system() == 'Windows' else ''
+        console_script_path = os.path.join(os.path.dirname(sys.executable), f'template-specialize-client{script_ext}')
+        self.assertTrue(os.path.isfile(console_script_path))
+
+    @staticmethod
+    def _start_server(socket_path, handle_request):
+        # The server stops when a request's first argument is "stop"
+        def handle_request_stop(argv, cwd):
+            if argv[:1] == ['stop']:
+                raise KeyboardInterrupt()
+            return handle_request(argv, cwd)
+
+        thread = threading.Thread(target=serve, args=(socket_path, handle_request_stop))
+        thread.start()
+        while True:
+            try:
+                request(socket_path, None)
+                break
+            except OSError:
+                time.sleep(0.01)
+        return thread
+
+    @staticmethod
+    def _stop_server(socket_path, thread):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            client.sendall(b'{"argv": ["stop"], "cwd": "/"}\n')
+            client.recv(1)
+        thread.join()
+
+    def test_serve(self):
+        requests = []
+        def handle_request(argv, cwd):
+            requests.append((argv, cwd))
+            return len(argv), f'stdout {argv!r}', 'stderr'
+
+        with TemporaryDirectory() as temp_dir:
+            socket_path = os.path.join(temp_dir, 'test.sock')
+            thread = self._start_server(socket_path, handle_request)
+            try:
+                self.assertEqual(os.stat(socket_path).st_mode & 0o777, 0o600)
+                self.assertEqual(request(socket_path, ['a', 'b'], '/some/dir'), (2, "stdout ['a', 'b']", 'stderr'))
+                self.assertEqual(request(socket_path, []), (0, 'stdout []', 'stderr'))
+
+                # The client writes the response output and exits with the response status
+                with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                     unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                    with self.assertRaises(SystemExit) as cm_exc:
+                        client_main([socket_path, 'c', '-k', 'foo', 'bar'])
+                self.assertEqual(cm_exc.exception.code, 4)
+                self.assertEqual(stdout.getvalue(), "stdout ['c', '-k', 'foo', 'bar']")
+                self.assertEqual(stderr.getvalue(), 'stderr')
+
+                # Invalid requests
+                for request_line, error in (
+                    (b'invalid\n', 'Expecting value: line 1 column 1 (char 0)'),
+                    (b'{"argv": []}\n', "'cwd'"),
+                    (b'{"argv": [1], "cwd": "/"}\n', '"argv" must be a list of strings and "cwd" must be a string')
+                ):
+                    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                        client.connect(socket_path)
+                        client.sendall(request_line)
+                        self.assertEqual(
+                            json.loads(client.recv(1024)),
+                            {'status': 2, 'stdout': '', 'stderr': f'invalid request: {error}\n'}
+                        )
+
+                # A running daemon's socket is not replaced
+                with self.assertRaises(OSError) as cm_exc:
+                    serve(socket_path, handle_request)
+                self.assertEqual(str(cm_exc.exception), f'socket {socket_path!r} is in use')
+            finally:
+                self._stop_server(socket_path, thread)
+
+            self.assertFalse(os.path.exists(socket_path))
+            self.assertEqual(requests, [(['a', 'b'], '/some/dir'), ([], os.getcwd()), (['c', '-k', 'foo', 'bar'], os.getcwd())])
+
+    def test_serve_stale_socket(self):
+        with TemporaryDirectory() as temp_dir:
+            socket_path = os.path.join(temp_dir, 'test.sock')
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale_server:
+                stale_server.bind(socket_path)
+            self.assertTrue(os.path.exists(socket_path))
+
+            thread = self._start_server(socket_path, lambda argv, cwd: (0, 'ok', ''))
+            try:
+                self.assertEqual(request(socket_path, []), (0, 'ok', ''))
+            finally:
+                self._stop_server(socket_path, thread)
+
+    def test_serve_unterminated_request(self):
+        with TemporaryDirectory() as temp_dir:
+            socket_path = os.path.join(temp_dir, 'test.sock')
+            thread = self._start_server(socket_path, lambda argv, cwd: (0, f'ok {argv!r}', ''))
+            try:
+                # A request line without a newline is read until the client closes its side of the connection
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                    client.connect(socket_path)
+                    client.sendall(b'{"argv": ["a"], "cwd": "/"}')
+                    client.shutdown(socket.SHUT_WR)
+                    self.assertEqual(json.loads(client.recv(1024)), {'status': 0, 'stdout': "ok ['a']", 'stderr': ''})
+            finally:
+                self._stop_server(socket_path, thread)
+
+    def test_serve_request_timeout(self):
+        with TemporaryDirectory() as temp_dir:
+            socket_path = os.path.join(temp_dir, 'test.sock')
+            with unittest_mock.patch('template_specialize.serve.REQUEST_TIMEOUT', 0.1):
+                thread = self._start_server(socket_path, lambda argv, cwd: (0, f'ok {argv!r}', ''))
+                try:
+                    # A partial request line times out
+                    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                        client.connect(socket_path)
+                        client.sendall(b'{"argv": ["a"]')
+                        self.assertEqual(
+                            json.loads(client.recv(1024)),
+                            {'status': 2, 'stdout': '', 'stderr': 'invalid request: timed out\n'}
+                        )
+
+                    # Other clients are served
+                    self.assertEqual(request(socket_path, ['b']), (0, "ok ['b']", ''))
+                finally:
+                    self._stop_server(socket_path, thread)
+
+    def test_serve_not_socket(self):
+        with TemporaryDirectory() as temp_dir:
+            socket_path = os.path.join(temp_dir, 'test.sock')
+            with open(socket_path, 'w', encoding='utf-8') as f_file:
+                f_file.write('not a socket')
+
+            # A file that isn't a socket is not removed
+            with self.assertRaises(OSError):
+                serve(socket_path, lambda argv, cwd: (0, '', ''))
+            with open(socket_path, 'r', encoding='utf-8') as f_file:
+                self.assertEqual(f_file.read(), 'not a socket')
+
+    def test_client_error(self):
+        with TemporaryDirectory() as temp_dir:
+            socket_path = os.path.join(temp_dir, 'test.sock')
+            with unittest_mock.patch('sys.stdout', new=StringIO()) as stdout, \
+                 unittest_mock.patch('sys.stderr', new=StringIO()) as stderr:
+                with self.assertRaises(SystemExit) as cm_exc:
+                    client_main([socket_path, 'a'])
+
+            self.assertEqual(cm_exc.exception.code, 2)
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(stderr.getvalue(), '[Errno 2] No such file or directory\n')
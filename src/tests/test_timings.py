@@ -0,0 +1,74 @@
+# Licensed under the MIT License
+# https://github.com/craigahobbs/template-specialize/blob/main/LICENSE
+
+import unittest
+import unittest.mock as unittest_mock
+
+from template_specialize.timings import Timings
+
+
+class TestTimings(unittest.TestCase):
+
+    def test_timings(self):
+        with unittest_mock.patch('time.perf_counter', side_effect=[0, 1, 3, 10]):
+            timings = Timings()
+            with timings.time('walk'):
+                pass
+            timings.add('render', 'a.txt', 0.5)
+            timings.add('render', 'a.txt', 1)
+            timings.add('render', 'b.txt', 0.25)
+            self.assertEqual(timings.seconds('walk'), 2)
+            self.assertEqual(timings.seconds('render', 'a.txt'), 1.5)
+            self.assertEqual(timings.seconds('compile', 'a.txt'), 0)
+            self.assertEqual(timings.report(), {
+                'total': 10,
+                'timings': [
+                    {'phase': 'walk', 'name': None, 'seconds': 2, 'count': 1},
+                    {'phase': 'render', 'name': 'a.txt', 'seconds': 1.5, 'count': 2},
+                    {'phase': 'render', 'name': 'b.txt', 'seconds': 0.25, 'count': 1}
+                ],
+                'counts': {}
+            })
+
+    def test_count(self):
+        timings = Timings()
+        timings.count('b')
+        timings.parameter_cache('val1', True)
+        timings.parameter_cache('val2', False)
+        timings.parameter_cache('val3', True)
+        timings.count('b', 2)
+        self.assertEqual(timings.report()['counts'], {
+            'b': 3,
+            'parameter store cache hits': 2,
+            'parameter store cache misses': 1
+        })
+
+    def test_time_error(self):
+        timings = Timings()
+        with self.assertRaises(ValueError):
+            with timings.time('render', 'a.txt'):
+                raise ValueError()
+        self.assertEqual(timings.report()['timings'][0]['count'], 1)
+
+    def test_format_table(self):
+        with unittest_mock.patch('time.perf_counter', side_effect=[0, 4.5, 4.5]):
+            timings = Timings()
+            timings.add('walk', None, 0.5)
+            timings.add('render', 'a.txt', 1.5)
+            timings.add('render', 'b.txt', 0.25)
+            self.assertEqual(timings.format_table(), '''\
+   Seconds   Count  Phase                    Name
+     1.500       1  render                   a.txt
+     0.500       1  walk
+     0.250       1  render                   b.txt
+     4.500          total
+''')
+            timings.count('parameter store cache hits', 3)
+            self.assertEqual(timings.format_table(max_rows=2), '''\
+   Seconds   Count  Phase                    Name
+     1.500       1  render                   a.txt
+     0.500       1  walk
+(1 more)
+                 3  parameter store cache hits
+     4.500          total
+''')